@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' Throughput of the OpenSubtitles hash kernels: the former loop reading and unpacking
+8 bytes at a time, the bulk struct unpack and the NumPy one (when NumPy is installed).
+Checks that they all give the same hash.
+
+usage: python benchmarks/hashing.py [files] [rounds] '''
+
+import os
+import sys
+import time
+import struct
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'periscope', 'plugins'))
+import Fingerprint
+
+def legacyHash(name):
+    ''' OpenSubtitles.hashFile before the bulk kernel '''
+    longlongformat = 'q'  # long long
+    bytesize = struct.calcsize(longlongformat)
+    f = open(name, "rb")
+    filesize = os.path.getsize(name)
+    hash = filesize
+    for x in range(65536/bytesize):
+        buffer = f.read(bytesize)
+        (l_value,)= struct.unpack(longlongformat, buffer)
+        hash += l_value
+        hash = hash & 0xFFFFFFFFFFFFFFFF
+    f.seek(max(0,filesize-65536),0)
+    for x in range(65536/bytesize):
+        buffer = f.read(bytesize)
+        (l_value,)= struct.unpack(longlongformat, buffer)
+        hash += l_value
+        hash = hash & 0xFFFFFFFFFFFFFFFF
+    f.close()
+    return "%016x" % hash
+
+def kernelHash(kernel):
+    def hash(name):
+        size = os.path.getsize(name)
+        with open(name, 'rb') as f:
+            head = f.read(Fingerprint.CHUNK_SIZE)
+            f.seek(max(0, size - Fingerprint.CHUNK_SIZE))
+            tail = f.read(Fingerprint.CHUNK_SIZE)
+        return "%016x" % ((size + kernel(head) + kernel(tail)) & Fingerprint.MASK)
+    return hash
+
+def main():
+    nfiles = len(sys.argv) > 1 and int(sys.argv[1]) or 50
+    rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 5
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(nfiles):
+            path = os.path.join(tmpdir, 'video%d.avi' % i)
+            open(path, 'wb').write(os.urandom(Fingerprint.CHUNK_SIZE * 2 + i * 4099))
+            files.append(path)
+
+        kernels = [ ('legacy loop', legacyHash), ('struct bulk', kernelHash(Fingerprint._sumLongsStruct)) ]
+        if Fingerprint.numpy is not None:
+            kernels.append(('numpy', kernelHash(Fingerprint._sumLongsNumpy)))
+        else:
+            print 'NumPy is not installed, skipping its kernel'
+
+        expected = [ legacyHash(path) for path in files ]
+        megabytes = 2.0 * Fingerprint.CHUNK_SIZE * nfiles * rounds / 2**20
+        for name, hash in kernels:
+            start = time.time()
+            for r in range(rounds):
+                hashes = [ hash(path) for path in files ]
+            elapsed = time.time() - start
+            assert hashes == expected, "%s gives different hashes" % name
+            print '%-12s %8.1f MB/s %8.0f files/s' % (name, megabytes / elapsed, nfiles * rounds / elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
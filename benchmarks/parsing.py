@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' Speed of VideoInfo.fastGuess against guessit.guess_video_info on a corpus of video
+names, and how often they agree on the fields the plugins use when the fast path
+accepts a name.
+
+usage: python benchmarks/parsing.py [corpus]
+
+The corpus is a file with one video name or path per line, e.g. the output of
+`find /media/tv -name '*.mkv'`. Without one, a synthetic corpus mixing common
+release names with harder ones is used. '''
+
+import os
+import sys
+import time
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'periscope', 'plugins'))
+import VideoInfo
+
+FIELDS = ('type', 'series', 'season', 'episodeNumber', 'releaseGroup', 'year')
+
+SHOWS = ['Dexter', 'The.Big.Bang.Theory', 'House.M.D', 'the.office.us', 'Castle.2009', 'Doctor.Who.2005',
+         'Marvels.Agents.of.S.H.I.E.L.D', 'Grey\'s.Anatomy', 'Law.and.Order.SVU', 'Fringe']
+EPISODES = ['S01E02', 'S05E12', 's07e10', '3x04']
+RELEASES = ['720p.HDTV.x264-IMMERSE', 'HDTV.XviD-LOL', 'REPACK.720p.HDTV.x264-DIMENSION',
+            '1080p.WEB-DL.DD5.1.H.264-CtrlHD', 'hdtv.xvid-fqm', 'HDTV-2HD']
+HARD = ['Lost.S06E17E18.HDTV.avi', '24.S08E01.HDTV.XviD-LOL.avi', 'Show Name - S01E02 - Pilot.mkv',
+        'The.Wire.1x01.The.Target.avi', 'Movie.Name.2010.720p.BluRay.x264-GRP.mkv',
+        '/media/tv/Friends/Season 1/Friends - 1x01 - The One Where Monica Gets a Roommate.avi',
+        'Show.S01E01-E02.HDTV.avi', 'Show.Part.1.S01E01.mkv', 'Show.S01E01.720p.WEB-DL.mkv',
+        'Show.S01E01.HDTV.XviD-CTU-sample.avi', 'Show.S01E01.HDTV.XviD-CTU[eztv].avi', 'Heroes.S04E01.2009.avi',
+        'V.2009.S01E01.avi']
+
+def syntheticCorpus():
+    names = [ '%s.%s.%s.mkv' % combination for combination in itertools.product(SHOWS, EPISODES, RELEASES) ]
+    return names + HARD * 10
+
+def normalize(guess):
+    values = []
+    for field in FIELDS:
+        value = guess.get(field)
+        if isinstance(value, basestring):
+            value = value.lower()
+        values.append(value)
+    return tuple(values)
+
+def main():
+    if len(sys.argv) > 1:
+        corpus = [ line.strip() for line in open(sys.argv[1]) if line.strip() ]
+    else:
+        corpus = syntheticCorpus()
+
+    start = time.time()
+    import guessit
+    print 'guessit import: %.0f ms' % ((time.time() - start) * 1000)
+
+    start = time.time()
+    guesses = [ dict(guessit.guess_video_info(name)) for name in corpus ]
+    guessitTime = time.time() - start
+
+    start = time.time()
+    fast = [ VideoInfo.fastGuess(name) for name in corpus ]
+    fastTime = time.time() - start
+
+    accepted = [ (name, f, g) for name, f, g in zip(corpus, fast, guesses) if f is not None ]
+    disagreements = [ (name, f, g) for name, f, g in accepted if normalize(f) != normalize(g) ]
+
+    print '%d names, %d taken by the fast path (%.1f%%)' % (len(corpus), len(accepted), 100.0 * len(accepted) / len(corpus))
+    print 'guessit:   %8.3f ms/name' % (1000 * guessitTime / len(corpus))
+    print 'fast path: %8.3f ms/name (%.0fx faster)' % (1000 * fastTime / len(corpus), guessitTime / max(fastTime, 1e-9))
+    print 'agreement on %s: %.1f%%' % (', '.join(FIELDS), 100.0 * (len(accepted) - len(disagreements)) / max(len(accepted), 1))
+    for name, f, g in sorted(set((name, normalize(f), normalize(g)) for name, f, g in disagreements))[:20]:
+        print '  %s\n    fast:    %s\n    guessit: %s' % (name, f, g)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' Time spent decoding and unmarshalling SearchSubtitles responses by the stock
+xmlrpclib transport and by Transport.XMLRPCTransport, plain and gzipped, and the
+size gzip saves on the wire.
+
+usage: python benchmarks/xmlrpc.py [responses] [rounds]
+
+responses are files holding recorded XML-RPC response bodies (uncompressed), e.g.
+saved from a debugging proxy. Without them, a response of 500 rows shaped like the
+ones of OpenSubtitles is used. '''
+
+import os
+import sys
+import time
+import gzip
+import xmlrpclib
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'periscope', 'plugins'))
+import Transport
+
+def syntheticResponse(rows=500):
+    data = []
+    for i in range(rows):
+        data.append({ 'MatchedBy' : 'moviehash', 'IDSubtitleFile' : str(1950000000 + i), 'SubFileName' : 'Show.S01E%02d.720p.HDTV.x264-GRP.srt' % (i % 24),
+                      'SubLanguageID' : 'eng', 'MovieHash' : '%016x' % i, 'MovieByteSize' : str(366876694 + i),
+                      'MovieReleaseName' : 'Show.S01E%02d.720p.HDTV.x264-GRP' % (i % 24), 'SubDownloadsCnt' : str(i * 7),
+                      'SubAddDate' : '2011-05-04 16:28:43', 'SubRating' : '0.0', 'SubFormat' : 'srt', 'IDMovieImdb' : '1486217',
+                      'SubDownloadLink' : 'http://dl.opensubtitles.org/en/download/filead/%d.gz' % (1950000000 + i),
+                      'ZipDownloadLink' : 'http://dl.opensubtitles.org/en/download/subad/%d' % (4000000 + i),
+                      'SubtitlesLink' : 'http://www.opensubtitles.org/en/subtitles/%d/show-en' % (4000000 + i) })
+    return xmlrpclib.dumps(({ 'status' : '200 OK', 'data' : data, 'seconds' : '0.1' },), methodresponse=True)
+
+def gzipped(body):
+    buf = StringIO()
+    zf = gzip.GzipFile(fileobj=buf, mode='wb')
+    zf.write(body)
+    zf.close()
+    return buf.getvalue()
+
+class RecordedResponse(object):
+    ''' What parse_response gets from httplib '''
+    def __init__(self, body, encoding=None):
+        self.stream = StringIO(body)
+        self.encoding = encoding
+    def getheader(self, name, default=None):
+        if name.lower() == 'content-encoding' and self.encoding:
+            return self.encoding
+        return default
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+def measure(transport, body, encoding, rounds):
+    start = time.time()
+    for i in range(rounds):
+        result = transport.parse_response(RecordedResponse(body, encoding))
+    return (time.time() - start) / rounds, result
+
+def main():
+    files = [ arg for arg in sys.argv[1:] if not arg.isdigit() ]
+    rounds = ([ int(arg) for arg in sys.argv[1:] if arg.isdigit() ] or [ 20 ])[0]
+    if files:
+        responses = [ (os.path.basename(name), open(name, 'rb').read()) for name in files ]
+    else:
+        responses = [ ('synthetic', syntheticResponse()) ]
+
+    stock = xmlrpclib.Transport()
+    stock.verbose = 0
+    ours = Transport.XMLRPCTransport()
+    for name, body in responses:
+        compressed = gzipped(body)
+        print '%s: %d KiB, %d KiB gzipped (%.0f%%)' % (name, len(body) / 1024, len(compressed) / 1024, 100.0 * len(compressed) / len(body))
+        for label, payload, encoding in (('plain', body, None), ('gzip', compressed, 'gzip')):
+            stockTime, stockResult = measure(stock, payload, encoding, rounds)
+            oursTime, oursResult = measure(ours, payload, encoding, rounds)
+            assert stockResult == oursResult
+            print '  %-5s xmlrpclib: %7.2f ms  XMLRPCTransport: %7.2f ms (%.1fx)' % (label, stockTime * 1000, oursTime * 1000, stockTime / oursTime)
+
+if __name__ == '__main__':
+    main()
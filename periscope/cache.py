@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from plugins.Fingerprint import VideoFingerprint
+
+log = logging.getLogger(__name__)
+
+class CacheDatabase(object):
+    ''' A SQLite database shared by the threads of periscope. Subclasses give the
+    SCHEMA of their tables. Reads do not commit, writes commit once per logical
+    operation, and the database is in WAL mode so that commits are cheap. '''
+    SCHEMA = ""
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            log.info("Creating folder %s" % folder)
+            os.makedirs(folder)
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock:
+            try:
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+            except sqlite3.DatabaseError, e:
+                log.debug("Could not use WAL mode for %s: %s" % (path, e))
+            self.db.executescript(self.SCHEMA)
+            self.db.commit()
+
+    def query(self, query, args=()):
+        ''' Runs a read-only query and returns all its rows '''
+        with self.lock:
+            return self.db.execute(query, args).fetchall()
+
+    def execute(self, query, args=()):
+        ''' Runs a query, commits, and returns all its rows '''
+        with self.transaction() as db:
+            return db.execute(query, args).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        ''' Yields the connection to run several statements committed at once '''
+        with self.lock:
+            try:
+                yield self.db
+            except Exception:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ResultCache(CacheDatabase):
+    ''' Remembers what each plugin answered for a video and a list of languages.
+    Results with subtitles are kept ttl seconds, empty ones negativeTtl seconds.
+    The least recently used entries are evicted beyond maxEntries. '''
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS results (
+                    plugin TEXT, video TEXT, langs TEXT, subs TEXT, found INTEGER,
+                    stored REAL, accessed REAL, PRIMARY KEY (plugin, video, langs));
+                CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);'''
+
+    # Keys added by periscope to the results of the plugins, which are not stored
+    TRANSIENT_KEYS = ("plugin", "filename")
+
+    # Cache hits whose access time is written at once
+    ACCESS_BATCH = 100
+
+    def __init__(self, path, ttl=7*24*3600, negativeTtl=24*3600, maxEntries=50000):
+        super(ResultCache, self).__init__(path)
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.maxEntries = maxEntries
+        self.puts = 0
+        self.accessed = {} # (plugin, video, langs) -> time of the last hit, not written yet
+
+    def langsKey(self, langs):
+        return langs and ",".join(sorted(langs)) or "*"
+
+    def get(self, plugin, video, langs):
+        ''' Returns the cached subtitles, None if there are none or if they expired. The
+        time of the hit is written later, with other ones. '''
+        now = time.time()
+        key = (plugin, video, self.langsKey(langs))
+        rows = self.query("SELECT subs, found, stored FROM results WHERE plugin=? AND video=? AND langs=?", key)
+        if not rows:
+            return None
+        subs, found, stored = rows[0]
+        if now - stored > (found and self.ttl or self.negativeTtl):
+            return None
+        with self.lock:
+            self.accessed[key] = now
+            if len(self.accessed) >= self.ACCESS_BATCH:
+                self.flush()
+        return json.loads(subs)
+
+    def flush(self):
+        ''' Writes the access times of the last hits '''
+        with self.transaction() as db:
+            accessed, self.accessed = self.accessed, {}
+            db.executemany("UPDATE results SET accessed=? WHERE plugin=? AND video=? AND langs=?",
+                           [ (when,) + key for key, when in accessed.items() ])
+
+    def put(self, plugin, video, langs, subs):
+        now = time.time()
+        subs = [ dict((k, v) for k, v in sub.items() if k not in self.TRANSIENT_KEYS) for sub in subs ]
+        key = (plugin, video, self.langsKey(langs))
+        with self.transaction() as db:
+            self.accessed.pop(key, None)
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       key + (json.dumps(subs), len(subs) > 0, now, now))
+        self.puts += 1
+        if self.puts % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        ''' Removes the expired entries, then the least recently used ones beyond maxEntries '''
+        now = time.time()
+        self.flush()
+        with self.transaction() as db:
+            db.execute("DELETE FROM results WHERE (found AND stored < ?) OR (NOT found AND stored < ?)",
+                       (now - self.ttl, now - self.negativeTtl))
+            count = db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            if count > self.maxEntries:
+                log.debug("Evicting %d results from the cache" % (count - self.maxEntries))
+                db.execute("DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY accessed LIMIT ?)",
+                           (count - self.maxEntries,))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            super(ResultCache, self).close()
+
+
+class SearchHistory(CacheDatabase):
+    ''' Remembers the videos for which no subtitle was found, so that they are searched
+    again less and less often: backoff seconds after the first miss, then twice as
+    long after each new miss, up to maxBackoff. '''
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS history (
+                    video TEXT, langs TEXT, attempts INTEGER, lastAttempt REAL, plugins TEXT,
+                    PRIMARY KEY (video, langs));'''
+
+    def __init__(self, path, backoff=24*3600, maxBackoff=30*24*3600):
+        super(SearchHistory, self).__init__(path)
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+
+    def langsKey(self, langs):
+        return langs and ",".join(langs) or "*"
+
+    def get(self, video, langs):
+        ''' Returns (attempts, lastAttempt, plugins) for the video, None if it was never missed '''
+        rows = self.query("SELECT attempts, lastAttempt, plugins FROM history WHERE video=? AND langs=?",
+                            (video, self.langsKey(langs)))
+        if not rows:
+            return None
+        attempts, lastAttempt, plugins = rows[0]
+        return attempts, lastAttempt, plugins and plugins.split(",") or []
+
+    def nextAttempt(self, video, langs):
+        ''' Returns the time after which the video should be searched again, 0 for a new video '''
+        entry = self.get(video, langs)
+        if not entry:
+            return 0
+        attempts, lastAttempt, plugins = entry
+        return lastAttempt + min(self.maxBackoff, self.backoff * 2 ** min(attempts - 1, 32))
+
+    def shouldSearch(self, video, langs, now=None):
+        return (now or time.time()) >= self.nextAttempt(video, langs)
+
+    def recordMiss(self, video, langs, plugins):
+        ''' Records that none of the plugins found a subtitle for the video '''
+        key = (video, self.langsKey(langs))
+        self.execute("INSERT OR REPLACE INTO history VALUES (?, ?, "
+                     "COALESCE((SELECT attempts FROM history WHERE video=? AND langs=?), 0) + 1, ?, ?)",
+                     key + key + (time.time(), ",".join(plugins)))
+
+    def recordFound(self, video, langs):
+        self.execute("DELETE FROM history WHERE video=? AND langs=?", (video, self.langsKey(langs)))
+
+
+class LibraryIndex(CacheDatabase):
+    ''' Remembers the folders of the video library with their mtime and subfolders, and
+    their videos with whether they have a subtitle. A folder keeps the same entries as
+    long as its mtime does not change, so LibraryWalker does not list it again. '''
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, parent TEXT, mtime REAL);
+                CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+                CREATE TABLE IF NOT EXISTS videos (
+                    folder TEXT, name TEXT, subtitled INTEGER, PRIMARY KEY (folder, name));'''
+
+    def __init__(self, path):
+        super(LibraryIndex, self).__init__(path)
+        self.db.text_factory = str # Paths are byte strings, in any encoding
+
+    def folder(self, path, mtime):
+        ''' Returns the names of the subfolders of the folder and the paths of its videos
+        without subtitle, None if the folder is unknown or changed since it was recorded '''
+        with self.lock:
+            rows = self.db.execute("SELECT mtime FROM folders WHERE path=?", (path,)).fetchall()
+            if not rows or rows[0][0] != mtime:
+                return None
+            subfolders = [ os.path.basename(row[0]) for row in self.db.execute("SELECT path FROM folders WHERE parent=?", (path,)) ]
+            videos = [ os.path.join(path, row[0]) for row in
+                       self.db.execute("SELECT name FROM videos WHERE folder=? AND NOT subtitled ORDER BY name", (path,)) ]
+        return subfolders, videos
+
+    def update(self, path, mtime, subfolders, videos):
+        ''' Records the listing of a folder: the names of its subfolders and (name, subtitled)
+        for its videos. The folders which are gone are forgotten with everything under
+        them. A mtime of None has the folder listed again next time. '''
+        children = [ os.path.join(path, name) for name in subfolders ]
+        with self.transaction() as db:
+            known = [ row[0] for row in db.execute("SELECT path FROM folders WHERE parent=?", (path,)) ]
+            for child in set(known) - set(children):
+                self._forget(db, child)
+            db.executemany("INSERT OR IGNORE INTO folders VALUES (?, ?, NULL)", [ (child, path) for child in children ])
+            if not db.execute("UPDATE folders SET mtime=? WHERE path=?", (mtime, path)).rowcount:
+                db.execute("INSERT INTO folders VALUES (?, NULL, ?)", (path, mtime))
+            db.execute("DELETE FROM videos WHERE folder=?", (path,))
+            db.executemany("INSERT INTO videos VALUES (?, ?, ?)", [ (path, name, subtitled) for name, subtitled in videos ])
+
+    def _forget(self, db, path):
+        # The paths under path/ sort between "path/" and "path0"
+        below = (path + os.sep, path + chr(ord(os.sep) + 1))
+        db.execute("DELETE FROM folders WHERE path=? OR (path>? AND path<?)", (path,) + below)
+        db.execute("DELETE FROM videos WHERE folder=? OR (folder>? AND folder<?)", (path,) + below)
+
+
+def fileKey(path):
+    ''' Returns (device, inode, size, mtime in ns), which changes whenever the file does '''
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, int(round(st.st_mtime * 1000000000))
+
+class FingerprintCache(CacheDatabase):
+    ''' Remembers the hashes of the video files, per flavour ("opensubtitles",
+    "thesubdb", ...), so that the files are not read again on the next runs. Entries
+    are keyed by fileKey: a modified file gets new ones, the old ones are dropped.
+    The VideoFingerprint of the last used files are also kept in memory. A path of
+    ":memory:" gives a cache which only lasts as long as the process. '''
+
+    # A file has one hash per flavour, replaced when the file changes
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS hashes (
+                    device INTEGER, inode INTEGER, flavour TEXT, size INTEGER, mtime INTEGER, hash TEXT,
+                    PRIMARY KEY (device, inode, flavour));'''
+
+    def __init__(self, path, maxEntries=200000, maxMemory=256):
+        super(FingerprintCache, self).__init__(path)
+        self.maxEntries = maxEntries
+        self.maxMemory = maxMemory
+        self.memory = OrderedDict()
+        self.memoryLock = threading.Lock()
+        self.puts = 0
+
+    def get(self, path, flavour):
+        rows = self.query("SELECT hash FROM hashes WHERE device=? AND inode=? AND size=? AND mtime=? AND flavour=?",
+                          fileKey(path) + (flavour,))
+        return rows and rows[0][0] or None
+
+    def put(self, path, flavour, value):
+        self.putMany(path, { flavour : value })
+
+    def putMany(self, path, hashes):
+        ''' Stores { flavour : hash } for the file at once '''
+        device, inode, size, mtime = fileKey(path)
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                           [ (device, inode, flavour, size, mtime, value) for flavour, value in hashes.items() ])
+        self.puts += 1
+        if self.puts % 1000 == 0:
+            self.evict()
+
+    def fingerprint(self, path):
+        ''' Returns the VideoFingerprint of the file, reading the file only if its hashes
+        are not in the cache '''
+        key = (path,) + fileKey(path)
+        with self.memoryLock:
+            fingerprint = self.memory.pop(key, None)
+            if fingerprint:
+                self.memory[key] = fingerprint
+                return fingerprint
+        rows = self.query("SELECT flavour, hash FROM hashes WHERE device=? AND inode=? AND size=? AND mtime=?", key[1:])
+        hashes = dict(rows)
+        if all([ flavour in hashes for flavour in VideoFingerprint.FLAVOURS ]):
+            fingerprint = VideoFingerprint(path, key[3], hashes)
+        else:
+            fingerprint = VideoFingerprint.fromFile(path)
+            # Hashes the file is too small for are stored empty
+            self.putMany(path, dict([ (flavour, value or "") for flavour, value in fingerprint.hashes.items() ]))
+        for flavour, value in fingerprint.hashes.items():
+            fingerprint.hashes[flavour] = value or None
+        with self.memoryLock:
+            self.memory[key] = fingerprint
+            while len(self.memory) > self.maxMemory:
+                self.memory.popitem(last=False)
+        return fingerprint
+
+    def lookup(self, path, flavour, compute):
+        ''' Returns the hash of the file, calling compute(path) if it is not in the cache yet.
+        The flavours of VideoFingerprint come from fingerprint(). '''
+        if flavour in VideoFingerprint.FLAVOURS:
+            return self.fingerprint(path).get(flavour)
+        value = self.get(path, flavour)
+        if value is None:
+            value = compute(path)
+            if isinstance(value, basestring) and value:
+                self.put(path, flavour, value)
+        return value
+
+    def evict(self):
+        ''' Removes the oldest entries beyond maxEntries '''
+        count = self.query("SELECT COUNT(*) FROM hashes")[0][0]
+        if count > self.maxEntries:
+            self.execute("DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY rowid LIMIT ?)",
+                         (count - self.maxEntries,))
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import logging
+import mimetypes
+from Queue import Queue
+
+import workerpool
+
+try:
+    from scandir import scandir # Backport of os.scandir, much faster than listdir + stat
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+log = logging.getLogger(__name__)
+
+SUPPORTED_FORMATS = 'video/x-msvideo', 'video/quicktime', 'video/x-matroska', 'video/mp4'
+SUBTITLE_EXTENSIONS = ('.srt', '.sub')
+
+mimetypes.add_type("video/x-matroska", ".mkv")
+VIDEO_EXTENSIONS = frozenset([ ext.lower() for ext, mimetype in mimetypes.types_map.items() if mimetype in SUPPORTED_FORMATS ])
+
+def isVideo(filename):
+    return os.path.splitext(filename)[1].lower() in VIDEO_EXTENSIONS
+
+def hasSubtitle(name, siblings):
+    ''' Whether there is a subtitle for the video name among the set of names siblings '''
+    base = os.path.splitext(name)[0]
+    return bool([ sub for sub in SUBTITLE_EXTENSIONS if base + sub in siblings ])
+
+def listDirectory(path):
+    ''' Returns the names of the (subdirectories, files) of path. scandir gets the type
+    of the entries with the listing on most filesystems, listdir needs a stat of each. '''
+    dirs, files = [], []
+    if scandir:
+        for entry in scandir(path):
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                continue
+            (dirs if isdir else files).append(entry.name)
+    else:
+        for name in os.listdir(path):
+            (dirs if os.path.isdir(os.path.join(path, name)) else files).append(name)
+    return dirs, files
+
+
+class LibraryWalker(object):
+    ''' Finds the videos of a folder tree which have no subtitle next to them yet (or all
+    of them if force is set). The videos are yielded as their folder is listed, and up to
+    workers folders are listed at the same time, which hides the latency of network
+    filesystems. With a cache.LibraryIndex, only the folders whose mtime changed since
+    the last walk are listed (all of them if rescan is set). '''
+
+    # Folders modified less than this many seconds ago may still change within the same
+    # mtime, they are listed again on the next walk
+    SETTLE_TIME = 2
+
+    def __init__(self, force=False, workers=4, index=None, rescan=False):
+        self.force = force
+        self.workers = workers
+        self.index = index
+        self.rescan = rescan
+
+    def walk(self, root):
+        ''' Yields the videos of root, a video file or a folder searched recursively. The
+        videos of a folder are yielded together, sorted by name. '''
+        if os.path.isfile(root):
+            if not isVideo(root):
+                log.info("%s mimetype is '%s' which is not a supported video format (%s)" %(root, mimetypes.guess_type(root)[0], SUPPORTED_FORMATS))
+                return
+            folder, name = os.path.split(root)
+            base = os.path.splitext(root)[0]
+            subtitles = [ os.path.basename(base + sub) for sub in SUBTITLE_EXTENSIONS if os.path.exists(base + sub) ]
+            for video in self.videos(folder, [ name ], subtitles):
+                yield video
+            return
+        if not os.path.isdir(root):
+            return
+        if self.index:
+            root = os.path.abspath(root)
+        pool = workerpool.WorkerPool(self.workers)
+        visited = Queue()
+        def submit(path):
+            pool.submit(None, self._visit, path).addCallback(lambda task: visited.put((path, task.result or ([], []))))
+        try:
+            submit(root)
+            pending = 1
+            while pending:
+                path, (dirs, videos) = visited.get(True)
+                pending -= 1
+                #TODO if hidden folder, don't keep going (how to handle windows/mac/linux ?)
+                for name in sorted(dirs):
+                    submit(os.path.join(path, name))
+                    pending += 1
+                for video in videos:
+                    yield video
+        finally:
+            pool.shutdown()
+
+    def _visit(self, path):
+        ''' Returns the names of the subfolders of path and the paths of its videos to search '''
+        if not self.index:
+            dirs, files = self._list(path) or ([], [])
+            return dirs, self.videos(path, files, files)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError, e:
+            log.warning("Could not list %s: %s" % (path, e))
+            return [], []
+        if not self.rescan and not self.force:
+            known = self.index.folder(path, mtime)
+            if known is not None:
+                return known
+        listing = self._list(path)
+        if listing is None:
+            return [], []
+        dirs, files = listing
+        siblings = set(files)
+        if time.time() - mtime < self.SETTLE_TIME:
+            mtime = None
+        self.index.update(path, mtime, dirs, [ (name, hasSubtitle(name, siblings)) for name in files if isVideo(name) ])
+        return dirs, self.videos(path, files, siblings)
+
+    def _list(self, path):
+        try:
+            return listDirectory(path)
+        except OSError, e:
+            log.warning("Could not list %s: %s" % (path, e))
+            return None
+
+    def videos(self, folder, names, siblings):
+        ''' Returns the paths of the videos among names, sorted, which have no subtitle
+        among the siblings names of the folder '''
+        siblings = set(siblings)
+        found = []
+        for name in sorted(names):
+            if not isVideo(name):
+                continue
+            path = os.path.normpath(os.path.join(folder, name))
+            if not self.force and hasSubtitle(name, siblings):
+                log.info("Skipping file %s as it already has a subtitle. Use the --force option to force the download" % path)
+                continue
+            found.append(path)
+        return found
@@ -22,7 +22,9 @@ import sys
 import os
 import threading
 import logging
+import itertools
 from Queue import Queue
+from collections import OrderedDict
 
 import traceback
 import ConfigParser
@@ -35,18 +37,124 @@ except ImportError:
 
 import plugins
 import version
+import workerpool
+import cache
+import library
+import watcher
 import locale
 
-SUPPORTED_FORMATS = 'video/x-msvideo', 'video/quicktime', 'video/x-matroska', 'video/mp4'
+from library import SUPPORTED_FORMATS
 VERSION = version.VERSION
 
 log = logging.getLogger(__name__)
 
+# Only a subtitle found from the hash of the file stops a search early: a release name
+# match could still be beaten by a hash match from a slower plugin
+TOP_TIER_SCORE = 2
+
+class SubtitleSearch(workerpool.Future):
+    ''' The search of a file on every active plugin, whose result is the list of found
+    subtitles. It is done once every plugin answered, or as soon as a top-tier (hash
+    matched) subtitle in the first wanted language arrived if earlyExit is set, or when
+    stop() is called. The plugins still searching are then cancelled. '''
+
+    def __init__(self, periscope, filename, langs, earlyExit=False):
+        super(SubtitleSearch, self).__init__(filename)
+        self.periscope = periscope
+        self.langs = langs
+        self.earlyExit = earlyExit
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.cancelToken = plugins.Transport.Deadline()
+        self.tasks = periscope.submitSearch(filename, langs, self.cancelToken)
+        for task in self.tasks:
+            task.addCallback(self._arrived)
+        if not self.tasks:
+            self.stop()
+
+    def _arrived(self, task):
+        if all([ t.done() for t in self.tasks ]):
+            self.stop()
+        elif self.earlyExit and self.langs:
+            for sub in task.result or []:
+                if sub["lang"] == self.langs[0] and self.periscope.scoreSubtitle(sub) >= TOP_TIER_SCORE:
+                    log.info("Found %s on %s for %s, not waiting for the other plugins" %(sub.get("release"), task.key, self.key))
+                    self.stop()
+                    return
+
+    def pendingPlugins(self):
+        return [ task.key for task in self.tasks if not task.done() ]
+
+    def stop(self):
+        ''' Cancels the plugins still searching and sets the result from the others '''
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        pending = [ task for task in self.tasks if not task.done() ]
+        if pending:
+            self.periscope._unanswer(self.key)
+        for task in pending:
+            if hasattr(task, 'cancel'):
+                task.cancel()
+        self.cancelToken.cancel()
+        self.setResult(self.periscope.collectSubtitles([ task for task in self.tasks if task.done() ], self.langs))
+
+
+class DownloadBatcher(object):
+    ''' Gathers the subtitles chosen during a downloadSubtitles run on the plugins which can
+    download several of them at once (downloadBatchSize), and downloads them by batches:
+    as soon as a batch is full, or when every file in flight waits for its download. '''
+
+    def __init__(self, periscope):
+        self.periscope = periscope
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.pending = {} # plugin name -> [ (subtitle, subtitles, langs, future) ]
+
+    def started(self):
+        with self.lock:
+            self.inflight += 1
+
+    def finished(self):
+        with self.lock:
+            self.inflight -= 1
+            batches = self._ready()
+        self._submit(batches)
+
+    def add(self, subtitle, subtitles, langs, future):
+        ''' Queues the download of subtitle, the best of subtitles, whose result goes to future '''
+        name = subtitle["plugin"].__class__.__name__
+        with self.lock:
+            self.pending.setdefault(name, []).append((subtitle, subtitles, langs, future))
+            batches = self._ready()
+        self._submit(batches)
+
+    def _ready(self):
+        ''' Takes the batches to download out of pending. Must be called with the lock held. '''
+        batches = []
+        flush = sum([ len(items) for items in self.pending.values() ]) >= self.inflight
+        for name, items in self.pending.items():
+            size = getattr(plugins, name).downloadBatchSize
+            while len(items) >= size or (flush and items):
+                batches.append((name, items[:size]))
+                del items[:size]
+        return batches
+
+    def _submit(self, batches):
+        for name, items in batches:
+            try:
+                self.periscope.pool.submit(name, self.periscope._createFilesWithPlugin, name, items)
+            except RuntimeError:
+                for subtitle, subtitles, langs, future in items:
+                    future.setResult(None) # The pool was shut down
+
+
 class Periscope:
     ''' Main Periscope class'''
 
     def __init__(self):
-        self.config = ConfigParser.SafeConfigParser({"lang": "", "plugins" : "" })
+        self.config = ConfigParser.SafeConfigParser({"lang": "", "plugins" : "", "max_workers" : "8", "max_workers_per_plugin" : "2", "plugin_timeout" : "30", "search_timeout" : "30", "early_exit" : "true", "cache_ttl" : "604800", "cache_negative_ttl" : "86400", "cache_size" : "50000", "retry_backoff" : "86400", "retry_max_backoff" : "2592000" })
         if is_local:
             self.config_file = os.path.join(bd.xdg_config_home, "periscope", "config")
             if not os.path.exists(self.config_file):
@@ -64,6 +172,16 @@ class Periscope:
 
         self.pluginNames = self.get_preferedPlugins()
         self._preferedLanguages = None
+        self._pool = None
+        self._pluginInstances = {}
+        self._pluginLock = threading.Lock()
+        self._cache = None
+        self._cacheBroken = False
+        self._history = None
+        self._fingerprints = None
+        self._libraryIndex = None
+        self._batches = {} # (plugin name, filename) -> Task of the batch search of the file
+        self._unanswered = set() # Files a plugin failed to search since their last recordSearch
 
     def get_preferedLanguages(self):
         ''' Get the prefered language from the config file '''
@@ -125,30 +243,524 @@ class Periscope:
         ''' List all possible plugins from the plugin folder '''
         return map(lambda x : x.__name__, plugins.SubtitleDatabase.SubtitleDB.__subclasses__())
 
+    def get_pool(self):
+        ''' Returns the worker pool running the plugins, starting it if needed '''
+        with self._pluginLock:
+            if not self._pool:
+                maxWorkers = self.config.getint("DEFAULT", "max_workers")
+                maxPerPlugin = self.config.getint("DEFAULT", "max_workers_per_plugin")
+                log.debug("Starting worker pool (%d workers, %d per plugin)" %(maxWorkers, maxPerPlugin))
+                self._pool = workerpool.WorkerPool(maxWorkers, maxPerPlugin)
+            return self._pool
+
+    pool = property(get_pool)
+
+    def get_pluginTimeout(self):
+        ''' Seconds a plugin is given to answer a search '''
+        return self.config.getfloat("DEFAULT", "plugin_timeout")
+
+    pluginTimeout = property(get_pluginTimeout)
+
+    def get_searchTimeout(self):
+        ''' Seconds listSubtitles waits for the whole search before returning what it got.
+        Each plugin is bounded by its own plugin_timeout deadline meanwhile. '''
+        return self.config.getfloat("DEFAULT", "search_timeout")
+
+    searchTimeout = property(get_searchTimeout)
+
+    def get_earlyExit(self):
+        ''' Whether a search stops once a subtitle in the first language is found from the
+        hash of the file '''
+        return self.config.getboolean("DEFAULT", "early_exit")
+
+    earlyExit = property(get_earlyExit)
+
+    def cachePath(self):
+        ''' Returns the path of the database holding the caches, None without XDG folders '''
+        if is_local:
+            return os.path.join(bd.xdg_cache_home, "periscope", "cache.db")
+
+    def get_cache(self):
+        ''' Returns the cache of the search results, None if it is disabled (cache_ttl
+        set to 0) or if there is no XDG cache folder '''
+        with self._pluginLock:
+            if not self._cache and not self._cacheBroken and is_local and self.config.getint("DEFAULT", "cache_ttl") > 0:
+                path = self.cachePath()
+                try:
+                    self._cache = cache.ResultCache(path, self.config.getint("DEFAULT", "cache_ttl"),
+                                                    self.config.getint("DEFAULT", "cache_negative_ttl"),
+                                                    self.config.getint("DEFAULT", "cache_size"))
+                except Exception, e:
+                    log.warning("Could not open the cache %s: %s" % (path, e))
+                    self._cacheBroken = True
+            return self._cache
+
+    def set_cache(self, resultCache):
+        with self._pluginLock:
+            self._cache = resultCache
+
+    cache = property(get_cache, set_cache)
+
+    def get_history(self):
+        ''' Returns the history of the videos for which nothing was found, None if there is
+        no XDG cache folder or if the cache cannot be opened '''
+        with self._pluginLock:
+            if not self._history and not self._cacheBroken and is_local:
+                try:
+                    self._history = cache.SearchHistory(self.cachePath(), self.config.getint("DEFAULT", "retry_backoff"),
+                                                        self.config.getint("DEFAULT", "retry_max_backoff"))
+                except Exception, e:
+                    log.warning("Could not open the cache %s: %s" % (self.cachePath(), e))
+                    self._cacheBroken = True
+            return self._history
+
+    def set_history(self, history):
+        with self._pluginLock:
+            self._history = history
+
+    history = property(get_history, set_history)
+
+    def get_fingerprints(self):
+        ''' Returns the cache of the file hashes given to the plugins. It only lasts as long
+        as the process if there is no XDG cache folder. '''
+        with self._pluginLock:
+            if not self._fingerprints and not self._cacheBroken and is_local:
+                try:
+                    self._fingerprints = cache.FingerprintCache(self.cachePath())
+                except Exception, e:
+                    log.warning("Could not open the cache %s: %s" % (self.cachePath(), e))
+                    self._cacheBroken = True
+            if not self._fingerprints:
+                self._fingerprints = cache.FingerprintCache(":memory:")
+            return self._fingerprints
+
+    def set_fingerprints(self, fingerprints):
+        with self._pluginLock:
+            self._fingerprints = fingerprints
+
+    fingerprints = property(get_fingerprints, set_fingerprints)
+
+    def get_libraryIndex(self):
+        ''' Returns the index of the folders walked by LibraryWalker, None if there is no
+        XDG cache folder or if the cache cannot be opened '''
+        with self._pluginLock:
+            if not self._libraryIndex and not self._cacheBroken and is_local:
+                try:
+                    self._libraryIndex = cache.LibraryIndex(self.cachePath())
+                except Exception, e:
+                    log.warning("Could not open the cache %s: %s" % (self.cachePath(), e))
+                    self._cacheBroken = True
+            return self._libraryIndex
+
+    def set_libraryIndex(self, index):
+        with self._pluginLock:
+            self._libraryIndex = index
+
+    libraryIndex = property(get_libraryIndex, set_libraryIndex)
+
+    def filterRetries(self, filenames, langs=None):
+        ''' Returns the filenames that are worth searching: those which were never missed,
+        or whose last search is older than their backoff delay '''
+        return list(self.iterRetries(filenames, langs))
+
+    def iterRetries(self, filenames, langs=None):
+        ''' Same as filterRetries, for a stream of filenames '''
+        for filename in filenames:
+            if not self.history or self.history.shouldSearch(os.path.abspath(filename), langs):
+                yield filename
+            else:
+                log.info("Skipping %s, nothing was found for it recently. Use --retry-all to search it anyway" % filename)
+
+    def groupBySeason(self, filenames):
+        ''' Returns the filenames with the episodes of a same season next to each other, so
+        that they are searched together and the plugins fetch each season page once. The
+        groups, and the other files, keep the order in which they are first seen. '''
+        groups = OrderedDict()
+        for filename in filenames:
+            try:
+                fileData = self.guessFileData(filename)
+            except Exception, e:
+                # Names guessFileData cannot read, like non-ASCII ones, are left on their own
+                log.debug("Could not parse %s: %s" % (filename, e))
+                fileData = { 'type' : 'unknown' }
+            if fileData['type'] == 'tvshow':
+                key = (fileData['name'], fileData['season'])
+            else:
+                key = filename
+            groups.setdefault(key, []).append(filename)
+        return [ filename for group in groups.values() for filename in group ]
+
+    def recordSearch(self, filename, langs, subtitle):
+        ''' Updates the history of filename with the outcome of downloadSubtitle. A file is
+        only recorded as missed if every plugin answered: when one failed or timed out, as
+        without network, it is searched again on the next run. '''
+        with self._pluginLock:
+            answered = filename not in self._unanswered
+            self._unanswered.discard(filename)
+        history = self.history
+        if not history:
+            return
+        try:
+            if subtitle:
+                history.recordFound(os.path.abspath(filename), langs)
+            elif answered:
+                history.recordMiss(os.path.abspath(filename), langs, self.pluginNames)
+            else:
+                log.info("Not every plugin could search %s, not recording it as missed" % filename)
+        except Exception, e:
+            log.warning("Could not record the search of %s in the cache: %s" % (filename, e))
+
+    def shutdown(self):
+        ''' Stops the worker pool and closes the caches. The plugin instances are dropped
+        and the plugins which were used are closed. '''
+        with self._pluginLock:
+            pool, self._pool = self._pool, None
+            resultCache, self._cache = self._cache, None
+            history, self._history = self._history, None
+            fingerprints, self._fingerprints = self._fingerprints, None
+            libraryIndex, self._libraryIndex = self._libraryIndex, None
+            usedPlugins, self._pluginInstances = self._pluginInstances.keys(), {}
+            self._batches = {}
+        if pool:
+            pool.shutdown()
+        for name in usedPlugins:
+            try:
+                getattr(plugins, name).close()
+            except Exception, e:
+                log.warning("Could not close plugin %s: %s" % (name, e))
+        if resultCache:
+            resultCache.close()
+        if history:
+            history.close()
+        if fingerprints:
+            fingerprints.close()
+        if libraryIndex:
+            libraryIndex.close()
+        plugins.Transport.close()
+
+    def acquirePlugin(self, name):
+        ''' Returns an idle instance of the plugin, creating one if all of them are busy.
+        The pool never runs more than max_workers_per_plugin tasks of a plugin so the
+        number of instances stays bounded. Asynchronous plugins have a single instance
+        shared by all the searches. The instances share the fingerprint cache. '''
+        pluginClass = getattr(plugins, name)
+        fingerprints = self.fingerprints
+        with self._pluginLock:
+            idle = self._pluginInstances.setdefault(name, [])
+            if idle:
+                return pluginClass.isAsync and idle[0] or idle.pop()
+            log.debug("Creating a new instance of plugin %s" % name)
+            plugin = pluginClass()
+            plugin.fingerprints = fingerprints
+            if pluginClass.isAsync:
+                idle.append(plugin)
+            return plugin
+
+    def releasePlugin(self, name, plugin):
+        ''' Gives back a plugin instance obtained through acquirePlugin '''
+        if plugin.isAsync:
+            return
+        with self._pluginLock:
+            self._pluginInstances.setdefault(name, []).append(plugin)
+
+    def cacheKey(self, filename, fingerprint=None):
+        ''' Identifies the video of filename in the result cache: the normalized guess of
+        its show, season, episode and release (or movie, year and part), plus the hash of
+        the file when it exists so that two different copies do not share their results '''
+        guess = self.guessFileData(filename)
+        fields = [guess["type"], guess["name"]]
+        if guess["type"] == "tvshow":
+            fields += [guess["season"], guess["episode"]]
+        elif guess["type"] == "movie":
+            fields += [guess["year"], guess["part"] or ""]
+        fields.append(".".join(sorted([ team for team in guess["teams"] if team ])))
+        if fingerprint:
+            fields.append(fingerprint.get("thesubdb") or fingerprint.size)
+        return "|".join([ unicode(field) for field in fields ])
+
+    def _cachedResults(self, name, filename, langs, video):
+        ''' Returns a done future holding the cached results of the plugin, None if they
+        are not in the cache '''
+        subs = self.cache.get(name, video, langs)
+        if subs is None:
+            return None
+        log.info("Using the cached results of %s" % name)
+        plugin = self.acquirePlugin(name)
+        for sub in subs:
+            sub["plugin"] = plugin
+            sub["filename"] = filename
+        self.releasePlugin(name, plugin)
+        future = workerpool.Future(name)
+        future.setResult(subs)
+        return future
+
+    def _unanswer(self, filename):
+        ''' Records that a plugin did not answer for filename, see recordSearch '''
+        with self._pluginLock:
+            self._unanswered.add(filename)
+
+    def _cacheResults(self, name, filename, video, langs, subs, deadline):
+        ''' Stores the results of a search, unless a request failed during it or the search
+        was cancelled or timed out: an empty answer then does not mean that there is
+        nothing to find, and the file is not recorded as missed either '''
+        if deadline.failures or deadline.expired():
+            self._unanswer(filename)
+        elif video:
+            try:
+                self.cache.put(name, video, langs, subs)
+            except Exception, e:
+                log.warning("Could not store the results of %s in the cache: %s" % (name, e))
+
+    def _searchWithPlugin(self, name, filename, langs, cancel=None, video=None):
+        try:
+            plugin = self.acquirePlugin(name)
+        except Exception, e:
+            log.error("Error while importing plugin %s: %s" % (name, e))
+            return []
+        try:
+            log.info("Searching on %s " % name)
+            with plugins.Transport.deadline(self.pluginTimeout, cancel) as deadline:
+                subs = plugin.search(filename, langs)
+            self._cacheResults(name, filename, video, langs, subs, deadline)
+            return subs
+        finally:
+            self.releasePlugin(name, plugin)
+
+    def _asearchWithPlugin(self, name, filename, langs, cancel=None, video=None):
+        future = workerpool.Future(name)
+        try:
+            plugin = self.acquirePlugin(name)
+        except Exception, e:
+            log.error("Error while importing plugin %s: %s" % (name, e))
+            future.setResult([])
+            return future
+        log.info("Searching on %s " % name)
+        with plugins.Transport.deadline(self.pluginTimeout, cancel) as deadline:
+            def finish(subs):
+                try:
+                    self._cacheResults(name, filename, video, langs, subs, deadline)
+                finally:
+                    future.setResult(subs)
+            def done(subs):
+                # Called from the HTTP event loop, which must not wait for the cache nor
+                # for the work chained to the future
+                try:
+                    self.pool.submit(None, finish, subs)
+                except RuntimeError:
+                    future.setResult(subs) # The pool was shut down
+            plugin.asearch(filename, langs, done)
+        return future
+
+    def _searchBatchWithPlugin(self, name, filenames, langs):
+        ''' Searches the files at once with the plugin, except those whose results are in
+        the cache. Returns { filename : subs } for the files the plugin searched. '''
+        try:
+            plugin = self.acquirePlugin(name)
+        except Exception, e:
+            log.error("Error while importing plugin %s: %s" % (name, e))
+            return {}
+        try:
+            videos = dict([ (filename, self.identify(filename)) for filename in filenames ])
+            wanted = [ filename for filename in filenames
+                       if not (videos[filename] and self.cache.get(name, videos[filename], langs) is not None) ]
+            if not wanted:
+                return {}
+            log.info("Searching %d files at once on %s" % (len(wanted), name))
+            with plugins.Transport.deadline(self.pluginTimeout) as deadline:
+                results = plugin.searchBatch(wanted, langs)
+            for filename, subs in results.items():
+                self._cacheResults(name, filename, videos.get(filename), langs, subs, deadline)
+            return results
+        finally:
+            self.releasePlugin(name, plugin)
+
+    def _batchedSearch(self, name, filename, langs, cancel, video, batch):
+        ''' Returns a future for the results of filename in a batch search, which searches
+        the file alone if the batch did not '''
+        future = workerpool.Future(name)
+        def searched(task):
+            future.setResult(task.result or [])
+        def done(task):
+            results = task.result or {}
+            if filename in results:
+                future.setResult(results[filename])
+                return
+            try:
+                self.pool.submit(name, self._searchWithPlugin, name, filename, langs, cancel, video).addCallback(searched)
+            except RuntimeError:
+                future.setResult([]) # The pool was shut down
+        batch.addCallback(done)
+        return future
+
+    def submitBatches(self, filenames, langs=None):
+        ''' Yields the filenames after scheduling their search, by chunks, on the plugins
+        which can search several files at once. submitSearch then waits for the result of
+        the batch instead of searching a file alone. '''
+        names = [ name for name in self.pluginNames if getattr(getattr(plugins, name, None), 'batchSize', 0) ]
+        if not names:
+            for filename in filenames:
+                yield filename
+            return
+        filenames = iter(filenames)
+        chunkSize = max([ getattr(plugins, name).batchSize for name in names ])
+        while True:
+            chunk = list(itertools.islice(filenames, chunkSize))
+            if not chunk:
+                return
+            if len(chunk) > 1:
+                for name in names:
+                    batchSize = getattr(plugins, name).batchSize
+                    for i in range(0, len(chunk), batchSize):
+                        files = chunk[i:i + batchSize]
+                        task = self.pool.submit(name, self._searchBatchWithPlugin, name, files, langs)
+                        with self._pluginLock:
+                            for filename in files:
+                                self._batches[(name, filename)] = task
+            for filename in chunk:
+                yield filename
+
+    def identify(self, filename):
+        ''' Returns the key of the video in the result cache, None without cache. The file
+        is read once here to compute its VideoFingerprint, which the plugins get from the
+        fingerprint cache. '''
+        fingerprint = None
+        if os.path.isfile(filename):
+            try:
+                fingerprint = self.fingerprints.fingerprint(filename)
+            except Exception, e:
+                log.warning("Could not compute the fingerprint of %s: %s" % (filename, e))
+        if self.cache:
+            try:
+                return self.cacheKey(filename, fingerprint)
+            except Exception, e:
+                log.warning("Could not identify %s for the cache: %s" % (filename, e))
+        return None
+
+    def submitSearch(self, filename, langs=None, cancel=None):
+        ''' Schedules the search of filename on every active plugin and returns one future
+        per plugin. Results found in the cache are returned as done futures, files in a
+        batch search wait for it, asynchronous plugins run on the shared HTTP event loop,
+        the others on the worker pool. Cancelling the cancel Deadline aborts their requests.
+        The name of the file is parsed at most once into the VideoInfo the plugins share. '''
+        video = self.identify(filename)
+        tasks = []
+        for name in self.pluginNames:
+            if not hasattr(plugins, name):
+                log.error("Plugin %s is not a valid plugin name. Skipping it." % name)
+                continue
+            with self._pluginLock:
+                batch = self._batches.pop((name, filename), None)
+            cached = video and self._cachedResults(name, filename, langs, video)
+            if cached:
+                tasks.append(cached)
+            elif batch:
+                tasks.append(self._batchedSearch(name, filename, langs, cancel, video, batch))
+            elif getattr(plugins, name).isAsync:
+                tasks.append(self._asearchWithPlugin(name, filename, langs, cancel, video))
+            else:
+                tasks.append(self.pool.submit(name, self._searchWithPlugin, name, filename, langs, cancel, video))
+        return tasks
+
     def listSubtitles(self, filename, langs=None):
         '''Searches subtitles within the active plugins and returns all found matching subtitles ordered by language then by plugin.'''
         #if not os.path.isfile(filename):
             #raise InvalidFileException(filename, "does not exist")
 
+        search = self.alistSubtitles(filename, langs)
+
+        # Wait till every plugin has a result, a good enough subtitle arrived or the search
+        # times out. The plugins give up by themselves after plugin_timeout.
+        if not search.wait(self.searchTimeout):
+            log.warning("Plugins %s did not answer in time, skipping them" % ", ".join(search.pendingPlugins()))
+            search.stop()
+            search.wait()
+        return search.result
+
+    def alistSubtitles(self, filename, langs=None):
+        ''' Asynchronous listSubtitles: returns at once a SubtitleSearch, the Future whose
+        result will be the found subtitles '''
         log.info("Searching subtitles for %s with langs %s" %(filename, langs))
-        subtitles = []
-        q = Queue()
-        startedPlugins = []
-        for name in self.pluginNames:
-            try :
-                plugin = getattr(plugins, name)()
-                log.info("Searching on %s " %plugin.__class__.__name__)
-                thread = threading.Thread(target=plugin.searchInThread, args=(q, filename, langs))
-                thread.start()
-                startedPlugins.append(name)
-            except ImportError:
-                log.error("Plugin %s is not a valid plugin name. Skipping it." % name)
-            except Exception, e:
-                log.error("Error while importing plugin %s: %s" % (name, e))
+        return SubtitleSearch(self, filename, langs, self.earlyExit)
+
+    def adownloadSubtitle(self, filename, langs=None, batcher=None):
+        ''' Asynchronous downloadSubtitle: returns at once a Future whose result will be the
+        downloaded subtitle, or None. The downloads on plugins which can fetch several
+        subtitles at once go through the DownloadBatcher if one is given. '''
+        future = workerpool.Future()
+        def searched(search):
+            if search.result:
+                self._attemptDownload(search.result, langs, future, batcher)
+            else:
+                future.setResult(None)
+        self.alistSubtitles(filename, langs).addCallback(searched)
+        return future
+
+    def _attemptDownload(self, subtitles, langs, future, batcher=None):
+        ''' Downloads the best subtitle, through the batcher or acreateFile for the plugins
+        supporting them and on the worker pool for the others, then sets it as result of future '''
+        subtitle = self.selectBestSubtitle(subtitles, langs)
+        if batcher and subtitle and subtitle["plugin"].downloadBatchSize:
+            batcher.add(subtitle, subtitles, langs, future)
+            return
+        if not subtitle or not subtitle["plugin"].isAsync:
+            task = self.pool.submit(None, self.attemptDownloadSubtitle, subtitles, langs)
+            task.addCallback(lambda task: future.setResult(task.result))
+            return
+
+        def created(subpath):
+            if subpath:
+                subtitle["subtitlepath"] = subpath
+                future.setResult(subtitle)
+            else:
+                log.warn("Subtitle %s could not be downloaded, trying the next on the list" %subtitle['link'])
+                subtitles.remove(subtitle)
+                self._attemptDownload(subtitles, langs, future)
 
-        # Get data from the queue and wait till we have a result
-        for name in startedPlugins:
-            subs = q.get(True)
+        log.info("Trying to download subtitle: %s" %subtitle['link'])
+        try:
+            subtitle["plugin"].acreateFile(subtitle, created)
+        except Exception, e:
+            log.error(e)
+            created(None)
+
+    def _createFilesWithPlugin(self, name, items):
+        ''' Downloads a batch of the DownloadBatcher. The files whose subtitle could not be
+        downloaded try the next subtitles on their list one by one. '''
+        subs = [ item[0] for item in items ]
+        log.info("Downloading %d subtitles at once from %s" % (len(subs), name))
+        plugin = subs[0]["plugin"]
+        try:
+            with plugins.Transport.deadline(self.pluginTimeout):
+                paths = plugin.createFiles(subs)
+        except Exception, e:
+            log.error("Could not download the subtitles from %s: %s" % (name, e))
+            paths = [ None ] * len(subs)
+        for (subtitle, subtitles, langs, future), subpath in zip(items, paths):
+            if subpath:
+                subtitle["subtitlepath"] = subpath
+                future.setResult(subtitle)
+                continue
+            log.warn("Subtitle %s could not be downloaded, trying the next on the list" %subtitle['link'])
+            subtitles.remove(subtitle)
+            future.setResult(self.attemptDownloadSubtitle(subtitles, langs))
+
+    def scoreSubtitle(self, subtitle):
+        ''' Returns 2 for a subtitle found from the hash of the file, 1 if its release is
+        the name of the file, else 0 '''
+        if subtitle.get("hashMatch"):
+            return 2
+        release = subtitle.get("release")
+        if release and "filename" in subtitle and "plugin" in subtitle:
+            if release.lower() == subtitle["plugin"].getFileName(os.path.basename(subtitle["filename"])).lower():
+                return 1
+        return 0
+
+    def collectSubtitles(self, tasks, langs=None):
+        ''' Merges the results of finished search tasks, keeping only the wanted languages.
+        The best scored subtitles come first, then they are ordered by plugin. '''
+        subtitles = []
+        for task in tasks:
+            subs = task.result
             if subs and len(subs) > 0:
                 if not langs:
                     subtitles += subs
@@ -156,11 +768,40 @@ class Periscope:
                     for sub in subs:
                         if sub["lang"] in langs:
                             subtitles += [sub] # Add an array with just that sub
-
-        if len(subtitles) == 0:
-            return []
+        subtitles.sort(key=self.scoreSubtitle, reverse=True)
         return subtitles
 
+    def downloadSubtitles(self, filenames, langs=None, window=None):
+        ''' Takes an iterable of filenames and creates ONE subtitle for each of them. Files
+        are searched on every plugin then downloaded, with up to window files in flight.
+        Yields (filename, subtitle) as soon as a file is done, subtitle being None when
+        nothing could be downloaded. The plugins which can search several files at once
+        get them by chunks, see submitBatches. '''
+        if not window:
+            window = 2 * self.pool.maxWorkers
+        done = Queue()
+        filenames = self.submitBatches(filenames, langs)
+        batcher = DownloadBatcher(self)
+        inflight = 0
+        while True:
+            while inflight < window:
+                try:
+                    filename = filenames.next()
+                except StopIteration:
+                    break
+                batcher.started()
+                self._startBatchSearch(filename, langs, done, batcher)
+                inflight += 1
+            if not inflight:
+                return
+            filename, subtitle = done.get(True)
+            inflight -= 1
+            batcher.finished()
+            yield filename, subtitle
+
+    def _startBatchSearch(self, filename, langs, done, batcher=None):
+        self.adownloadSubtitle(filename, langs, batcher).addCallback(lambda download: done.put((filename, download.result)))
+
 
     def selectBestSubtitle(self, subtitles, langs=None):
         '''Searches subtitles from plugins and returns the best subtitles from all candidates'''
@@ -235,8 +876,7 @@ class Periscope:
             return None
 
     def guessFileData(self, filename):
-        subdb = plugins.SubtitleDatabase.SubtitleDB(None)
-        return subdb.guessFileData(filename)
+        return plugins.VideoInfo.videoInfo(filename).fileData
 
     def __orderSubtitles__(self, subs):
         '''reorders the subtitles according to the languages then the website'''
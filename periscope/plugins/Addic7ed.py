@@ -18,12 +18,15 @@
 
 import zipfile, os, urllib2, urllib, logging, traceback, httplib, re, socket
 from BeautifulSoup import BeautifulSoup
-import guessit
 
 import SubtitleDatabase
+import PageCache
 
 log = logging.getLogger(__name__)
 
+# Parsed episode pages, shared by every release and language of an episode
+episodePages = PageCache.PageCache(ttl=3600)
+
 LANGUAGES = {u"English" : "en",
 			 u"English (US)" : "en",
 			 u"English (UK)" : "en",
@@ -68,7 +71,7 @@ class Addic7ed(SubtitleDatabase.SubtitleDB):
 	def process(self, filepath, langs):
 		''' main method to call on the plugin, pass the filename and the wished
 		languages and it will query the subtitles source '''
-                guessedData = guessit.guess_video_info(filepath)
+                guessedData = self.videoInfo(filepath).guess
                 if guessedData['type'] == 'episode':
                         team = [ guessedData['releaseGroup'].lower() ] if 'releaseGroup' in guessedData else []
                         return self.query(guessedData['series'], guessedData['season'], guessedData['episodeNumber'], team, langs)
@@ -81,56 +84,63 @@ class Addic7ed(SubtitleDatabase.SubtitleDB):
 		sublinks = []
 		name = name.lower().replace(" ", "_")
 		searchurl = "%s/serie/%s/%s/%s/%s" %(self.host, name, season, episode, name)
-                log.debug("dl'ing %s" % searchurl)
-                content = self.downloadText(searchurl, timeout = 5)
-                if not content:
-                        return sublinks
-
+		try:
+			rows = episodePages.get(searchurl, lambda: self.parseEpisodePage(searchurl))
+		except IOError, e:
+			log.debug(e)
+			return sublinks
+
+		# Addic7ed only takes the real team into account
+		fteams = []
+		for team in teams:
+			fteams += team.split("-")
+		teams = set(fteams)
+
+		for subteams, lang, status, link in rows:
+			subteams = self.listTeams([subteams], [".", "_", " "])
+			log.debug("[Addic7ed] Team from website: %s - from file: %s - match = %s" % (subteams, teams, subteams.issubset(teams)))
+			log.debug("%s - match : %s - lang : %s" %(status == "Completed", subteams.issubset(teams), (not langs or lang in langs)))
+			if status == "Completed" and subteams.issubset(teams) and (not langs or lang in langs) :
+				result = {}
+				result["release"] = "%s.S%.2dE%.2d.%s" %(name.replace("_", ".").title(), int(season), int(episode), '.'.join(subteams))
+				result["lang"] = lang
+				result["link"] = link
+				result["page"] = searchurl
+				result["forceType"] = "srt"
+				sublinks.append(result)
+		return sublinks
 
-                # HTML bug in addic7ed that prevents BeautifulSoup 3.1 from correctly parsing the html
-                # BeautifulSoup 3.2 doesn't have this problem, though
-                content = re.sub(r'"true"/ onclick="saveWatched(\([0-9,]*\));" >',
-                                 r'"true" onclick="saveWatched\1;" />',
-                                 content)
+	def parseEpisodePage(self, searchurl):
+		''' Downloads the page of an episode and returns its subtitles as (teams, lang, status,
+		link) tuples, which are kept in episodePages for the other releases and languages of
+		the episode. Raises IOError if the page could not be downloaded. '''
+		log.debug("dl'ing %s" % searchurl)
+		content = self.downloadText(searchurl, timeout = 5)
+		if not content:
+			raise IOError("Could not download %s" % searchurl)
+
+		# HTML bug in addic7ed that prevents BeautifulSoup 3.1 from correctly parsing the html
+		# BeautifulSoup 3.2 doesn't have this problem, though
+		content = re.sub(r'"true"/ onclick="saveWatched(\([0-9,]*\));" >',
+		                 r'"true" onclick="saveWatched\1;" />',
+		                 content)
 
 		soup = BeautifulSoup(content)
-                log.debug('Found %d potential subs' % len(soup("td", {"class":"NewsTitle", "colspan" : "3"})))
+		rows = []
 		for subs in soup("td", {"class":"NewsTitle", "colspan" : "3"}):
-			if not self.release_pattern.match(str(subs.contents[1])):
+			release = self.release_pattern.match(str(subs.contents[1]))
+			if not release:
 				continue
-
-			subteams = self.release_pattern.match(str(subs.contents[1])).groups()[0].lower()
-
-			# Addic7ed only takes the real team into account
-			fteams = []
-			for team in teams:
-				fteams += team.split("-")
-			teams = set(fteams)
-			subteams = self.listTeams([subteams], [".", "_", " "])
-
-			log.debug("[Addic7ed] Team from website: %s - from file: %s - match = %s" % (subteams, teams, subteams.issubset(teams)))
 			langs_html = subs.findNext("td", {"class" : "language"})
 			lang = self.getLG(langs_html.contents[0].strip().replace('&nbsp;', ''))
-			#log.debug("[Addic7ed] Language : %s - lang : %s" %(langs_html, lang))
-
 			statusTD = langs_html.findNext("td")
 			status = statusTD.find("b").string.strip()
-
 			# take the last one (most updated if it exists)
 			links = statusTD.findNext("td").findAll("a")
 			link = "%s%s"%(self.host,links[len(links)-1]["href"])
-
-			log.debug("%s - match : %s - lang : %s" %(status == "Completed", subteams.issubset(teams), (not langs or lang in langs)))
-			if status == "Completed" and subteams.issubset(teams) and (not langs or lang in langs) :
-				result = {}
-				result["release"] = "%s.S%.2dE%.2d.%s" %(name.replace("_", ".").title(), int(season), int(episode), '.'.join(subteams)
-)
-				result["lang"] = lang
-				result["link"] = link
-				result["page"] = searchurl
-                                result["forceType"] = "srt"
-				sublinks.append(result)
-		return sublinks
+			rows.append((release.groups()[0].lower(), lang, unicode(status), link))
+		log.debug('Found %d potential subs' % len(rows))
+		return tuple(rows)
 
 	def listTeams(self, subteams, separators):
 		teams = []
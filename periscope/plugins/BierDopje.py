@@ -31,6 +31,8 @@ except ImportError:
     is_local = False
 
 import SubtitleDatabase
+import Transport
+import ShowIndex
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +49,9 @@ exceptions = {
     'hawaii five-0 2010' : 14211,
 }
 
+# The exceptions, then the shows learned from the site, see BierDopje.showids
+showIndex = ShowIndex.ShowIndex(exceptions.items())
+
 class BierDopje(SubtitleDatabase.SubtitleDB):
     url = "http://bierdopje.com/"
     site_name = "BierDopje"
@@ -67,6 +72,7 @@ class BierDopje(SubtitleDatabase.SubtitleDB):
         self.showids = pickle.load(f)
         f.close()
         log.debug("Cache of showids : %s" % self.showids)
+        showIndex.update(self.showids.items())
 
     def process(self, filepath, langs):
         ''' main method to call on the plugin, pass the filename and the wished
@@ -86,12 +92,10 @@ class BierDopje(SubtitleDatabase.SubtitleDB):
             traceback.print_exc()
             return []
 
-    def createFile(self, subtitle):
-        '''get the URL of the sub, download it and return the path to the created file'''
-        sublink = subtitle["link"]
-        subpath = self.findSrtFilename(subtitle["filename"])
-        self.downloadFile(sublink, subpath)
-        return subpath
+    def downloadContents(self, subtitle):
+        '''get the URL of the sub and download it'''
+        text = self.downloadText(subtitle["link"])
+        return text and [ ("srt", text) ] or []
 
     def query(self, token, langs=None):
         ''' makes a query and returns info (link, lang) about found subtitles'''
@@ -111,20 +115,18 @@ class BierDopje(SubtitleDatabase.SubtitleDB):
 
         # Query the show to get the show id
         showName = guessedData['name'].lower()
-        if exceptions.has_key(showName):
-            show_id = exceptions.get(showName)
-        elif self.showids.has_key(showName):
-            show_id = self.showids.get(showName)
-        else :
+        show_id = showIndex.lookup(showName)
+        if not show_id:
             getShowId_url = "%sGetShowByName/%s" %(self.api, urllib.quote(showName))
             log.debug("Looking for show Id @ %s" % getShowId_url)
-            page = urllib2.urlopen(getShowId_url)
+            page = Transport.urlopen(getShowId_url)
             dom = minidom.parse(page)
             if not dom or len(dom.getElementsByTagName('showid')) == 0 :
                 page.close()
                 return []
             show_id = dom.getElementsByTagName('showid')[0].firstChild.data
             self.showids[showName] = show_id
+            showIndex.add(showName, show_id)
             f = open(self.showid_cache, 'w')
             pickle.dump(self.showids, f)
             f.close()
@@ -134,7 +136,7 @@ class BierDopje(SubtitleDatabase.SubtitleDB):
         for lang in availableLangs :
             getAllSubs_url = "%sGetAllSubsFor/%s/%s/%s/%s" %(self.api, show_id, guessedData['season'], guessedData['episode'], lang)
             log.debug("Looking for subs @ %s" %getAllSubs_url)
-            page = urllib2.urlopen(getAllSubs_url)
+            page = Transport.urlopen(getAllSubs_url)
             dom = minidom.parse(page)
             page.close()
             for sub in dom.getElementsByTagName('result'):
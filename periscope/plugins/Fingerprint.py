@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import struct
+import hashlib
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536 # Every hash is computed from the first and last 64 KiB of the file
+MASK = 0xFFFFFFFFFFFFFFFF
+_chunkStruct = struct.Struct('<%dq' % (CHUNK_SIZE / 8))
+
+def _sumLongsStruct(data):
+    count = len(data) / 8
+    if count == CHUNK_SIZE / 8:
+        values = _chunkStruct.unpack(data)
+    else:
+        values = struct.unpack('<%dq' % count, data[:count * 8])
+    return sum(values) & MASK
+
+def _sumLongsNumpy(data):
+    # uint64 additions wrap around, which gives the sum modulo 2**64 directly
+    return long(numpy.frombuffer(data, dtype='<u8', count=len(data) / 8).sum(dtype=numpy.uint64))
+
+def sumLongs(data):
+    ''' Returns the sum of the little-endian 64 bits integers of data, modulo 2**64.
+    The trailing bytes which do not make a whole integer are ignored. '''
+    if numpy is not None:
+        return _sumLongsNumpy(data)
+    return _sumLongsStruct(data)
+
+def openSubtitlesHash(size, head, tail):
+    ''' The hash à-la Media Player Classic used by OpenSubtitles and Podnapisi '''
+    return "%016x" % ((size + sumLongs(head) + sumLongs(tail)) & MASK)
+
+def theSubDBHash(head, tail):
+    ''' The MD5 of the first and last 64 KiB used by TheSubDB '''
+    return hashlib.md5(head + tail).hexdigest()
+
+
+class VideoFingerprint(object):
+    ''' The hashes of a video file for every plugin, computed from a single read of
+    its first and last 64 KiB. The hash of a flavour is None if the file is too small
+    for it. '''
+
+    FLAVOURS = ("opensubtitles", "thesubdb", "podnapisi")
+
+    def __init__(self, path, size, hashes):
+        self.path = path
+        self.size = size
+        self.hashes = hashes
+
+    def __repr__(self):
+        return "<VideoFingerprint %s %s>" % (self.path, self.hashes)
+
+    def get(self, flavour):
+        return self.hashes.get(flavour)
+
+    @classmethod
+    def fromData(cls, path, size, head, tail):
+        ''' Computes the fingerprint from the first and last CHUNK_SIZE bytes of the file,
+        tail being the CHUNK_SIZE bytes starting at max(0, size - CHUNK_SIZE) '''
+        hashes = dict.fromkeys(cls.FLAVOURS)
+        if size >= CHUNK_SIZE:
+            hashes["thesubdb"] = theSubDBHash(head, tail)
+            hashes["podnapisi"] = openSubtitlesHash(size, head, tail)
+        if size >= CHUNK_SIZE * 2:
+            hashes["opensubtitles"] = hashes["podnapisi"]
+        return cls(path, size, hashes)
+
+    @classmethod
+    def fromFile(cls, path):
+        ''' Reads the head and the tail of the file once and computes every hash '''
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            head = f.read(CHUNK_SIZE)
+            if size > CHUNK_SIZE:
+                f.seek(max(0, size - CHUNK_SIZE))
+                tail = f.read(CHUNK_SIZE)
+            else:
+                tail = head
+        if size < CHUNK_SIZE * 2:
+            log.debug("File %s is too small for some of the hashes (%d bytes)" % (path, size))
+        return cls.fromData(path, size, head, tail)
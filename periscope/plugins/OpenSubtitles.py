@@ -16,13 +16,23 @@
 #    along with periscope; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import os, struct, xmlrpclib, commands, gzip, traceback, logging
-import socket # For timeout purposes
+import os, struct, xmlrpclib, commands, gzip, traceback, logging, threading, time, base64, zlib
 
 import SubtitleDatabase
+import Transport
+import Fingerprint
 
 log = logging.getLogger(__name__)
 
+SERVER_URL = 'http://api.opensubtitles.org/xml-rpc'
+TOKEN_TTL = 15 * 60 # OpenSubtitles forgets the tokens which are not used for 15 minutes
+KEEPALIVE = 10 * 60 # Idle tokens are checked with NoOperation before being used again
+REFUSED_TOKEN = ('401', '406') # Statuses of a refused token: 406 No session once it expired
+SEARCH_BATCH_SIZE = 20 # Searches sent in one SearchSubtitles call
+SEARCH_ROW_LIMIT = 500 # Rows returned by SearchSubtitles at most, the others are dropped
+DOWNLOAD_BATCH_SIZE = 20 # Subtitles fetched in one DownloadSubtitles call
+GZIP_THRESHOLD = 1024 # Larger requests, such as batched searches, are gzipped
+
 OS_LANGS ={ "en": "eng",
             "fr" : "fre",
             "hu": "hun",
@@ -76,20 +86,101 @@ OS_LANGS ={ "en": "eng",
             "uk":"ukr",
             "vi":"vie"}
 
+class Session(object):
+    ''' A login on OpenSubtitles shared by all the queries: it logs in when a token is
+    first needed, checks a token which was idle for a while with NoOperation, logs in
+    again when the token expired, and logs out only when closed. Each thread talks to
+    the server through its own connection. '''
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self.token = None
+        self.lastUse = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def server(self):
+        ''' Returns the ServerProxy of the calling thread '''
+        server = getattr(self.local, 'server', None)
+        if server is None:
+            server = self.local.server = Transport.xmlrpcServer(self.url, timeout=self.timeout, gzipThreshold=GZIP_THRESHOLD)
+        return server
+
+    def getToken(self):
+        ''' Returns a valid token, logging in if needed. Raises an exception if the
+        login failed. '''
+        with self.lock:
+            now = time.time()
+            if self.token and now - self.lastUse > TOKEN_TTL:
+                self.token = None
+            elif self.token and now - self.lastUse > KEEPALIVE:
+                try:
+                    status = self.server().NoOperation(self.token).get('status', '')
+                except Exception, e:
+                    status = str(e)
+                if not status.startswith('200'):
+                    log.debug("OpenSubtitles token expired: %s" % status)
+                    self.token = None
+            if not self.token:
+                log_result = self.server().LogIn("","","eng","periscope")
+                log.debug(log_result)
+                if not log_result.get("token"):
+                    raise Exception("Open subtitles did not return a token after logging in: %s" % log_result.get('status'))
+                self.token = log_result["token"]
+            self.lastUse = now
+            return self.token
+
+    def invalidate(self, token):
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+    def call(self, method, *args):
+        ''' Calls the XML-RPC method with a token and args, logging in again once if
+        the server refused the token or forgot it '''
+        token = self.getToken()
+        result = getattr(self.server(), method)(token, *args)
+        if str(result.get('status', '')).startswith(REFUSED_TOKEN):
+            log.debug("OpenSubtitles refused token %s, logging in again" % token)
+            self.invalidate(token)
+            result = getattr(self.server(), method)(self.getToken(), *args)
+        return result
+
+    def logout(self):
+        with self.lock:
+            token, self.token = self.token, None
+            if not token:
+                return
+            try:
+                self.server().LogOut(token)
+            except Exception:
+                log.error("Open subtitles could not be contacted for logout")
+
+session = Session(SERVER_URL)
+
+
 class OpenSubtitles(SubtitleDatabase.SubtitleDB):
     url = "http://www.opensubtitles.org/"
     site_name = "OpenSubtitles"
+    batchSize = SEARCH_BATCH_SIZE
+    downloadBatchSize = DOWNLOAD_BATCH_SIZE
 
     def __init__(self):
         super(OpenSubtitles, self).__init__(OS_LANGS)
-        self.server_url = 'http://api.opensubtitles.org/xml-rpc'
+        self.server_url = SERVER_URL
+        self.session = session
         self.revertlangs = dict(map(lambda item: (item[1],item[0]), self.langs.items()))
 
+    @classmethod
+    def close(cls):
+        session.logout()
+
     def process(self, filepath, langs):
         ''' main method to call on the plugin, pass the filename and the wished
         languages and it will query OpenSubtitles.org '''
         if os.path.isfile(filepath):
-            filehash = self.hashFile(filepath)
+            filehash = self.fileHash("opensubtitles", filepath, self.hashFile)
             size = os.path.getsize(filepath)
             fname = self.getFileName(filepath)
             return self.query(moviehash=filehash, langs=langs, bytesize=size, filename=fname)
@@ -97,41 +188,76 @@ class OpenSubtitles(SubtitleDatabase.SubtitleDB):
             fname = self.getFileName(filepath)
             return self.query(langs=langs, filename=fname)
 
+    def processBatch(self, filepaths, langs):
+        ''' Searches the hashes of many files in one SearchSubtitles call and gives each
+        file the results of its hash. The files which cannot be hashed are left to process. '''
+        searches = {}
+        for filepath in filepaths:
+            if not os.path.isfile(filepath):
+                continue
+            filehash = self.fileHash("opensubtitles", filepath, self.hashFile)
+            if not filehash:
+                continue
+            search = { 'moviehash' : filehash, 'moviebytesize' : str(os.path.getsize(filepath)) }
+            if langs: search['sublanguageid'] = ",".join([self.getLanguage(lang) for lang in langs])
+            searches.setdefault(filehash, (search, []))[1].append(filepath)
+        if not searches:
+            return {}
+        log.debug("query: %d searches at once" % len(searches))
+        results = self.session.call('SearchSubtitles', [ search for search, files in searches.values() ])
+        if not str(results.get('status', '')).startswith('200'):
+            raise Exception("OpenSubtitles could not search: %s" % results.get('status'))
+        data = results.get('data') or []
+        if len(data) >= SEARCH_ROW_LIMIT:
+            # Some files may have lost rows, they are all searched one by one instead
+            log.debug("SearchSubtitles returned %d rows, the batch may be truncated" % len(data))
+            return {}
+        rows = {}
+        for r in data:
+            rows.setdefault(r.get('MovieHash', '').lower().zfill(16), []).append(r)
+        found = {}
+        for filehash, (search, files) in searches.items():
+            for filepath in files:
+                self.filename = self.getFileName(filepath)
+                found[filepath] = self.parse_results(rows.get(filehash, []), search)
+        return found
+
+    def createFiles(self, subtitles):
+        ''' Fetches the subtitles with one DownloadSubtitles call and writes them next to
+        their videos, the gzipped contents being decoded in memory '''
+        ids = [ subtitle["subfileid"] for subtitle in subtitles if subtitle.get("subfileid") ]
+        if not ids:
+            return [ None ] * len(subtitles)
+        log.debug("DownloadSubtitles: %s" % ids)
+        results = self.session.call('DownloadSubtitles', ids)
+        contents = dict([ (str(r['idsubtitlefile']), r['data']) for r in results.get('data') or [] ])
+        paths = []
+        for subtitle in subtitles:
+            data = contents.get(str(subtitle.get("subfileid")))
+            if not data:
+                paths.append(None)
+                continue
+            try:
+                text = zlib.decompress(base64.b64decode(data), 16 + zlib.MAX_WBITS)
+            except Exception, e:
+                log.warning("Could not decode subtitle %s: %s" % (subtitle["subfileid"], e))
+                paths.append(None)
+                continue
+            subfile = self.findSrtFilename(subtitle["filename"])
+            self.writeFile(subfile, text)
+            paths.append(subfile)
+        return paths
 
     def hashFile(self, name):
         '''
         Calculates the Hash à-la Media Player Classic as it is the hash used by OpenSubtitles.
         By the way, this is not a very robust hash code.
         '''
-
-        longlongformat = 'q'  # long long
-        bytesize = struct.calcsize(longlongformat)
-
-        f = open(name, "rb")
-        filesize = os.path.getsize(name)
-        hash = filesize
-
-        if filesize < 65536 * 2:
+        filehash = Fingerprint.VideoFingerprint.fromFile(name).get("opensubtitles")
+        if not filehash:
             log.error("File %s is too small (SizeError < 2**16)"%name)
             return []
-
-        for x in range(65536/bytesize):
-            buffer = f.read(bytesize)
-            (l_value,)= struct.unpack(longlongformat, buffer)
-            hash += l_value
-            hash = hash & 0xFFFFFFFFFFFFFFFF #to remain as 64bit number
-
-
-        f.seek(max(0,filesize-65536),0)
-        for x in range(65536/bytesize):
-            buffer = f.read(bytesize)
-            (l_value,)= struct.unpack(longlongformat, buffer)
-            hash += l_value
-            hash = hash & 0xFFFFFFFFFFFFFFFF
-
-        f.close()
-        returnedhash =  "%016x" % hash
-        return returnedhash
+        return filehash
 
     def query(self, filename, imdbID=None, moviehash=None, bytesize=None, langs=None):
         ''' Makes a query on opensubtitles and returns info about found subtitles.
@@ -151,57 +277,37 @@ class OpenSubtitles(SubtitleDatabase.SubtitleDB):
             search['query'] = guessed_data['name']
             log.debug(search['query'])
 
-        #Login
-        self.server = xmlrpclib.Server(self.server_url)
-        socket.setdefaulttimeout(10)
-        try:
-            log_result = self.server.LogIn("","","eng","periscope")
-            log.debug(log_result)
-            token = log_result["token"]
-        except Exception:
-            log.error("Open subtitles could not be contacted for login")
-            token = None
-            socket.setdefaulttimeout(None)
-            return []
-        if not token:
-            log.error("Open subtitles did not return a token after logging in.")
-            return []
-
-        # Search
+        # Search, the session logs in the first time
         self.filename = filename #Used to order the results
-        sublinks += self.get_results(token, search)
-
-        # Logout
-        try:
-            self.server.LogOut(token)
-        except:
-            log.error("Open subtitles could not be contacted for logout")
-        socket.setdefaulttimeout(None)
+        sublinks += self.get_results(search)
         return sublinks
 
 
-    def get_results(self, token, search):
-        log.debug("query: token='%s', search='%s'" % (token, search))
+    def get_results(self, search):
+        log.debug("query: search='%s'" % search)
         try:
-            if search:
-                results = self.server.SearchSubtitles(token, [search])
+            results = self.session.call('SearchSubtitles', [search])
         except Exception, e:
             log.error("Could not query the server OpenSubtitles")
             log.debug(e)
             return []
         log.debug("Result: %s" %str(results))
+        return self.parse_results(results['data'], search)
 
+    def parse_results(self, data, search):
         sublinks = []
-        if results['data']:
-            log.debug(results['data'])
+        if data:
+            log.debug(data)
             # OpenSubtitles hash function is not robust ... We'll use the MovieReleaseName to help us select the best candidate
-            for r in sorted(results['data'], self.sort_by_moviereleasename):
+            for r in sorted(data, self.sort_by_moviereleasename):
                 # Only added if the MovieReleaseName matches the file
                 result = {}
                 result["release"] = r['SubFileName']
                 result["link"] = r['SubDownloadLink']
                 result["page"] = r['SubDownloadLink']
                 result["lang"] = self.getLG(r['SubLanguageID'])
+                result["hashMatch"] = r.get('MatchedBy') == 'moviehash'
+                result["subfileid"] = r.get('IDSubtitleFile')
                 if search.has_key("query") : #We are using the guessed file name, let's remove some results
                     if r["MovieReleaseName"].startswith(self.filename):
                         sublinks.append(result)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+class _Flight(object):
+    ''' A computation of a value that other threads wait for '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class PageCache(object):
+    ''' An in-memory cache of what the plugins parse from the pages of their sites.
+    Values expire after ttl seconds and the least recently used ones are dropped beyond
+    maxEntries. When several threads want a missing value at the same time, only one
+    computes it and the others wait for its result. '''
+
+    def __init__(self, ttl=3600, maxEntries=256):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict() # key -> (expires, value)
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        ''' Returns the value of key, calling compute() if it is missing or expired.
+        Errors raised by compute are raised to every waiting thread but not cached. '''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > time.time():
+                self.entries[key] = entry
+                return entry[1]
+            flight = self.flights.get(key)
+            owner = flight is None
+            if owner:
+                flight = self.flights[key] = _Flight()
+        if not owner:
+            log.debug("Waiting for %s to be computed by another thread" % (key,))
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = compute()
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if flight.error is None:
+                    self.entries[key] = (time.time() + self.ttl, flight.value)
+                    while len(self.entries) > self.maxEntries:
+                        self.entries.popitem(last=False)
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
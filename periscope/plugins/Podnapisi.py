@@ -16,10 +16,11 @@
 #    along with periscope; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import zipfile, os, urllib2, urllib, traceback, logging, socket
+import zipfile, os, urllib2, urllib, traceback, logging
 from BeautifulSoup import BeautifulSoup
 
 import SubtitleDatabase
+import Transport
 
 log = logging.getLogger(__name__)
 
@@ -105,22 +106,20 @@ class Podnapisi(SubtitleDatabase.SubtitleDB):
 		log.debug(sublinks)
 		return sublinks
 
-	def createFile(self, subtitle):
-		'''pass the URL of the sub and the file it matches, will unzip it
-		and return the path to the created file'''
+	def downloadContents(self, subtitle):
+		'''find the URL of the sub on its page, download it and unzip it in memory'''
 		subpage = subtitle["page"]
 
 		# Parse the subpage and extract the link
 		log.debug('Downloading %s' % subpage)
 		try:
-			socket.setdefaulttimeout(10)
-			page = urllib2.urlopen(subpage)
+			page = Transport.urlopen(subpage, timeout=10)
 		except urllib2.HTTPError as inst:
 			log.info("Error : %s" %inst)
-			return None
+			return []
 		except urllib2.URLError as inst:
 			log.info("TimeOut : %s" %inst)
-			return None
+			return []
 		content = page.read()
 		# Workaround for the Beautifulsoup 3.1 bug or HTML bugs
 		content = content.replace("scr'+'ipt", "script")
@@ -130,4 +129,4 @@ class Podnapisi(SubtitleDatabase.SubtitleDB):
 		subtitle["link"] = self.host + dlimg.parent["href"]
                 subtitle["forceType"] = "zip"
 
-		return SubtitleDatabase.SubtitleDB.createFile(self, subtitle)
+		return SubtitleDatabase.SubtitleDB.downloadContents(self, subtitle)
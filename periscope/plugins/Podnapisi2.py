@@ -17,10 +17,12 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import zipfile, os, urllib2, urllib, traceback, logging
-import xmlrpclib, struct, socket
+import xmlrpclib, struct
 from hashlib import md5, sha256
 
 import SubtitleDatabase
+import Transport
+import Fingerprint
 
 log = logging.getLogger(__name__)
 
@@ -34,45 +36,18 @@ class Podnapisi(SubtitleDatabase.SubtitleDB):
         #Note: Podnapisi uses two reference for latin serbian and cyrillic serbian (36 and 47). We'll add the 36 manually as cyrillic seems to be more used
         self.revertlangs["36"] = "sr";
         self.server_url = 'http://ssp.podnapisi.net:8000'
+        self.server = None # Kept for the next queries of this instance, with its connection
 
     def hashFile(self, name):
         '''
         Calculates the Hash à-la Media Player Classic as it is the hash used by OpenSubtitles.
         By the way, this is not a very robust hash code.
         '''
-        longlongformat = '<LL'  # signed long, unsigned long
-        bytesize = struct.calcsize(longlongformat)
-        print "bytesize %s" %bytesize
-
-        f = open(name, "rb")
-        filesize = os.path.getsize(name)
-        hash = filesize
-        print hash
-
-        if filesize < 2**16:
+        filehash = Fingerprint.VideoFingerprint.fromFile(name).get("podnapisi")
+        if not filehash:
             log.error("File %s is too small (SizeError < 2**16)"%name)
             return []
-
-        for x in range(65536/bytesize):
-            buffer = f.read(bytesize)
-            (l2, l1)= struct.unpack(longlongformat, buffer)
-            l_value = (long(l1) << 32) | long(l2)
-            hash += l_value
-            hash = hash & 0xFFFFFFFFFFFFFFFF #to remain as 64bit number
-        print hash
-
-        f.seek(max(0,filesize-65536),0)
-        for x in range(65536/bytesize):
-            buffer = f.read(bytesize)
-            (l2, l1) = struct.unpack(longlongformat, buffer)
-            l_value = (long(l1) << 32) | long(l2)
-            hash += l_value
-            hash = hash & 0xFFFFFFFFFFFFFFFF
-        print hash
-
-        f.close()
-        returnedhash =  "%016x" % hash
-        return returnedhash
+        return filehash
 
 
 
@@ -80,7 +55,7 @@ class Podnapisi(SubtitleDatabase.SubtitleDB):
         ''' main method to call on the plugin, pass the filename and the wished
         languages and it will query the subtitles source '''
         if os.path.isfile(filepath):
-            filehash = self.hashFile(filepath)
+            filehash = self.fileHash("podnapisi", filepath, self.hashFile)
             size = os.path.getsize(filepath)
             fname = self.getFileName(filepath)
             return self.query(moviehash=filehash, langs=langs, bytesize=size, filename=fname)
@@ -92,8 +67,8 @@ class Podnapisi(SubtitleDatabase.SubtitleDB):
         ''' makes a query on podnapisi and returns info (link, lang) about found subtitles'''
 
         #Login
-        self.server = xmlrpclib.Server(self.server_url)
-        socket.setdefaulttimeout(1)
+        if not self.server:
+            self.server = Transport.xmlrpcServer(self.server_url, timeout=1, gzipThreshold=1024)
         try:
             log_result = self.server.initiate("Periscope")
             log.debug(log_result)
@@ -101,7 +76,6 @@ class Podnapisi(SubtitleDatabase.SubtitleDB):
             nonce = log_result["nonce"]
         except Exception, e:
             log.error("Podnapisi could not be contacted")
-            socket.setdefaulttimeout(None)
             return []
         log.debug("got token %s" %token)
         log.debug("got nonce %s" %nonce)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import re
+import pickle
+import logging
+import threading
+
+try:
+    import xdg.BaseDirectory as bd
+    is_local = True
+except ImportError:
+    is_local = False
+
+log = logging.getLogger(__name__)
+
+YEAR_REGEX = re.compile(r'\s*\(?\b(?:19|20)[0-9]{2}\)?$')
+PUNCTUATION_REGEX = re.compile(r"[^\w\s]", re.UNICODE)
+SPACES_REGEX = re.compile(r"\s+", re.UNICODE)
+
+def normalize(title):
+    ''' Returns the title in lower case, with "&" spelled "and" and without punctuation:
+    "Brothers &amp; Sisters" and "brothers.and.sisters" give "brothers and sisters" '''
+    title = title.lower().replace('&amp;', '&').replace('&', ' and ')
+    title = PUNCTUATION_REGEX.sub(lambda m: "" if m.group(0) == "'" else " ", title)
+    return SPACES_REGEX.sub(" ", title.replace('_', ' ')).strip()
+
+def stripYear(title):
+    ''' Removes the year at the end of a normalized title, "castle 2009" gives "castle" '''
+    stripped = YEAR_REGEX.sub("", title)
+    return stripped or title
+
+def trigrams(title):
+    padded = "  %s " % title
+    return set([ padded[i:i + 3] for i in range(len(padded) - 2) ])
+
+def similarity(a, b):
+    ''' Dice coefficient of the trigrams of two normalized titles, 1.0 when they are equal '''
+    if a == b:
+        return 1.0
+    ta, tb = trigrams(a), trigrams(b)
+    return 2.0 * len(ta & tb) / (len(ta) + len(tb))
+
+
+class ShowIndex(object):
+    ''' Maps show titles to the ids a site gives them. Titles are normalized, and a title
+    which is not in the index is matched to the closest known one by comparing their
+    trigrams, through an inverted index so that only the titles sharing trigrams with
+    it are compared. '''
+
+    def __init__(self, titles=(), threshold=0.8):
+        self.threshold = threshold
+        self.ids = {}
+        self.sizes = {} # Number of trigrams of each title
+        self.postings = {}
+        self.lock = threading.Lock()
+        self.update(titles)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, title, showId):
+        ''' Adds a title, without replacing the id of a title already known. The title
+        is also known without its year unless another show already has that name. '''
+        key = normalize(title)
+        with self.lock:
+            self._add(key, showId)
+            stripped = stripYear(key)
+            if stripped != key:
+                self._add(stripped, showId)
+
+    def _add(self, key, showId):
+        if key in self.ids:
+            return
+        self.ids[key] = showId
+        grams = trigrams(key)
+        self.sizes[key] = len(grams)
+        for trigram in grams:
+            self.postings.setdefault(trigram, set()).add(key)
+
+    def update(self, titles):
+        ''' Adds (title, id) pairs '''
+        for title, showId in titles:
+            self.add(title, showId)
+
+    def match(self, name):
+        ''' Returns (title, id, score) for the known title closest to name, None if
+        none is similar enough '''
+        key = normalize(name)
+        with self.lock:
+            for candidate in (key, stripYear(key)):
+                if candidate in self.ids:
+                    return candidate, self.ids[candidate], 1.0
+            grams = trigrams(key)
+            shared = {}
+            for trigram in grams:
+                for title in self.postings.get(trigram, ()):
+                    shared[title] = shared.get(title, 0) + 1
+            best = None
+            for title, count in shared.items():
+                score = 2.0 * count / (len(grams) + self.sizes[title])
+                if score >= self.threshold and (not best or score > best[2]) and self.compatible(key, title):
+                    best = title, self.ids[title], score
+            return best
+
+    def compatible(self, a, b):
+        ''' Whether two similar titles may be the same show spelled differently: the words
+        only one of them has must be long ones. "the office uk" is not "the office us",
+        nor "csi ny" "csi". '''
+        return all([ len(word) >= 4 and not word.isdigit() for word in set(a.split()) ^ set(b.split()) ])
+
+    def lookup(self, name):
+        ''' Returns the id of the show named name, None if it is not known '''
+        found = self.match(name)
+        if found:
+            log.debug("Show %s matched %s (%.2f)" % (name, found[0], found[2]))
+            return found[1]
+        return None
+
+
+def cachePath(filename):
+    ''' Returns the path of filename in the XDG cache folder of periscope, None without XDG '''
+    if is_local:
+        return os.path.join(bd.xdg_cache_home, "periscope", filename)
+
+class LearnedShows(object):
+    ''' The titles a plugin learned from the searches on its site. They are added to its
+    ShowIndex and saved in path (if not None), so that the next runs know them. '''
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.titles = {}
+        self.lock = threading.Lock()
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'rb') as f:
+                    self.titles = pickle.load(f)
+            except Exception, e:
+                log.warning("Could not read the learned shows %s: %s" % (self.path, e))
+        index.update(self.titles.items())
+
+    def learn(self, titles):
+        ''' Adds (title, id) pairs to the index and saves the new ones '''
+        with self.lock:
+            new = [ (title, showId) for title, showId in titles if self.titles.get(title) != showId ]
+            if not new:
+                return
+            self.titles.update(new)
+            self.index.update(new)
+            if not self.path:
+                return
+            try:
+                if not os.path.exists(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+                with open(self.path, 'wb') as f:
+                    pickle.dump(self.titles, f)
+            except Exception, e:
+                log.warning("Could not save the learned shows %s: %s" % (self.path, e))
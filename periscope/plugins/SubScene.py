@@ -16,10 +16,11 @@
 #    along with periscope; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import zipfile, os, urllib2, urllib, logging, traceback, httplib
+import zipfile, os, urllib2, urllib, logging, traceback
 from BeautifulSoup import BeautifulSoup
 
 import SubtitleDatabase
+import Transport
 
 log = logging.getLogger(__name__)
 
@@ -85,79 +86,31 @@ class SubScene(SubtitleDatabase.SubtitleDB):
 			traceback.print_exc()
 			return []
 
-	def createFile(self, subtitle):
-		'''pass the URL of the sub and the file it matches, will unzip it
-		and return the path to the created file'''
+	def downloadContents(self, subtitle):
+		'''find the URL of the sub on its page, download it and unzip it in memory'''
 		subpage = subtitle["page"]
-		page = urllib2.urlopen(subpage)
-		soup = BeautifulSoup(page)
+		page = Transport.urlopen(subpage)
+		soup = BeautifulSoup(page.read())
 
 		dlhref = soup.find("div", {"class" : "download"}).find("a")["href"]
 		subtitle["link"] =  "http://subscene.com" + dlhref.split('"')[7]
-		format = "zip"
-		archivefilename = subtitle["filename"].rsplit(".", 1)[0] + '.'+ format
-		self.downloadFile(subtitle["link"], archivefilename)
-		subtitlefilename = None
-
-		if zipfile.is_zipfile(archivefilename):
-			log.debug("Unzipping file " + archivefilename)
-			zf = zipfile.ZipFile(archivefilename, "r")
-			for el in zf.infolist():
-				extension = el.orig_filename.rsplit(".", 1)[1]
-				if extension in ("srt", "sub", "txt"):
-					subtitlefilename = srtbasefilename + "." + extension
-					outfile = open(subtitlefilename, "wb")
-					outfile.write(zf.read(el.orig_filename))
-					outfile.flush()
-					outfile.close()
-				else:
-					log.info("File %s does not seem to be valid " %el.orig_filename)
-			# Deleting the zip file
-			zf.close()
-			os.remove(archivefilename)
-			return subtitlefilename
-		elif archivefilename.endswith('.rar'):
-			log.warn('Rar is not really supported yet. Trying to call unrar')
-			import subprocess
-			try :
-				args = ['unrar', 'lb', archivefilename]
-				output = subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
-				for el in output.splitlines():
-					extension = el.rsplit(".", 1)[1]
-					if extension in ("srt", "sub"):
-						args = ['unrar', 'e', archivefilename, el, os.path.dirname(archivefilename)]
-						subprocess.Popen(args)
-						tmpsubtitlefilename = os.path.join(os.path.dirname(archivefilename), el)
-						subtitlefilename = os.path.join(os.path.dirname(archivefilename), srtbasefilename+"."+extension)
-						if os.path.exists(tmpsubtitlefilename):
-							# rename it to match the file
-							os.rename(tmpsubtitlefilename, subtitlefilename)
-							# exit
-						return subtitlefilename
-			except OSError, e:
-			    log.error("Execution failed: %s" %e)
-			    return None
-
-		else:
-			log.info("Unexpected file type (not zip) for %s" %archivefilename)
-			return None
+		data = self.fetchArchive(subtitle["link"])
+		if not data:
+			return []
+		return self.extractContents(data, "zip", videofilename = subtitle["filename"])
 
-	def downloadFile(self, url, filename):
-		''' Downloads the given url to the given filename '''
+	def fetchArchive(self, url):
+		''' Downloads the archive at the given url, the form of the page must be posted to
+		get it. Returns None on failure. '''
 		log.info("Downloading file %s" %url)
-		req = urllib2.Request(url, headers={'Referer' : url, 'User-Agent' : 'Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.1.3)'})
-
-		f = urllib2.urlopen(req, data=urllib.urlencode({'__EVENTTARGET' : 's$lc$bcr$downloadLink', '__EVENTARGUMENT' : '', '__VIEWSTATE' : '/wEPDwUHNzUxOTkwNWRk4wau5efPqhlBJJlOkKKHN8FIS04='}))
-		dump = open(filename, "wb")
+		headers = {'Referer' : url, 'User-Agent' : 'Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.1.3)'}
+		data = urllib.urlencode({'__EVENTTARGET' : 's$lc$bcr$downloadLink', '__EVENTARGUMENT' : '', '__VIEWSTATE' : '/wEPDwUHNzUxOTkwNWRk4wau5efPqhlBJJlOkKKHN8FIS04='})
 		try:
-			f.read(1000000)
-		except httplib.IncompleteRead, e:
-			dump.write(e.partial)
-			log.warn('Incomplete read for %s ... Trying anyway to decompress.' %url)
-		dump.close()
-		f.close()
-
-		#SubtitleDatabase.SubtitleDB.downloadFile(self, req, filename)
+			return Transport.request('POST', url, data, headers).body
+		except urllib2.HTTPError, e:
+			log.warning("HTTP Error: %s - %s" % (e.code, url))
+		except urllib2.URLError, e:
+			log.warning("URL Error: %s - %s" % (e.reason, url))
 
 	def query(self, token, langs=None):
 		''' makes a query on subscene and returns info (link, lang) about found subtitles'''
@@ -165,9 +118,9 @@ class SubScene(SubtitleDatabase.SubtitleDB):
 
 		searchurl = "%s%s" %(self.host, urllib.quote(token))
 		log.debug("dl'ing %s" %searchurl)
-		page = urllib2.urlopen(searchurl)
+		page = Transport.urlopen(searchurl)
 
-		soup = BeautifulSoup(page)
+		soup = BeautifulSoup(page.read())
 		for subs in soup("a", {"class":"a1"}):
 			lang_span = subs.find("span")
 			lang = self.getLG(lang_span.contents[0].strip())
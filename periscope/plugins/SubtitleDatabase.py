@@ -16,16 +16,37 @@
 #    along with periscope; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import os, shutil, urllib2, sys, logging, traceback, zipfile, gzip, socket
-import re
+import os, re, shutil, urllib2, sys, logging, traceback, zipfile, gzip, socket, thread
+from cStringIO import StringIO
+
+import Transport
+import VideoInfo
+import PageCache
 
 log = logging.getLogger(__name__)
 
+TEXTSUB_EXTS = ("srt", "sub", "txt")
+TOKEN_REGEX = re.compile('[a-z0-9]+')
+
+# Downloaded archives by URL, so that the other episodes of a season pack are taken from it
+archives = PageCache.PageCache(ttl=600, maxEntries=16)
+
+def tokens(name):
+	return set(TOKEN_REGEX.findall(name.lower()))
+
 def fileext(filename):
         return os.path.splitext(filename)[1][1:].lower()
 
 class SubtitleDB(object):
 	''' Base (kind of abstract) class that represent a SubtitleDB, usually a website. Should be rewritten using abc module in Python 2.6/3K'''
+	isAsync = False # Set by the plugins implementing aquery and acreateFile
+	batchSize = 0 # Set by the plugins implementing processBatch, the number of files searched at once
+	downloadBatchSize = 0 # Set by the plugins implementing createFiles, the number of subtitles downloaded at once
+	fingerprints = None # Cache of the file hashes shared by the plugins, set by periscope
+	tvshowRegex = VideoInfo.TVSHOW_REGEX
+	tvshowRegex2 = VideoInfo.TVSHOW_REGEX2
+	movieRegex = VideoInfo.MOVIE_REGEX
+
 	def __init__(self, langs, revertlangs = None):
 		if langs:
 			self.langs = langs
@@ -33,22 +54,104 @@ class SubtitleDB(object):
 		if revertlangs:
 			self.revertlangs = revertlangs
 			self.langs = dict(map(lambda item: (item[1],item[0]), self.revertlangs.items()))
-		self.tvshowRegex = re.compile('(?P<show>.*)S(?P<season>[0-9]{2})E(?P<episode>[0-9]{2}).(?P<teams>.*)', re.IGNORECASE)
-		self.tvshowRegex2 = re.compile('(?P<show>.*).(?P<season>[0-9]{1,2})x(?P<episode>[0-9]{1,2}).(?P<teams>.*)', re.IGNORECASE)
-		self.movieRegex = re.compile('(?P<movie>.*)[\.|\[|\(| ]{1}(?P<year>(?:(?:19|20)[0-9]{2}))(?P<teams>.*)', re.IGNORECASE)
 
 	def searchInThread(self, queue, filename, langs):
 		''' search subtitles with the given filename for the given languages'''
+		subs = self.search(filename, langs)
+		log.info("%s writing %s items to queue" % (self.__class__.__name__, len(subs)))
+		queue.put(subs, True) # Each plugin must write as the caller periscopy.py waits for an result on the queue
+
+	def search(self, filename, langs):
+		''' search subtitles with the given filename for the given languages and
+		returns them tagged with the plugin and the filename. Never raises.'''
 		try:
 			subs = self.process(filename, langs)
 			map(lambda item: item.setdefault("plugin", self), subs)
 			map(lambda item: item.setdefault("filename", filename), subs)
-			log.info("%s writing %s items to queue" % (self.__class__.__name__, len(subs)))
 		except Exception, e:
                         log.debug("Error raised by plugin %s: %s" %(self.__class__.__name__, e))
                         log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+			Transport.recordFailure()
 			subs = []
-		queue.put(subs, True) # Each plugin must write as the caller periscopy.py waits for an result on the queue
+		return subs
+
+	def asearch(self, filename, langs, callback):
+		''' asynchronous counterpart of search: returns immediately and calls
+		callback(subs) once the plugin answered. Never raises.'''
+		def done(subs):
+			subs = subs or []
+			map(lambda item: item.setdefault("plugin", self), subs)
+			map(lambda item: item.setdefault("filename", filename), subs)
+			callback(subs)
+		try:
+			self.aquery(filename, langs, done)
+		except Exception, e:
+			log.debug("Error raised by plugin %s: %s" %(self.__class__.__name__, e))
+			log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+			Transport.recordFailure()
+			callback([])
+
+	def searchBatch(self, filenames, langs):
+		''' searches several files at once through processBatch and returns
+		{ filename : subs } for the files it could search, the subtitles being tagged like
+		the results of search. Never raises.'''
+		try:
+			results = self.processBatch(filenames, langs)
+			for filename, subs in results.items():
+				map(lambda item: item.setdefault("plugin", self), subs)
+				map(lambda item: item.setdefault("filename", filename), subs)
+		except Exception, e:
+			log.debug("Error raised by plugin %s: %s" %(self.__class__.__name__, e))
+			log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+			Transport.recordFailure()
+			results = {}
+		return results
+
+	def processBatch(self, filepaths, langs):
+		''' batch counterpart of process, only called when batchSize is set, with at most
+		batchSize files. Returns { filepath : subs } for the files it searched, the others are
+		searched one by one with process'''
+		raise TypeError("%s has not implemented method '%s'" %(self.__class__.__name__, sys._getframe().f_code.co_name))
+
+	def createFiles(self, subtitles):
+		''' batch counterpart of createFile, only called when downloadBatchSize is set, with
+		at most downloadBatchSize subtitles. Returns the paths of the created files in the order
+		of subtitles, None for those which could not be downloaded'''
+		raise TypeError("%s has not implemented method '%s'" %(self.__class__.__name__, sys._getframe().f_code.co_name))
+
+	def aquery(self, filepath, langs, callback):
+		''' asynchronous counterpart of process, only called when isAsync is set. Must not
+		block on the network and must call callback(subs) exactly once, usually from the
+		callback of self.fetch'''
+		raise TypeError("%s has not implemented method '%s'" %(self.__class__.__name__, sys._getframe().f_code.co_name))
+
+	def acreateFile(self, subtitle, callback):
+		''' asynchronous counterpart of createFile, only called when isAsync is set.
+		Must call callback(subpath) exactly once, subpath being None on failure'''
+		raise TypeError("%s has not implemented method '%s'" %(self.__class__.__name__, sys._getframe().f_code.co_name))
+
+	@classmethod
+	def close(cls):
+		''' Releases what the instances of the plugin share, such as a login on the site.
+		Called by periscope at shutdown for the plugins it used. '''
+		pass
+
+	def fileHash(self, flavour, filepath, compute):
+		''' Returns compute(filepath), the hash of the given flavour of the file, through
+		the shared fingerprint cache when there is one'''
+		if self.fingerprints:
+			try:
+				return self.fingerprints.lookup(filepath, flavour, compute)
+			except Exception, e:
+				log.warning("Could not use the fingerprint cache for %s: %s" %(filepath, e))
+		return compute(filepath)
+
+	def fetch(self, url, callback, data=None, headers=None, timeout=None):
+		''' Downloads url on the shared event loop and calls callback(response) from it '''
+		log.info("Downloading %s" % url)
+		allheaders = {'Referer' : url}
+		allheaders.update(headers or {})
+		Transport.asyncClient().fetch(url, callback, data, allheaders, timeout)
 
 	def process(self, filepath, langs):
 		''' main method to call on the plugin, pass the filename and the wished
@@ -59,71 +162,113 @@ class SubtitleDB(object):
 		except Exception, e:
 			log.error("Error raised by plugin %s: %s" %(self.__class__.__name__, e))
 			traceback.print_exc()
+			Transport.recordFailure()
 			return []
 
-        def writeFile(self, filename, contents):
-                with open(filename, 'wb') as outfile:
-                        outfile.write(contents)
-
-        def downloadSubtitleText(self, subtitle):
-                filename = self.createFile(subtitle)
-                contents = open(filename).read()
-                os.remove(filename)
-                return contents
+	def writeFile(self, filename, contents):
+		''' Writes the file atomically: the contents go to a temporary file of the same folder
+		which is then renamed, so a partly written subtitle is never seen '''
+		tmpname = os.path.join(os.path.dirname(os.path.abspath(filename)),
+		                       ".%s.%d.%d.part" % (os.path.basename(filename), os.getpid(), thread.get_ident()))
+		fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0666)
+		try:
+			with os.fdopen(fd, 'wb') as outfile:
+				outfile.write(contents)
+			if os.name == 'nt' and os.path.exists(filename):
+				os.remove(filename) # rename does not replace files on Windows
+			os.rename(tmpname, filename)
+		except:
+			if os.path.exists(tmpname):
+				os.remove(tmpname)
+			raise
+
+	def downloadSubtitleText(self, subtitle):
+		''' Returns the text of the subtitle, without writing anything on disk '''
+		contents = self.downloadContents(subtitle)
+		if contents:
+			return contents[-1][1]
+
+	def downloadContents(self, subtitle):
+		''' Downloads the subtitle and returns its files as (extension, contents) pairs, the
+		archives being extracted in memory. The plugins whose subtitles are not simply
+		at subtitle["link"] override this rather than createFile. '''
+		suburl = subtitle["link"]
+		forceType = subtitle.get('forceType', '')
+		if fileext(suburl) == 'zip' or forceType == 'zip':
+			try:
+				data = archives.get(suburl, lambda: self.downloadArchive(suburl))
+			except IOError, e:
+				log.warning(e)
+				return []
+		else:
+			data = self.downloadText(suburl)
+		if not data:
+			return []
+		return self.extractContents(data, fileext(suburl), forceType, subtitle.get("filename"))
+
+	def downloadArchive(self, url):
+		''' Downloads an archive for the archives cache, raises IOError on failure '''
+		data = self.downloadText(url)
+		if not data:
+			raise IOError("Could not download %s" % url)
+		return data
+
+	def extractContents(self, data, ext, forceType = '', videofilename = None):
+		''' Returns the subtitles held by data, a file with the given extension, as
+		(extension, contents) pairs. For a season pack, only the member matching the
+		episode of videofilename is returned, see selectMembers. '''
+		if ext == 'zip' or forceType == 'zip':
+			try:
+				zf = zipfile.ZipFile(StringIO(data))
+			except zipfile.BadZipfile:
+				log.warning("Unexpected file type (not zip)")
+				return []
+			names = []
+			for el in zf.infolist():
+				if fileext(el.orig_filename) in TEXTSUB_EXTS:
+					names.append(el.orig_filename)
+				else:
+					log.info("File %s does not seem to be valid " % el.orig_filename)
+			contents = [ (fileext(name), zf.read(name)) for name in self.selectMembers(names, videofilename) ]
+			zf.close()
+			return contents
+		elif ext == 'gz':
+			return [ ("srt", Transport.decodeBody(data, 'gzip')) ]
+		elif ext in TEXTSUB_EXTS or forceType in TEXTSUB_EXTS:
+			return [ (ext in TEXTSUB_EXTS and ext or forceType, data) ]
+		log.warning("Unrecognized file type: %s" % (ext or forceType))
+		return []
+
+	def selectMembers(self, names, videofilename):
+		''' Returns the names of the archive members holding the subtitle of the video. When
+		the video is an episode and the archive holds episodes (a season pack), only those
+		of the episode of the video are kept, and the one sharing the most release tokens
+		with the video is chosen. Otherwise all the members are kept, like the parts of a
+		multi-CD subtitle. '''
+		if len(names) <= 1 or not videofilename:
+			return names
+		video = self.videoInfo(videofilename).fileData
+		if video['type'] != 'tvshow':
+			return names
+		episodes = [ (name, VideoInfo.guessFileData(os.path.basename(name))) for name in names ]
+		if not [ name for name, data in episodes if data['type'] == 'tvshow' ]:
+			return names
+		names = [ name for name, data in episodes if data['type'] == 'tvshow'
+		          and (data['season'], data['episode']) == (video['season'], video['episode']) ]
+		if not names:
+			log.info("No subtitle for S%02dE%02d in the archive" % (video['season'], video['episode']))
+			return []
+		videoTokens = tokens(os.path.basename(videofilename))
+		return [ max(names, key=lambda name: len(tokens(os.path.basename(name)) & videoTokens)) ]
 
 	def createFile(self, subtitle):
 		'''pass the URL of the sub and the file it matches, will unzip it
 		and return the path to the created file'''
-		suburl = subtitle["link"]
-		videofilename = subtitle["filename"]
-		srtbasefilename = videofilename.rsplit(".", 1)[0]
-
-                TEXTSUB_EXTS = ("srt", "sub", "txt")
-
-                if fileext(suburl) == 'zip' or subtitle.get('forceType', '') == 'zip':
-                        zipfilename = self.findSrtFilename(videofilename, ext = 'zip')
-                        self.downloadFile(suburl, zipfilename)
-
-                        if not zipfile.is_zipfile(zipfilename):
-                                log.warning("Unexpected file type (not zip)")
-                                os.remove(zipfilename)
-                                return None
-
-                        log.debug("Unzipping file " + zipfilename)
-                        zf = zipfile.ZipFile(zipfilename, "r")
-                        subfile = None
-                        for el in zf.infolist():
-                                if fileext(el.orig_filename) in TEXTSUB_EXTS:
-                                        subfile = self.findSrtFilename(videofilename, ext = fileext(el.orig_filename))
-                                        self.writeFile(subfile, contents = zf.read(el.orig_filename))
-                                else:
-                                        log.info("File %s does not seem to be valid " % el.orig_filename)
-
-                        # Deleting the zip file
-                        zf.close()
-                        os.remove(zipfilename)
-                        return subfile
-
-                elif fileext(suburl) == 'gz':
-                        subfile = self.findSrtFilename(videofilename)
-                        self.downloadFile(suburl, subfile+".gz")
-
-                        f = gzip.open(subfile+".gz")
-                        dump = open(subfile, "wb")
-                        dump.write(f.read())
-
-                        dump.close()
-                        f.close()
-                        os.remove(subfile+".gz")
-                        return subfile
-
-                elif fileext(suburl) in TEXTSUB_EXTS or subtitle.get('forceType', '') in TEXTSUB_EXTS:
-                        subfile = self.findSrtFilename(videofilename, ext = fileext(suburl))
-                        self.downloadFile(suburl, subfile)
-                        return subfile
-                else:
-                        log.warning("Unrecognized file type: " + suburl)
-
+		subfile = None
+		for ext, contents in self.downloadContents(subtitle):
+			subfile = self.findSrtFilename(subtitle["filename"], ext = ext)
+			self.writeFile(subfile, contents)
+		return subfile
 
         def findSrtFilename(self, videofilename, ext = 'srt'):
 		srtbasefilename = os.path.splitext(videofilename)[0]
@@ -144,14 +289,7 @@ class SubtitleDB(object):
 		''' Downloads the given url and returns its contents.'''
 		try:
 			log.info("Downloading %s" % url)
-			req = urllib2.Request(url, headers={'Referer' : url, 'User-Agent' : 'Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.1.3)'})
-                        if timeout is not None:
-                                socket.setdefaulttimeout(timeout)
-
-                        f = urllib2.urlopen(req)
-                        result = f.read()
-                        f.close()
-                        return result
+			return Transport.request('GET', url, headers={'Referer' : url}, timeout=timeout).body
 
 		except urllib2.HTTPError, e:
 			log.warning("HTTP Error: %s - %s" % (e.code, url))
@@ -162,8 +300,7 @@ class SubtitleDB(object):
                 text = self.downloadText(url)
 
                 if text:
-                        with open(filename, "wb") as dump:
-                                dump.write(text)
+                        self.writeFile(filename, text)
                         log.debug("Download finished to file %s. Size : %d" % (filename, os.path.getsize(filename)))
 
 
@@ -186,46 +323,15 @@ class SubtitleDB(object):
 		raise TypeError("%s has not implemented method '%s'" %(self.__class__.__name__, sys._getframe().f_code.co_name))
 
 	def getFileName(self, filepath):
-		if os.path.isfile(filepath):
-			filename = os.path.basename(filepath)
-		else:
-			filename = filepath
-		if filename.endswith(('.avi', '.wmv', '.mov', '.mp4', '.mpeg', '.mpg', '.mkv')):
-			fname = filename.rsplit('.', 1)[0]
-		else:
-			fname = filename
-		return fname
+		return VideoInfo.getFileName(filepath)
+
+	def videoInfo(self, filepath):
+		''' Returns the VideoInfo of the file, shared by every plugin so that the guesses are
+		only made once per file'''
+		return VideoInfo.videoInfo(filepath)
 
 	def guessFileData(self, filename):
-		filename = unicode(self.getFileName(filename).lower())
-		matches_tvshow = self.tvshowRegex.match(filename)
-		if matches_tvshow: # It looks like a tv show
-			(tvshow, season, episode, teams) = matches_tvshow.groups()
-			tvshow = tvshow.replace(".", " ").strip()
-			teams = teams.split('.')
-			return {'type' : 'tvshow', 'name' : tvshow.strip(), 'season' : int(season), 'episode' : int(episode), 'teams' : teams}
-		else:
-			matches_tvshow = self.tvshowRegex2.match(filename)
-			if matches_tvshow:
-				(tvshow, season, episode, teams) = matches_tvshow.groups()
-				tvshow = tvshow.replace(".", " ").strip()
-				teams = teams.split('.')
-				return {'type' : 'tvshow', 'name' : tvshow.strip(), 'season' : int(season), 'episode' : int(episode), 'teams' : teams}
-			else:
-				matches_movie = self.movieRegex.match(filename)
-				if matches_movie:
-					(movie, year, teams) = matches_movie.groups()
-					teams = teams.split('.')
-					part = None
-					if "cd1" in teams :
-						teams.remove('cd1')
-						part = 1
-					if "cd2" in teams :
-						teams.remove('cd2')
-						part = 2
-					return {'type' : 'movie', 'name' : movie.strip(), 'year' : year, 'teams' : teams, 'part' : part}
-				else:
-					return {'type' : 'unknown', 'name' : filename, 'teams' : [] }
+		return self.videoInfo(filename).fileData
 
 
 class InvalidFileException(Exception):
@@ -26,6 +26,7 @@ except ImportError:
     is_local = False
 
 import SubtitleDatabase
+import Transport
 
 log = logging.getLogger(__name__)
 
@@ -92,7 +93,7 @@ class SubtitleSource(SubtitleDatabase.SubtitleDB):
         for lang in languages:
             searchurl = "%s/%s/%s/0" %(self.host, urllib.quote(token), lang)
             log.debug("dl'ing %s" %searchurl)
-            page = urllib2.urlopen(searchurl, timeout=5)
+            page = Transport.urlopen(searchurl, timeout=5)
             xmltree = xml.dom.minidom.parse(page)
             subs = xmltree.getElementsByTagName("sub")
 
@@ -121,14 +122,10 @@ class SubtitleSource(SubtitleDatabase.SubtitleDB):
         return sublinks
 
 
-    def createFile(self, subtitle):
-        '''pass the URL of the sub and the file it matches, will unzip it
-        and return the path to the created file'''
-        suburl = subtitle["link"]
-        srtfilename = self.findSrtFilename(subtitle["filename"])
-
-        self.downloadFile(suburl, srtfilename)
-        return srtfilename
+    def downloadContents(self, subtitle):
+        '''pass the URL of the sub and download it'''
+        text = self.downloadText(subtitle["link"])
+        return text and [ ("srt", text) ] or []
 
     def getValue(self, sub, tagName):
         for node in sub.childNodes:
@@ -20,9 +20,14 @@ import zipfile, os, urllib2, urllib, logging, traceback, httplib, re
 from BeautifulSoup import BeautifulSoup
 
 import SubtitleDatabase
+import Transport
+import PageCache
 
 log = logging.getLogger(__name__)
 
+# Parsed episode pages, shared by every release and language of an episode
+episodePages = PageCache.PageCache(ttl=3600)
+
 LANGUAGES = {u"English (US)" : "en",
 			 u"English (UK)" : "en",
 			 u"English" : "en",
@@ -62,43 +67,46 @@ class Subtitulos(SubtitleDatabase.SubtitleDB):
 		sublinks = []
 		name = name.lower().replace(" ", "-")
 		searchurl = "%s/%s/%sx%s" %(self.host, name, season, episode)
-		log.debug("dl'ing %s" %searchurl)
 		try:
-			page = urllib2.urlopen(searchurl)
+			rows = episodePages.get(searchurl, lambda: self.parseEpisodePage(searchurl))
 		except urllib2.HTTPError as inst:
 			log.debug("Error : %s for %s" % (searchurl, inst))
 			return sublinks
 
-		soup = BeautifulSoup(page)
-		for subs in soup("td", {"class":"NewsTitle"}):
-			subteams = self.release_pattern.match("%s"%subs.contents[1]).groups()[0].lower()
-			teams = set(teams)
+		teams = set(teams)
+		for subteams, lang, status, link in rows:
 			subteams = self.listTeams([subteams], [".", "_", " "])
 
 			log.debug("Team from website: %s" %subteams)
 			log.debug("Team from file: %s" %teams)
 
-			#langs_html = subs.findNext("td", {"class" : "language"})
-			#lang = self.getLG(langs_html.string.strip())
+			if status == "Completado" and subteams.issubset(teams) and (not langs or lang in langs) :
+				result = {}
+				result["release"] = "%s.S%.2dE%.2d.%s" %(name.replace("-", ".").title(), int(season), int(episode), '.'.join(subteams))
+				result["lang"] = lang
+				result["link"] = link
+				result["page"] = searchurl
+				sublinks.append(result)
 
+		return sublinks
+
+	def parseEpisodePage(self, searchurl):
+		''' Downloads the page of an episode and returns its subtitles as (teams, lang, status,
+		link) tuples, which are kept in episodePages for the other releases and languages of
+		the episode '''
+		log.debug("dl'ing %s" %searchurl)
+		soup = BeautifulSoup(Transport.urlopen(searchurl).read())
+		rows = []
+		for subs in soup("td", {"class":"NewsTitle"}):
+			subteams = self.release_pattern.match("%s"%subs.contents[1]).groups()[0].lower()
 			nexts = subs.parent.parent.findAll("td", {"class" : "language"})
 			for langs_html in nexts:
 				lang = self.getLG(langs_html.string.strip())
-
 				statusTD = langs_html.findNext("td")
 				status = statusTD.find("strong").string.strip()
-
 				link = statusTD.findNext("td").find("a")["href"]
-				if status == "Completado" and subteams.issubset(teams) and (not langs or lang in langs) :
-					result = {}
-					result["release"] = "%s.S%.2dE%.2d.%s" %(name.replace("-", ".").title(), int(season), int(episode), '.'.join(subteams)
-	)
-					result["lang"] = lang
-					result["link"] = link
-					result["page"] = searchurl
-					sublinks.append(result)
-
-		return sublinks
+				rows.append((subteams, lang, unicode(status), unicode(link)))
+		return tuple(rows)
 
 	def listTeams(self, subteams, separators):
 		teams = []
@@ -113,12 +121,7 @@ class Subtitulos(SubtitleDatabase.SubtitleDB):
 			teams += t.split(sep)
 		return teams
 
-	def createFile(self, subtitle):
-		'''pass the URL of the sub and the file it matches, will unzip it
-		and return the path to the created file'''
-		suburl = subtitle["link"]
-		videofilename = subtitle["filename"]
-		srtbasefilename = videofilename.rsplit(".", 1)[0]
-		srtfilename = srtbasefilename +".srt"
-		self.downloadFile(suburl, srtfilename)
-		return srtfilename
+	def downloadContents(self, subtitle):
+		'''pass the URL of the sub and download it'''
+		text = self.downloadText(subtitle["link"])
+		return text and [ ("srt", text) ] or []
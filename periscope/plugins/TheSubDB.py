@@ -22,9 +22,10 @@ import urllib
 import xml.dom.minidom
 import logging
 import traceback
-import hashlib
 
 import SubtitleDatabase
+import Transport
+import Fingerprint
 
 log = logging.getLogger(__name__)
 
@@ -46,63 +47,83 @@ class TheSubDB(SubtitleDatabase.SubtitleDB):
         super(TheSubDB, self).__init__(SS_LANGUAGES)
         self.host = "http://api.thesubdb.com/"
 
+    isAsync = True
+
     def process(self, filepath, langs):
         ''' main method to call on the plugin, pass the filename and the wished
         languages and it will query the subtitles source '''
         # Get the hash
-        filehash = self.get_hash(filepath)
+        filehash = self.fileHash("thesubdb", filepath, self.get_hash)
         log.debug('File hash : %s' % filehash)
+        if not filehash:
+            return []
         # Make the search
-        search_url = "%s?action=%s&hash=%s" % (self.host, "search", filehash)
+        search_url = self.searchUrl(filehash)
         log.debug('Query URL : %s' % search_url)
-        req = urllib2.Request(search_url)
-        req.add_header('User-Agent', self.user_agent)
-        subs = []
         try :
-            page = urllib2.urlopen(req, timeout=5)
-            content = page.readlines()
-            plugin_langs = content[0].split(',')
-            for lang in plugin_langs :
-                if not langs or lang in langs:
-                    result = {}
-                    result['release'] = filepath
-                    result['lang'] = lang
-                    result['link'] = "%s?action=%s&hash=%s&language=%s" % (self.host, "download", filehash, lang)
-                    result['page'] = result['link']
-                    subs.append(result)
-            return subs
+            page = Transport.urlopen(search_url, headers={'User-Agent' : self.user_agent}, timeout=5)
+            return self.parseResults(filepath, filehash, page.read(), langs)
         except urllib2.HTTPError, e :
             if e.code == 404 : # No result found
-                return subs
+                return []
+
+    def aquery(self, filepath, langs, callback):
+        ''' asynchronous version of process '''
+        filehash = self.fileHash("thesubdb", filepath, self.get_hash)
+        log.debug('File hash : %s' % filehash)
+        if not filehash:
+            callback([])
+            return
+
+        def searched(response):
+            subs = []
+            try:
+                if not response.error:
+                    subs = self.parseResults(filepath, filehash, response.body, langs)
+            finally:
+                callback(subs)
+
+        self.fetch(self.searchUrl(filehash), searched, headers={'User-Agent' : self.user_agent}, timeout=5)
+
+    def searchUrl(self, filehash):
+        return "%s?action=%s&hash=%s" % (self.host, "search", filehash)
+
+    def parseResults(self, filepath, filehash, content, langs):
+        ''' builds the subtitles from the comma separated list of languages returned by a search '''
+        subs = []
+        plugin_langs = content.splitlines()[0].split(',')
+        for lang in plugin_langs :
+            if not langs or lang in langs:
+                result = {}
+                result['release'] = filepath
+                result['lang'] = lang
+                result['link'] = "%s?action=%s&hash=%s&language=%s" % (self.host, "download", filehash, lang)
+                result['page'] = result['link']
+                result['hashMatch'] = True
+                subs.append(result)
+        return subs
 
 
     def get_hash(self, name):
         '''this hash function receives the name of the file and returns the hash code'''
-        readsize = 64 * 1024
-        with open(name, 'rb') as f:
-            size = os.path.getsize(name)
-            data = f.read(readsize)
-            f.seek(-readsize, os.SEEK_END)
-            data += f.read(readsize)
-        return hashlib.md5(data).hexdigest()
-
-    def createFile(self, subtitle):
-        '''pass the URL of the sub and the file it matches, will unzip it
-        and return the path to the created file'''
-        suburl = subtitle["link"]
-        srtfilename = self.findSrtFilename(subtitle["filename"])
+        return Fingerprint.VideoFingerprint.fromFile(name).get("thesubdb")
+
+    def downloadContents(self, subtitle):
+        '''pass the URL of the sub and download it'''
+        f = Transport.urlopen(subtitle["link"], headers={'User-Agent' : self.user_agent})
+        return [ ("srt", f.read()) ]
 
-        self.downloadFile(suburl, srtfilename)
-        return srtfilename
+    def acreateFile(self, subtitle, callback):
+        ''' asynchronous version of createFile '''
+        srtfilename = self.findSrtFilename(subtitle["filename"])
 
-    def downloadFile(self, url, srtfilename):
-        ''' Downloads the given url to the given filename '''
-        req = urllib2.Request(url)
-        req.add_header('User-Agent', self.user_agent)
+        def downloaded(response):
+            subpath = None
+            try:
+                if not response.error:
+                    self.writeFile(srtfilename, response.body)
+                    subpath = srtfilename
+            finally:
+                callback(subpath)
 
-        f = urllib2.urlopen(req)
-        dump = open(srtfilename, "wb")
-        dump.write(f.read())
-        dump.close()
-        f.close()
-        log.debug("Download finished to file %s. Size : %s"%(srtfilename,os.path.getsize(srtfilename)))
+        self.fetch(subtitle["link"], downloaded, headers={'User-Agent' : self.user_agent})
@@ -0,0 +1,811 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+''' HTTP transport shared by the plugins.
+
+Blocking requests go through request() / urlopen(), which keep the connections
+alive and pool them per host (see ConnectionPool). AsyncHTTPClient multiplexes
+any number of outstanding requests on a single asyncore event loop running in
+its own thread, so that plugins implementing the asynchronous protocol
+(SubtitleDB.aquery / acreateFile) do not need a thread per request. '''
+
+import os, sys, socket, asyncore, errno, threading, time, logging, traceback, weakref
+import urllib, urllib2, urlparse, httplib, xmlrpclib, zlib, gzip
+from contextlib import contextmanager
+from xml.etree import cElementTree
+from cStringIO import StringIO
+from Queue import Queue, Empty
+
+log = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (X11; U; Linux x86_64; en-US; rv:1.9.1.3)'
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307)
+DEFAULT_TIMEOUT = (10, 30) # (connect, read) in seconds
+IDLE_TIMEOUT = 15 # Seconds after which a kept-alive connection is not reused, servers may have closed it
+SLOT_WAIT_STEP = 0.05
+# Methods which may be sent again when a kept-alive connection turns out to be closed
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+ADDRESS_TTL = 300 # Seconds the address of a host is reused by the event loop without resolving it again
+# Statuses of a server refusing a gzipped request body, before running the call
+GZIP_REFUSED_CODES = (400, 411, 415)
+
+class DeadlineExpired(urllib2.URLError):
+    ''' Raised instead of sending a request once the deadline of the thread expired '''
+    def __init__(self):
+        urllib2.URLError.__init__(self, socket.timeout("deadline expired"))
+
+
+class Deadline(object):
+    ''' A point in time after which the requests made by a thread fail, see deadline().
+    It can also be cancelled, which makes it expire at once. failures counts the
+    requests made under it that could not get an answer from the server. '''
+
+    def __init__(self, seconds=None, *parents):
+        self.expires = seconds is not None and time.time() + seconds or None
+        self.parents = [ parent for parent in parents if parent ]
+        self.cancelled = False
+        self.failures = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        ''' Returns the remaining seconds, None if there is no limit '''
+        if self.cancelled:
+            return 0
+        remaining = self.expires and max(0, self.expires - time.time())
+        for parent in self.parents:
+            left = parent.remaining()
+            if remaining is None or (left is not None and left < remaining):
+                remaining = left
+        return remaining
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            listeners, self.listeners = self.listeners, []
+        for listener in listeners:
+            listener()
+
+    def onCancel(self, listener):
+        ''' Calls listener() once the deadline or one of its parents is cancelled, at once
+        if one already is. It may be called several times. '''
+        with self.lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self.listeners.append(listener)
+        if cancelled:
+            listener()
+            return
+        for parent in self.parents:
+            parent.onCancel(listener)
+
+
+_local = threading.local()
+
+@contextmanager
+def deadline(seconds, cancel=None):
+    ''' Makes every request of the current thread fail after the given number of
+    seconds, or once the yielded Deadline or the given cancel Deadline are
+    cancelled. Can be nested. '''
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = Deadline(seconds, previous, cancel)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = previous
+
+def currentDeadline():
+    return getattr(_local, 'deadline', None)
+
+def recordFailure(current=None):
+    ''' Counts a failed request in the given deadline, the one of the current thread by default '''
+    current = current or currentDeadline()
+    if current:
+        current.failures += 1
+
+def isFailure(error):
+    ''' Whether error means the server could not answer, as opposed to an HTTP error
+    like 404 which is a valid answer '''
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500
+    return error is not None
+
+def timeouts(timeout=None):
+    ''' Returns the (connect, read) timeouts to use for a request, given either one
+    value for both or a pair, and bounded by the deadline of the current thread.
+    Raises DeadlineExpired if there is no time left. '''
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    if not isinstance(timeout, (tuple, list)):
+        timeout = (timeout, timeout)
+    connect, read = timeout
+    current = currentDeadline()
+    remaining = current and current.remaining()
+    if remaining is not None:
+        if remaining <= 0:
+            recordFailure(current)
+            raise DeadlineExpired()
+        connect, read = min(connect, remaining), min(read, remaining)
+    return connect, read
+
+
+class _HTTPConnection(httplib.HTTPConnection):
+    ''' HTTPConnection using timeout to connect and readTimeout once connected '''
+    readTimeout = None
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.settimeout(self.readTimeout)
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    readTimeout = None
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        self.sock.settimeout(self.readTimeout)
+
+
+def decodeBody(body, encoding):
+    ''' Decodes a body sent with the given Content-Encoding '''
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        try:
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        except zlib.error:
+            # zlib only reads the first member of a multi-member gzip file
+            return gzip.GzipFile(fileobj=StringIO(body)).read()
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Some servers send a raw deflate stream without the zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class Response(object):
+    ''' A complete HTTP response. error is None on success, otherwise an
+    urllib2.HTTPError (status >= 400) or an urllib2.URLError. '''
+
+    def __init__(self, url, status=None, reason=None, headers=None, body=None, error=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+        self.body = body
+        self.error = error
+        self.msg = None # httplib.HTTPMessage of the headers, when available
+
+    def __repr__(self):
+        return "<Response %s %s>" % (self.status, self.url)
+
+
+class ConnectionPool(object):
+    ''' Keeps HTTP/1.1 connections alive and reuses them for the following requests
+    to the same host, if they were not idle more than IDLE_TIMEOUT seconds. At most
+    maxPerHost requests run at the same time on a host, the other callers wait for a
+    connection to be given back, no longer than their connect timeout and deadline. '''
+
+    def __init__(self, maxPerHost=4):
+        self.maxPerHost = maxPerHost
+        self.idle = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        ''' Sends the request, following redirections, and returns the complete Response.
+        Raises urllib2.HTTPError for error statuses and urllib2.URLError when the server
+        could not be reached, like urllib2.urlopen. timeout is either one value or a
+        (connect, read) pair, DEFAULT_TIMEOUT if None. '''
+        try:
+            return self._follow(method, url, data, headers, timeout)
+        except urllib2.URLError, e:
+            if isFailure(e) and not isinstance(e, DeadlineExpired):
+                recordFailure()
+            raise
+
+    def _follow(self, method, url, data, headers, timeout):
+        allheaders = { 'User-Agent' : USER_AGENT, 'Accept-Encoding' : 'gzip, deflate' }
+        allheaders.update(headers or {})
+        for redirects in range(MAX_REDIRECTS + 1):
+            response = self._request(method, url, data, allheaders, timeout)
+            location = response.headers.get('location')
+            if response.status not in REDIRECT_CODES or not location:
+                break
+            location = urlparse.urljoin(url, location)
+            log.debug("Following redirection %s -> %s" % (url, location))
+            url = location
+            if response.status != 307:
+                method, data = 'GET', None
+                allheaders.pop('Content-Type', None)
+        response.body = decodeBody(response.body, response.headers.get('content-encoding'))
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(response.body))
+        return response
+
+    def urlopen(self, url, data=None, headers=None, timeout=None):
+        ''' Drop-in replacement of urllib2.urlopen returning a file-like object '''
+        response = self.request(data is None and 'GET' or 'POST', url, data, headers, timeout)
+        f = urllib.addinfourl(StringIO(response.body), response.msg, response.url, response.status)
+        f.msg = response.reason
+        return f
+
+    def _key(self, url):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise urllib2.URLError("unknown url type: %s" % parts.scheme)
+        return parts.scheme, parts.hostname, parts.port
+
+    def _slot(self, key):
+        with self.lock:
+            slot = self.slots.get(key)
+            if not slot:
+                slot = self.slots[key] = threading.BoundedSemaphore(self.maxPerHost)
+            return slot
+
+    def _acquire(self, slot, timeout):
+        ''' Waits for the slot in short steps, so that the expiry or the cancellation of
+        the deadline of the thread is noticed '''
+        limit = timeouts(timeout)[0]
+        start = time.time()
+        while not slot.acquire(False):
+            timeouts(timeout) # Raises DeadlineExpired
+            if time.time() - start >= limit:
+                raise urllib2.URLError(socket.timeout("no free connection to the host"))
+            time.sleep(SLOT_WAIT_STEP)
+
+    def _connection(self, key, timeout):
+        ''' Returns (connection, reused) '''
+        connect, read = timeouts(timeout)
+        stale = []
+        with self.lock:
+            idle = self.idle.get(key)
+            while idle:
+                conn, released = idle.pop()
+                if time.time() - released > IDLE_TIMEOUT:
+                    stale.append(conn)
+                    continue
+                conn.sock.settimeout(read)
+                return conn, True
+        for conn in stale:
+            conn.close()
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = _HTTPSConnection(host, port, timeout=connect)
+        else:
+            conn = _HTTPConnection(host, port, timeout=connect)
+        conn.readTimeout = read
+        return conn, False
+
+    def _release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append((conn, time.time()))
+
+    def _request(self, method, url, data, headers, timeout):
+        key = self._key(url)
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(headers)
+        if data is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        slot = self._slot(key)
+        self._acquire(slot, timeout)
+        try:
+            while True:
+                conn, reused = self._connection(key, timeout)
+                answered = False
+                try:
+                    conn.request(method, path, data, headers)
+                    response = conn.getresponse()
+                    answered = True
+                    body = response.read()
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    if reused and not answered and method in IDEMPOTENT_METHODS and self._closedByServer(e):
+                        # The server closed the kept-alive connection meanwhile, try a new one
+                        log.debug("Connection to %s was closed, reconnecting" % parts.netloc)
+                        continue
+                    raise urllib2.URLError(e)
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release(key, conn)
+                result = Response(url, response.status, response.reason, dict(response.getheaders()), body)
+                result.msg = response.msg
+                return result
+        finally:
+            slot.release()
+
+    def _closedByServer(self, error):
+        ''' Whether error means the server closed the connection before answering '''
+        if isinstance(error, httplib.BadStatusLine):
+            return True
+        return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+    def close(self):
+        ''' Closes all the idle connections '''
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, released in conns:
+                conn.close()
+
+
+_pool = ConnectionPool()
+
+def request(method, url, data=None, headers=None, timeout=None):
+    ''' Sends a request through the connection pool shared by every plugin, see ConnectionPool.request '''
+    return _pool.request(method, url, data, headers, timeout)
+
+def urlopen(url, data=None, headers=None, timeout=None):
+    ''' urllib2.urlopen going through the connection pool shared by every plugin '''
+    return _pool.urlopen(url, data, headers, timeout)
+
+
+class XMLRPCTransport(xmlrpclib.Transport):
+    ''' xmlrpclib transport honouring the timeouts and the deadline of the calling thread.
+    It keeps its connection alive between calls and asks for gzipped responses. Requests
+    larger than gzipThreshold bytes are gzipped too, until the server refuses one with a
+    GZIP_REFUSED_CODES status.
+    Unlike xmlrpclib, a call is never sent twice since the server may have run it: a
+    connection idle more than IDLE_TIMEOUT seconds is replaced before sending instead. '''
+
+    def __init__(self, timeout=None, https=False, gzipThreshold=None):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+        self.https = https
+        self.encode_threshold = gzipThreshold
+        self.lastUsed = 0
+        _xmlrpcTransports.add(self)
+
+    def make_connection(self, host):
+        connect, read = timeouts(self.timeout)
+        if self._connection and host == self._connection[0]:
+            conn = self._connection[1]
+        else:
+            chost, self._extra_headers, x509 = self.get_host_info(host)
+            conn = self.https and _HTTPSConnection(chost) or _HTTPConnection(chost)
+            self._connection = host, conn
+        conn.timeout, conn.readTimeout = connect, read
+        if conn.sock:
+            conn.sock.settimeout(read)
+        return conn
+
+    def request(self, host, handler, request_body, verbose=0):
+        try:
+            try:
+                return self._send(host, handler, request_body, verbose)
+            except xmlrpclib.ProtocolError, e:
+                if self.encode_threshold is None or len(request_body) <= self.encode_threshold \
+                        or e.errcode not in GZIP_REFUSED_CODES:
+                    raise
+                log.debug("%s%s refused a gzipped request (%s), sending them uncompressed" % (host, handler, e.errcode))
+                self.encode_threshold = None
+                return self._send(host, handler, request_body, verbose)
+        except DeadlineExpired:
+            raise
+        except Exception:
+            recordFailure()
+            raise
+
+    def _send(self, host, handler, request_body, verbose):
+        if time.time() - self.lastUsed > IDLE_TIMEOUT:
+            self.close()
+        try:
+            return self.single_request(host, handler, request_body, verbose)
+        finally:
+            self.lastUsed = time.time()
+
+    def parse_response(self, response):
+        ''' Reads and decodes the whole body at once, then unmarshalls it with loadResponse
+        instead of decoding and parsing it by blocks of 1 KiB '''
+        body = decodeBody(response.read(), response.getheader("Content-Encoding"))
+        return loadResponse(body)
+
+def _struct(elem):
+    return dict([ (member.findtext('name'), _value(member.find('value'))) for member in elem ])
+
+def _array(elem):
+    return [ _value(value) for value in elem.find('data') ]
+
+def _base64(elem):
+    binary = xmlrpclib.Binary()
+    binary.decode(elem.text or '')
+    return binary
+
+_unmarshallers = {
+    'string' : lambda elem: elem.text or '',
+    'int' : lambda elem: int(elem.text),
+    'i4' : lambda elem: int(elem.text),
+    'i8' : lambda elem: int(elem.text),
+    'boolean' : lambda elem: elem.text.strip() == '1',
+    'double' : lambda elem: float(elem.text),
+    'nil' : lambda elem: None,
+    'dateTime.iso8601' : lambda elem: xmlrpclib.DateTime(elem.text.strip()),
+    'base64' : _base64,
+    'struct' : _struct,
+    'array' : _array,
+}
+
+def _value(elem):
+    if not len(elem):
+        return elem.text or ''
+    typed = elem[0]
+    try:
+        unmarshaller = _unmarshallers[typed.tag]
+    except KeyError:
+        raise xmlrpclib.ResponseError("unknown tag %r" % typed.tag)
+    return unmarshaller(typed)
+
+def loadResponse(body):
+    ''' Returns the params of an XML-RPC response like xmlrpclib.loads, raising
+    xmlrpclib.Fault for a fault. The document is parsed by cElementTree, which is several
+    times faster than the pure Python unmarshaller of xmlrpclib on large responses. '''
+    root = cElementTree.fromstring(body)
+    fault = root.find('fault')
+    if fault is not None:
+        raise xmlrpclib.Fault(**_value(fault.find('value')))
+    return tuple([ _value(param.find('value')) for param in root.find('params') ])
+
+_xmlrpcTransports = weakref.WeakSet()
+
+def xmlrpcServer(url, timeout=None, gzipThreshold=None):
+    ''' Returns an xmlrpclib.ServerProxy for url, see XMLRPCTransport '''
+    transport = XMLRPCTransport(timeout, urlparse.urlsplit(url).scheme == 'https', gzipThreshold)
+    return xmlrpclib.ServerProxy(url, transport)
+
+
+class _FakeSocket(object):
+    ''' Lets httplib.HTTPResponse parse a response which has already been received '''
+    def __init__(self, data):
+        self.data = data
+    def makefile(self, *args, **kwargs):
+        return StringIO(self.data)
+
+
+def _parseResponse(url, data):
+    response = httplib.HTTPResponse(_FakeSocket(data))
+    response.begin()
+    body = response.read()
+    headers = dict(response.getheaders())
+    body = decodeBody(body, headers.get('content-encoding'))
+    result = Response(url, response.status, response.reason, headers, body)
+    if response.status >= 400:
+        result.error = urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(body))
+    return result
+
+
+class _HTTPDispatcher(asyncore.dispatcher):
+    ''' One HTTP/1.1 request over a fresh non-blocking connection to address, the IP of
+    the host of url, closed by the server once the response is sent '''
+
+    def __init__(self, client, url, address, data, headers, timeout, callback, redirects=0, cancel=None):
+        asyncore.dispatcher.__init__(self, map=client.map)
+        self.client = client
+        self.url = url
+        self.data = data
+        self.headers = headers
+        self.timeout = timeout
+        self.callback = callback
+        self.redirects = redirects
+        self.cancel = cancel
+        self.inbuf = []
+        self.finished = False
+        self.deadline = timeout and time.time() + timeout
+
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        port = parts.port or 80
+        lines = [ "%s %s HTTP/1.1" % (data is None and 'GET' or 'POST', path),
+                  "Host: %s" % parts.netloc,
+                  "Connection: close",
+                  "Accept-Encoding: gzip, deflate" ]
+        allheaders = { 'User-Agent' : USER_AGENT }
+        allheaders.update(headers or {})
+        if data is not None:
+            allheaders.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+            allheaders['Content-Length'] = str(len(data))
+        lines += [ "%s: %s" % item for item in allheaders.items() ]
+        self.outbuf = "\r\n".join(lines) + "\r\n\r\n" + (data or '')
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((address, port))
+        if cancel:
+            cancel.onCancel(lambda: client.abort(self))
+
+    def writable(self):
+        return not self.connected or len(self.outbuf) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.inbuf.append(data)
+
+    def handle_close(self):
+        self.close()
+        try:
+            response = _parseResponse(self.url, ''.join(self.inbuf))
+        except Exception, e:
+            self.fail(urllib2.URLError("Invalid HTTP response: %s" % e))
+            return
+        location = response.headers.get('location')
+        if response.status in REDIRECT_CODES and location and self.redirects < MAX_REDIRECTS:
+            self.finished = True
+            location = urlparse.urljoin(self.url, location)
+            log.debug("Following redirection %s -> %s" % (self.url, location))
+            remaining = self.deadline and max(0.001, self.deadline - time.time())
+            self.client._start(location, None, self.headers, remaining, self.callback, self.redirects + 1, self.cancel)
+            return
+        self.done(response)
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self.fail(urllib2.URLError(error))
+
+    def checkTimeout(self, now):
+        if self.cancel and self.cancel.expired():
+            self.abort()
+        elif self.deadline and now > self.deadline and not self.finished:
+            self.close()
+            self.fail(urllib2.URLError(socket.timeout("timed out")))
+
+    def abort(self):
+        ''' Drops the request, its deadline was cancelled or expired '''
+        if not self.finished:
+            self.close()
+            self.fail(DeadlineExpired())
+
+    def fail(self, error):
+        self.done(Response(self.url, error=error))
+
+    def done(self, response):
+        if self.finished:
+            return
+        self.finished = True
+        if response.error:
+            log.warning("Error while downloading %s: %s" % (self.url, response.error))
+        try:
+            self.callback(response)
+        except Exception, e:
+            log.error("Error raised by the callback of %s: %s" % (self.url, e))
+            log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+class _Waker(asyncore.file_dispatcher):
+    ''' Interrupts the select() of the event loop when a request is queued from another thread '''
+
+    def __init__(self, map):
+        self.readfd, self.writefd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.readfd, map=map)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(512)
+        except OSError:
+            pass
+
+    def wake(self):
+        try:
+            os.write(self.writefd, 'x')
+        except OSError:
+            pass
+
+
+class AsyncHTTPClient(object):
+    ''' Runs HTTP requests on a single event loop thread. fetch() can be called from
+    any thread; callbacks are called from the event loop thread, so they must not
+    block. asyncore cannot do TLS: https requests are run through the ConnectionPool
+    by at most maxBlocking helper threads. The helpers also resolve the host names,
+    which would block the loop, and their addresses are kept ADDRESS_TTL seconds. '''
+
+    def __init__(self, maxBlocking=4):
+        self.map = {}
+        self.queue = Queue()
+        self.aborted = Queue()
+        self.blocking = Queue()
+        self.maxBlocking = maxBlocking
+        self.helpers = []
+        self.addresses = {} # (host, port) -> (address, time it expires)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.waker = None
+        self.closing = False
+
+    def fetch(self, url, callback, data=None, headers=None, timeout=None):
+        ''' Downloads url (POSTing data if given) and calls callback(response). The
+        whole request must complete before the read timeout, which is bounded by the
+        deadline of the calling thread, which also counts the failure of the request.
+        The request is aborted as soon as that deadline is cancelled. '''
+        try:
+            timeout = timeouts(timeout)[1]
+        except DeadlineExpired, e:
+            callback(Response(url, error=e))
+            return
+        current = currentDeadline()
+        if current:
+            def callback(response, callback=callback):
+                if isFailure(response.error):
+                    recordFailure(current)
+                callback(response)
+        if urlparse.urlsplit(url).scheme != 'http':
+            self._runBlocking(self._fetchBlocking, url, callback, data, headers, timeout, current)
+            return
+        self.queue.put((url, data, headers, timeout, callback, 0, current))
+        self._ensureRunning()
+
+    def abort(self, dispatcher):
+        ''' Has the event loop drop the request of dispatcher '''
+        self.aborted.put(dispatcher)
+        with self.lock:
+            if self.waker:
+                self.waker.wake()
+
+    def _runBlocking(self, function, *args):
+        ''' Has a helper thread call function(*args) '''
+        self.blocking.put((function, args))
+        with self.lock:
+            if len(self.helpers) < self.maxBlocking:
+                helper = threading.Thread(target=self._helper, name="periscope-http-helper-%d" % len(self.helpers))
+                helper.setDaemon(True)
+                self.helpers.append(helper)
+                helper.start()
+
+    def _helper(self):
+        while True:
+            request = self.blocking.get()
+            if request is None:
+                return
+            function, args = request
+            function(*args)
+
+    def _address(self, host, port):
+        ''' Returns the known address of host, None if it must be resolved '''
+        with self.lock:
+            address, expires = self.addresses.get((host, port), (None, 0))
+        if time.time() < expires:
+            return address
+        return None
+
+    def _resolve(self, host, port, request):
+        ''' Resolves host on a helper thread, then queues request on the event loop '''
+        url, data, headers, timeout, callback, redirects, cancel = request
+        start = time.time()
+        try:
+            address = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+        except Exception, e:
+            callback(Response(url, error=urllib2.URLError(e)))
+            return
+        with self.lock:
+            self.addresses[(host, port)] = (address, time.time() + ADDRESS_TTL)
+            if threading.currentThread() not in self.helpers:
+                return # The client was closed meanwhile, the request is dropped
+        if timeout:
+            timeout = max(0.001, timeout - (time.time() - start))
+        self.queue.put((url, data, headers, timeout, callback, redirects, cancel))
+        self._ensureRunning()
+
+    def _fetchBlocking(self, url, callback, data, headers, timeout, cancel=None):
+        try:
+            with deadline(None, cancel):
+                response = _pool.request(data is None and 'GET' or 'POST', url, data, headers, timeout)
+        except urllib2.HTTPError, e:
+            response = Response(url, e.code, e.msg, error=e)
+        except (urllib2.URLError, socket.error), e:
+            response = Response(url, error=urllib2.URLError(e))
+        callback(response)
+
+    def close(self):
+        ''' Stops the event loop, the outstanding requests are dropped '''
+        with self.lock:
+            thread, self.thread = self.thread, None
+            helpers, self.helpers = self.helpers, []
+            self.closing = True
+        for helper in helpers:
+            self.blocking.put(None)
+        if thread:
+            self.waker.wake()
+            thread.join()
+            for dispatcher in self.map.values():
+                dispatcher.close()
+            os.close(self.waker.writefd)
+        self.closing = False
+
+    def _ensureRunning(self):
+        with self.lock:
+            if not self.thread:
+                self.waker = _Waker(self.map)
+                self.thread = threading.Thread(target=self._loop, name="periscope-http-loop")
+                self.thread.setDaemon(True)
+                self.thread.start()
+        self.waker.wake()
+
+    def _start(self, url, data, headers, timeout, callback, redirects=0, cancel=None):
+        try:
+            parts = urlparse.urlsplit(url)
+            host, port = parts.hostname, parts.port or 80
+            if not host:
+                raise urllib2.URLError("no host given")
+            address = self._address(host, port)
+            if not address:
+                self._runBlocking(self._resolve, host, port, (url, data, headers, timeout, callback, redirects, cancel))
+                return
+            _HTTPDispatcher(self, url, address, data, headers, timeout, callback, redirects, cancel)
+        except Exception, e:
+            log.warning("Could not start request %s: %s" % (url, e))
+            callback(Response(url, error=urllib2.URLError(e)))
+
+    def _loop(self):
+        while not self.closing:
+            while True:
+                try:
+                    request = self.queue.get_nowait()
+                except Empty:
+                    break
+                self._start(*request)
+            while True:
+                try:
+                    self.aborted.get_nowait().abort()
+                except Empty:
+                    break
+            asyncore.loop(timeout=0.5, map=self.map, count=1)
+            now = time.time()
+            for dispatcher in self.map.values():
+                if isinstance(dispatcher, _HTTPDispatcher):
+                    dispatcher.checkTimeout(now)
+
+
+_asyncClient = None
+_asyncClientLock = threading.Lock()
+
+def close():
+    ''' Closes the kept-alive connections and stops the shared event loop '''
+    _pool.close()
+    for transport in list(_xmlrpcTransports):
+        transport.close()
+    with _asyncClientLock:
+        if _asyncClient:
+            _asyncClient.close()
+
+def asyncClient():
+    ''' Returns the AsyncHTTPClient shared by every plugin '''
+    global _asyncClient
+    with _asyncClientLock:
+        if not _asyncClient:
+            _asyncClient = AsyncHTTPClient()
+        return _asyncClient
@@ -7,7 +7,6 @@ import logging
 
 import zipfile, os, urllib2
 import os, re, BeautifulSoup, urllib
-import guessit
 from lxml import etree
 
 log = logging.getLogger(__name__)
@@ -257,38 +256,31 @@ def simpleMatch(string, regexp):
     except IndexError:
         raise Exception("'%s' Does not match regexp '%s'" % (string, regexp))
 
-def levenshtein(a, b):
-    if not a: return len(b)
-    if not b: return len(a)
-
-    m = len(a)
-    n = len(b)
-    d = []
-    for i in range(m+1):
-        d.append([0] * (n+1))
-
-    for i in range(m+1):
-        d[i][0] = i
-
-    for j in range(n+1):
-        d[0][j] = j
-
-    for i in range(1, m+1):
-        for j in range(1, n+1):
-            if a[i-1] == b[j-1]:
-                cost = 0
-            else:
-                cost = 1
-
-            d[i][j] = min(d[i-1][j] + 1,     # deletion
-                          d[i][j-1] + 1,     # insertion
-                          d[i-1][j-1] + cost # substitution
-                          )
-
-    return d[m][n]
-
-
 import SubtitleDatabase
+import Transport
+import ShowIndex
+import PageCache
+
+# Known shows, completed with the ones returned by the searches on the site
+showIndex = ShowIndex.ShowIndex(showNum.items())
+learnedShows = ShowIndex.LearnedShows(showIndex, ShowIndex.cachePath("tvsubtitles_shows.cache"))
+# (show id, season) -> { episode number : episode id }, shared by every search of a run
+seasonCache = PageCache.PageCache(ttl=3600)
+
+EPISODE_NUMBER_REGEX = re.compile(r'([0-9]+)x([0-9]{2})')
+EPISODE_LINK_REGEX = re.compile(r'episode-([0-9]+)\.html')
+
+def parseSeasonPage(seasonHtml):
+    ''' Returns { episode number : episode id } from the rows of a season page '''
+    episodes = {}
+    for row in seasonHtml.split('</tr>'):
+        number = EPISODE_NUMBER_REGEX.search(row)
+        if not number:
+            continue
+        link = EPISODE_LINK_REGEX.search(row, number.end())
+        if link:
+            episodes.setdefault(int(number.group(2)), int(link.group(1)))
+    return episodes
 
 class TvSubtitles(SubtitleDatabase.SubtitleDB):
 	url = "http://www.tvsubtitles.net"
@@ -307,7 +299,7 @@ class TvSubtitles(SubtitleDatabase.SubtitleDB):
         # NOTE: uses lxml at the moment
         def getLikelyShowUrl(self, name):
                 data = urllib.urlencode({ 'q': name })
-                html = etree.HTML(urllib2.urlopen(self.url + '/search.php', data).read())
+                html = etree.HTML(Transport.urlopen(self.url + '/search.php', data).read())
                 matches = [ s.find('a') for s in html.findall(".//div[@style='']") ]
 
                 # add baseUrl and remove year information
@@ -316,49 +308,51 @@ class TvSubtitles(SubtitleDatabase.SubtitleDB):
                         seriesID = int(match.get('href').split('-')[1].split('.')[0]) # remove potential season number
                         seriesUrl = self.url + '/tvshow-%d.html' % seriesID
                         title = match.text
-                        try:
-                                idx = title.find('(') - 1
-                                title = title[:idx]
-                        except: pass
+                        if title.find('(') > 0:
+                                title = title[:title.find('(')].strip()
 
-                        result.append({ 'title': title, 'url': seriesUrl })
+                        # name keeps the "(US)" or year which tells apart the shows of the same title
+                        result.append({ 'title': title, 'name': match.text, 'url': seriesUrl, 'id': seriesID })
 
                 if not matches:
-                        raise SmewtException("Couldn't find any matching series for '%s'" % name)
+                        raise Exception("Couldn't find any matching series for '%s'" % name)
 
                 return result
 
 
-        #@cachedmethod
         def getShowId(self, name):
-                name = name.lower()
-                showId = showNum.get(name, None)
+                showId = showIndex.lookup(name)
                 if showId:
                         log.debug("Show ID cached value for %s: %d" % (name, showId))
                         return showId
 
-
                 # get most likely one if more than one found
                 # FIXME: this hides another potential bug which is that tvsubtitles returns a lot of
                 # false positives that it doesn't return when using from a "normal" webbrowser...
-                urls = [ (levenshtein(s['title'].lower(), name), s) for s in self.getLikelyShowUrl(name) ]
-                url = sorted(urls)[0][1]['url']
-                result = int(simpleMatch(url, 'tvshow-(.*?).html'))
+                shows = self.getLikelyShowUrl(name)
+                learnedShows.learn([ (show['name'], show['id']) for show in shows ])
+                key = ShowIndex.normalize(name)
+                def score(show):
+                        return max([ ShowIndex.similarity(ShowIndex.normalize(title), key) for title in (show['name'], show['title']) ])
+                result = max(shows, key=score)['id']
 
                 log.debug('Found show ID for %s: %d' % (name, result))
                 return result
 
 
-        #@cachedmethod
+        def getSeasonEpisodes(self, showID, season):
+                ''' Returns { episode number : episode id } for a season, downloading and parsing
+                its page once for all the episodes '''
+                def parse():
+                        seasonHtml = Transport.urlopen(self.URL_SEASON_PATTERN % (showID, season)).read()
+                        return parseSeasonPage(seasonHtml)
+                return seasonCache.get((showID, season), parse)
+
         def getEpisodeId(self, show, season, episode):
                 showID = self.getShowId(show)
-                seasonHtml = urllib2.urlopen(self.URL_SEASON_PATTERN % (showID, season)).read()
-                try:
-                        episodeRowHtml = between(seasonHtml, '%dx%02d' % (season, episode), '</tr>')
-                except IndexError:
-                        raise Exception("Season %d Episode %d unavailable for series '%s'" % (season, episode, series))
-
-                result = int(simpleMatch(episodeRowHtml, 'episode-(.*?).html'))
+                result = self.getSeasonEpisodes(showID, season).get(episode)
+                if result is None:
+                        raise Exception("Season %d Episode %d unavailable for series '%s'" % (season, episode, show))
 
                 log.debug('Found episode ID for %s %dx%2d: %d' % (show, season, episode, result))
                 return result
@@ -369,7 +363,7 @@ class TvSubtitles(SubtitleDatabase.SubtitleDB):
                 episodeId = self.getEpisodeId(show, season, episode)
 
                 episodeURL = self.URL_EPISODE_PATTERN % episodeId
-                episodeHtml = urllib2.urlopen(episodeURL).read()
+                episodeHtml = Transport.urlopen(episodeURL).read()
 
                 episodeHtml = between(episodeHtml, '<b>Subtitles for this episode:</b>', '<br clear=all>')
                 ehtml = etree.HTML(episodeHtml)
@@ -400,7 +394,7 @@ class TvSubtitles(SubtitleDatabase.SubtitleDB):
 		''' main method to call on the plugin, pass the filename and the wished
 		languages and it will query TvSubtitles.net '''
 
-                guessedData = guessit.guess_video_info(filename)
+                guessedData = self.videoInfo(filename).guess
                 log.debug(filename)
 
 		if guessedData['type'] == 'episode':
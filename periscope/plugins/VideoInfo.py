@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import re
+import copy
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ('.avi', '.wmv', '.mov', '.mp4', '.mpeg', '.mpg', '.mkv')
+
+TVSHOW_REGEX = re.compile('(?P<show>.*)S(?P<season>[0-9]{2})E(?P<episode>[0-9]{2}).(?P<teams>.*)', re.IGNORECASE)
+TVSHOW_REGEX2 = re.compile('(?P<show>.*).(?P<season>[0-9]{1,2})x(?P<episode>[0-9]{1,2}).(?P<teams>.*)', re.IGNORECASE)
+MOVIE_REGEX = re.compile('(?P<movie>.*)[\.|\[|\(| ]{1}(?P<year>(?:(?:19|20)[0-9]{2}))(?P<teams>.*)', re.IGNORECASE)
+
+# Show.Name[.Year].S01E02[.anything][-GROUP] and Show.Name[.Year].1x02[.anything][-GROUP]
+EPISODE_REGEX = re.compile(r'^(?P<series>[^\W_](?:[\w\'&]|[. _-](?=[\w\'&]))*?)'
+                           r'(?:[. _-]+\(?(?P<year>(?:19|20)[0-9]{2})\)?)?'
+                           r'[. _-]+(?:S(?P<season>[0-9]{1,2})E(?P<episode>[0-9]{2,3})|(?P<season2>[0-9]{1,2})x(?P<episode2>[0-9]{2}))'
+                           r'(?P<rest>[. _-].*)?$', re.IGNORECASE | re.UNICODE)
+GROUP_REGEX = re.compile(r'-(?P<group>[^\W_]+)$', re.UNICODE)
+# Names the fast path leaves to guessit: several episodes, episode ranges, parts or a
+# year after the episode
+AMBIGUOUS_REGEX = re.compile(r'^[. _-]*(?:E[0-9]{2}|-[0-9]{2}\b|x[0-9]{2}|part|pt|cd[0-9]|(?:19|20)[0-9]{2}(?![0-9]))', re.IGNORECASE)
+# Ends guessit reads another group from: -GROUP-sample, tags in brackets like -GROUP[eztv]
+TAIL_REGEX = re.compile(r'-[^\W_]+-[^\W_]+$|[][(){}]', re.UNICODE)
+# Words after the last dash which are not the release group (WEB-DL, -sample)
+NOT_GROUPS = frozenset([ u'dl', u'sample', u'internal' ])
+
+def getFileName(filepath):
+    ''' Returns the name of the file without its folder nor its video extension '''
+    if os.path.isfile(filepath):
+        filename = os.path.basename(filepath)
+    else:
+        filename = filepath
+    if filename.endswith(VIDEO_EXTENSIONS):
+        fname = filename.rsplit('.', 1)[0]
+    else:
+        fname = filename
+    return fname
+
+def guessFileData(filename):
+    ''' Guesses the show, season, episode and teams (or the movie, year, part and teams)
+    from the name of the file with the regexes above '''
+    filename = unicode(getFileName(filename).lower())
+    for regex in (TVSHOW_REGEX, TVSHOW_REGEX2):
+        matches_tvshow = regex.match(filename)
+        if matches_tvshow: # It looks like a tv show
+            (tvshow, season, episode, teams) = matches_tvshow.groups()
+            tvshow = tvshow.replace(".", " ").strip()
+            teams = teams.split('.')
+            return {'type' : 'tvshow', 'name' : tvshow.strip(), 'season' : int(season), 'episode' : int(episode), 'teams' : teams}
+    matches_movie = MOVIE_REGEX.match(filename)
+    if matches_movie:
+        (movie, year, teams) = matches_movie.groups()
+        teams = teams.split('.')
+        part = None
+        if "cd1" in teams :
+            teams.remove('cd1')
+            part = 1
+        if "cd2" in teams :
+            teams.remove('cd2')
+            part = 2
+        return {'type' : 'movie', 'name' : movie.strip(), 'year' : year, 'teams' : teams, 'part' : part}
+    return {'type' : 'unknown', 'name' : filename, 'teams' : [] }
+
+
+def fastGuess(filepath):
+    ''' Parses the common Show.Name.S01E02.720p.HDTV.x264-GROUP.mkv names with the regexes
+    above, giving the fields of guessit used by the plugins: type, series, season,
+    episodeNumber and releaseGroup. Returns None when the name is not one of these, has a
+    year next to the episode (guessit may then take the year for the series) or could be
+    read in several ways, guessit must then be used. '''
+    filename = os.path.basename(filepath)
+    if filename.lower().endswith(VIDEO_EXTENSIONS):
+        filename = filename.rsplit('.', 1)[0]
+    match = EPISODE_REGEX.match(filename)
+    if not match:
+        return None
+    rest = match.group('rest') or ''
+    if match.group('year') or AMBIGUOUS_REGEX.match(rest) or TAIL_REGEX.search(rest):
+        return None
+    series = re.sub(r'[._]', ' ', match.group('series')).strip()
+    if not series or series.isdigit():
+        return None
+    guess = { 'type' : u'episode', 'series' : unicode(series),
+              'season' : int(match.group('season') or match.group('season2')),
+              'episodeNumber' : int(match.group('episode') or match.group('episode2')) }
+    group = GROUP_REGEX.search(rest)
+    if group:
+        if group.group('group').lower() in NOT_GROUPS:
+            return None
+        guess['releaseGroup'] = unicode(group.group('group'))
+    return guess
+
+
+class VideoInfo(object):
+    ''' What periscope knows about a video from its name: the guessFileData dict and
+    the guessit guess, each computed at most once. It is shared by every plugin through
+    videoInfo(), so its accessors return copies that the plugins are free to modify. '''
+
+    __slots__ = ('filename', '_fileData', '_guess', '_lock')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fileData = None
+        self._guess = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<VideoInfo %s>" % self.filename
+
+    @property
+    def fileData(self):
+        with self._lock:
+            if self._fileData is None:
+                self._fileData = guessFileData(self.filename)
+            return copy.deepcopy(self._fileData)
+
+    @property
+    def guess(self):
+        ''' The result of guessit.guess_video_info as a dict, or of fastGuess when it
+        recognizes the name '''
+        with self._lock:
+            if self._guess is None:
+                self._guess = fastGuess(self.filename)
+            if self._guess is None:
+                import guessit # Slow to import, only load it when a plugin needs it
+                self._guess = dict(guessit.guess_video_info(self.filename))
+            return copy.deepcopy(self._guess)
+
+
+_memo = OrderedDict()
+_memoLock = threading.Lock()
+MEMO_SIZE = 1024
+
+def videoInfo(filename):
+    ''' Returns the VideoInfo of filename, shared with the other recent callers '''
+    with _memoLock:
+        info = _memo.pop(filename, None)
+        if not info:
+            info = VideoInfo(filename)
+        _memo[filename] = info
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+        return info
@@ -1,6 +1,10 @@
 import unittest
 import logging
 import os
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
 
 logging.basicConfig(level=logging.DEBUG)
 '''
@@ -218,5 +222,794 @@ class BierDopjeTestCase(unittest.TestCase):
 '''
 
 
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Serves canned answers to the offline tests '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        import gzip, time, urlparse
+        from cStringIO import StringIO
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        headers = {}
+        if path == '/drop':
+            return self.drop()
+        status, body = 200, 'ok'
+        if path == '/slow':
+            time.sleep(0.3)
+            body = 'slow %s' % params.get('n')
+        elif path == '/gzip':
+            buf = StringIO()
+            zf = gzip.GzipFile(fileobj=buf, mode='wb')
+            zf.write('compressed ' * 100)
+            zf.close()
+            body = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        elif path == '/redirect':
+            status, body = 302, ''
+            headers['Location'] = '/gzip'
+        elif path == '/subdb' and params.get('action') == 'search':
+            body = 'en,fr'
+        elif path == '/subdb' and params.get('action') == 'download':
+            body = '1\n00:00:01,000 --> 00:00:02,000\nHello %s\n' % params.get('language')
+        else:
+            status, body = 404, 'not found'
+        self.send_response(status)
+        for header in headers.items():
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        import gzip, xmlrpclib
+        from cStringIO import StringIO
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/drop':
+            return self.drop()
+        requestEncoding = self.headers.get('Content-Encoding')
+        self.server.posts.append((self.path, requestEncoding))
+        status, headers = 200, {}
+        if requestEncoding == 'gzip' and self.path == '/plain-xmlrpc':
+            status, body = 415, 'gzip not supported'
+        elif self.path == '/busy-xmlrpc':
+            status, body = 503, 'try again later'
+        else:
+            if requestEncoding == 'gzip':
+                body = gzip.GzipFile(fileobj=StringIO(body)).read()
+            params, method = xmlrpclib.loads(body)
+            body = xmlrpclib.dumps(({ 'status' : '200 OK', 'method' : method, 'data' : params[0] },), methodresponse=True)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                buf = StringIO()
+                zf = gzip.GzipFile(fileobj=buf, mode='wb')
+                zf.write(body)
+                zf.close()
+                body = buf.getvalue()
+                headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for header in headers.items():
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def drop(self):
+        ''' Closes the connection without answering '''
+        self.server.drops.append(self.command)
+        self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.posts = []
+        self.drops = []
+
+def startStubServer():
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server, self.base = startStubServer()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def testKeepAlive(self):
+        import urllib2
+        import Transport
+        pool = Transport.ConnectionPool()
+        for i in range(5):
+            self.assertEqual(pool.urlopen(self.base + '/redirect').read(), 'compressed ' * 100)
+        self.assertEqual(self.server.connections, 1)
+        try:
+            pool.urlopen(self.base + '/missing')
+            self.fail("No HTTPError raised")
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+        pool.close()
+
+    def testDeadline(self):
+        import time, urllib2
+        import Transport
+        pool = Transport.ConnectionPool()
+        start = time.time()
+        with Transport.deadline(0.1):
+            self.assertRaises(urllib2.URLError, pool.request, 'GET', self.base + '/slow')
+            self.assertRaises(Transport.DeadlineExpired, pool.request, 'GET', self.base + '/gzip')
+        self.assert_(time.time() - start < 0.3)
+        pool.close()
+
+    def testMaxPerHost(self):
+        import time
+        import Transport
+        pool = Transport.ConnectionPool(maxPerHost=2)
+        threads = [ threading.Thread(target=pool.request, args=('GET', '%s/slow?n=%d' % (self.base, i))) for i in range(6) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.connections, 2)
+        pool.close()
+
+    def testSlotDeadline(self):
+        import time
+        import Transport
+        pool = Transport.ConnectionPool(maxPerHost=1)
+        busy = threading.Thread(target=pool.request, args=('GET', self.base + '/slow'))
+        busy.start()
+        time.sleep(0.05)
+        start = time.time()
+        with Transport.deadline(0.1):
+            self.assertRaises(Transport.DeadlineExpired, pool.request, 'GET', self.base + '/gzip')
+        cancel = Transport.Deadline()
+        threading.Timer(0.05, cancel.cancel).start()
+        with Transport.deadline(None, cancel):
+            self.assertRaises(Transport.DeadlineExpired, pool.request, 'GET', self.base + '/gzip')
+        self.assert_(time.time() - start < 0.25)
+        busy.join()
+        pool.close()
+
+    def testNoBlindRetry(self):
+        import urllib2
+        import Transport
+        pool = Transport.ConnectionPool()
+        for method, data in (('GET', None), ('POST', 'data')):
+            pool.request('GET', self.base + '/gzip')
+            self.assertRaises(urllib2.URLError, pool.request, method, self.base + '/drop', data)
+        # A GET is sent again on a new connection, a POST is not
+        self.assertEqual(self.server.drops, [ 'GET', 'GET', 'POST' ])
+        pool.close()
+
+    def testXMLRPC(self):
+        import xmlrpclib
+        import Transport
+        server = Transport.xmlrpcServer(self.base + '/xmlrpc', timeout=5, gzipThreshold=1024)
+        for data in ('small', 'large' * 1000, 'small'):
+            self.assertEqual(server.Echo(data), { 'status' : '200 OK', 'method' : 'Echo', 'data' : data })
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual([ encoding for path, encoding in self.server.posts ], [ None, 'gzip', None ])
+        # A server refusing gzipped requests gets them uncompressed
+        del self.server.posts[:]
+        server = Transport.xmlrpcServer(self.base + '/plain-xmlrpc', timeout=5, gzipThreshold=1024)
+        for i in range(2):
+            self.assertEqual(server.Echo('large' * 1000)['data'], 'large' * 1000)
+        self.assertEqual([ encoding for path, encoding in self.server.posts ], [ 'gzip', None, None ])
+        # Other errors are not taken for a refused gzip: the call is not sent again
+        del self.server.posts[:]
+        transport = Transport.XMLRPCTransport(timeout=5, gzipThreshold=1024)
+        server = xmlrpclib.ServerProxy(self.base + '/busy-xmlrpc', transport=transport)
+        self.assertRaises(xmlrpclib.ProtocolError, server.Echo, 'large' * 1000)
+        self.assertEqual([ encoding for path, encoding in self.server.posts ], [ 'gzip' ])
+        self.assertEqual(transport.encode_threshold, 1024)
+        Transport.close()
+
+    def testLoadResponse(self):
+        import xmlrpclib
+        import Transport
+        params = ({ 'status' : '200 OK', 'data' : [ 1, 2.5, True, None, u'\xe9t\xe9', '', [], {},
+                                                    xmlrpclib.Binary('\x00\x01'), xmlrpclib.DateTime('20110504T16:28:43') ] },)
+        body = xmlrpclib.dumps(params, methodresponse=True, allow_none=True)
+        self.assertEqual(Transport.loadResponse(body), xmlrpclib.loads(body)[0])
+        body = xmlrpclib.dumps(xmlrpclib.Fault(401, 'Unauthorized'), methodresponse=True)
+        try:
+            Transport.loadResponse(body)
+            self.fail("No Fault raised")
+        except xmlrpclib.Fault, e:
+            self.assertEqual((e.faultCode, e.faultString), (401, 'Unauthorized'))
+
+class AsyncTransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server, self.base = startStubServer()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def fetchAll(self, urls):
+        import Transport
+        client = Transport.AsyncHTTPClient()
+        responses = Queue.Queue()
+        for url in urls:
+            client.fetch(url, responses.put, timeout=5)
+        try:
+            return [ responses.get(True, 10) for url in urls ]
+        finally:
+            client.close()
+
+    def testConcurrentRequests(self):
+        import time
+        start = time.time()
+        responses = self.fetchAll([ '%s/slow?n=%d' % (self.base, i) for i in range(10) ])
+        # Served sequentially this would take 3 seconds
+        self.assert_(time.time() - start < 2)
+        self.assertEqual(sorted(r.body for r in responses), sorted('slow %d' % i for i in range(10)))
+
+    def testEncodingRedirectAndErrors(self):
+        redirected, missing = self.fetchAll([ self.base + '/redirect', self.base + '/missing' ])
+        if redirected.url.endswith('missing'):
+            redirected, missing = missing, redirected
+        self.assertEqual(redirected.body, 'compressed ' * 100)
+        self.assertEqual(missing.error.code, 404)
+
+    def testCancel(self):
+        import time
+        import Transport
+        client = Transport.AsyncHTTPClient()
+        responses = Queue.Queue()
+        cancel = Transport.Deadline()
+        try:
+            with Transport.deadline(None, cancel):
+                client.fetch(self.base + '/slow', responses.put, timeout=5)
+            start = time.time()
+            time.sleep(0.05)
+            cancel.cancel()
+            response = responses.get(True, 10)
+            self.assert_(isinstance(response.error, Transport.DeadlineExpired))
+            self.assert_(time.time() - start < 0.25)
+        finally:
+            client.close()
+
+    def testResolveOffLoop(self):
+        import time, socket
+        import Transport
+        getaddrinfo = socket.getaddrinfo
+        resolving = []
+        def slowGetaddrinfo(host, *args):
+            resolving.append(threading.currentThread().getName())
+            if host == 'slow.invalid':
+                time.sleep(1)
+                host = '127.0.0.1'
+            return getaddrinfo(host, *args)
+        socket.getaddrinfo = slowGetaddrinfo
+        client = Transport.AsyncHTTPClient()
+        responses = Queue.Queue()
+        try:
+            client.fetch(self.base.replace('127.0.0.1', 'slow.invalid') + '/gzip', responses.put, timeout=5)
+            time.sleep(0.1)
+            # A slow lookup does not hold the requests to the other hosts
+            start = time.time()
+            client.fetch(self.base + '/gzip', responses.put, timeout=5)
+            first = responses.get(True, 10)
+            self.assert_(time.time() - start < 0.5)
+            self.assert_('127.0.0.1' in first.url)
+            second = responses.get(True, 10)
+            self.assertEqual(second.body, first.body)
+            # The addresses are kept, and never resolved on the event loop
+            client.fetch(self.base + '/gzip', responses.put, timeout=5)
+            responses.get(True, 10)
+            self.assertEqual(len(resolving), 2)
+            self.assert_('periscope-http-loop' not in resolving)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+            client.close()
+
+    def testBoundedHelpers(self):
+        import Transport
+        client = Transport.AsyncHTTPClient(maxBlocking=2)
+        responses = Queue.Queue()
+        # The stub server does not speak TLS, these requests fail on helper threads
+        for i in range(6):
+            client.fetch(self.base.replace('http:', 'https:') + '/gzip', responses.put, timeout=5)
+        try:
+            self.assert_(all([ responses.get(True, 10).error for i in range(6) ]))
+            self.assertEqual(len(client.helpers), 2)
+        finally:
+            client.close()
+
+    def testAsyncPlugin(self):
+        import tempfile, shutil
+        import TheSubDB, Transport
+        tmpdir = tempfile.mkdtemp()
+        try:
+            video = os.path.join(tmpdir, 'video.avi')
+            open(video, 'wb').write(os.urandom(200000))
+            subdb = TheSubDB.TheSubDB()
+            subdb.host = self.base + '/subdb'
+            results = Queue.Queue()
+            subdb.asearch(video, ['fr'], results.put)
+            subs = results.get(True, 10)
+            self.assertEqual([ s['lang'] for s in subs ], ['fr'])
+            subdb.acreateFile(subs[0], results.put)
+            subpath = results.get(True, 10)
+            self.assertEqual(subpath, os.path.join(tmpdir, 'video.srt'))
+            self.assert_('Hello fr' in open(subpath).read())
+        finally:
+            shutil.rmtree(tmpdir)
+            Transport.close()
+
+class FingerprintTestCase(unittest.TestCase):
+
+    def referenceHashes(self, path):
+        ''' The hashes as the plugins used to compute them, reading the file each time '''
+        import struct, hashlib
+        size = os.path.getsize(path)
+        f = open(path, 'rb')
+        head = f.read(65536)
+        f.seek(max(0, size - 65536))
+        tail = f.read(65536)
+        f.close()
+        total = size
+        for data in (head, tail):
+            for x in range(len(data) / 8):
+                (l_value,) = struct.unpack('q', data[x * 8:x * 8 + 8])
+                total = (total + l_value) & 0xFFFFFFFFFFFFFFFF
+        return "%016x" % total, hashlib.md5(head + tail).hexdigest()
+
+    def testHashes(self):
+        import tempfile, shutil
+        import Fingerprint, TheSubDB, OpenSubtitles
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for size in (65536 * 2, 65536 * 3 + 5, 1000003):
+                video = os.path.join(tmpdir, 'video%d.avi' % size)
+                open(video, 'wb').write(os.urandom(size))
+                fingerprint = Fingerprint.VideoFingerprint.fromFile(video)
+                opensubtitles, subdb = self.referenceHashes(video)
+                self.assertEqual(fingerprint.get('opensubtitles'), opensubtitles)
+                self.assertEqual(fingerprint.get('podnapisi'), opensubtitles)
+                self.assertEqual(fingerprint.get('thesubdb'), subdb)
+                self.assertEqual(TheSubDB.TheSubDB().get_hash(video), subdb)
+                self.assertEqual(OpenSubtitles.OpenSubtitles().hashFile(video), opensubtitles)
+            small = os.path.join(tmpdir, 'small.avi')
+            open(small, 'wb').write(os.urandom(100000))
+            fingerprint = Fingerprint.VideoFingerprint.fromFile(small)
+            self.assertEqual(fingerprint.get('opensubtitles'), None)
+            self.assert_(fingerprint.get('podnapisi') and fingerprint.get('thesubdb'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testKernels(self):
+        import struct
+        import Fingerprint
+        kernels = [ Fingerprint._sumLongsStruct ]
+        if Fingerprint.numpy is not None:
+            kernels.append(Fingerprint._sumLongsNumpy)
+        for data in ('\xff' * 65536, os.urandom(65536), os.urandom(1000) + 'abc', ''):
+            expected = 0
+            for x in range(len(data) / 8):
+                expected = (expected + struct.unpack('<q', data[x * 8:x * 8 + 8])[0]) & 0xFFFFFFFFFFFFFFFF
+            for kernel in kernels:
+                self.assertEqual(kernel(data), expected)
+
+
+class VideoInfoTestCase(unittest.TestCase):
+
+    def testSharedGuesses(self):
+        import VideoInfo, Addic7ed, TvSubtitles
+        filename = 'Dexter.S05E02.720p.HDTV.x264-IMMERSE.mkv'
+        addic7ed, tvsubtitles = Addic7ed.Addic7ed(), TvSubtitles.TvSubtitles()
+        info = addic7ed.videoInfo(filename)
+        self.assert_(tvsubtitles.videoInfo(filename) is info)
+        self.assert_(addic7ed.tvshowRegex is tvsubtitles.tvshowRegex)
+        guess = info.guess
+        self.assertEqual((guess['series'], guess['season'], guess['episodeNumber']), ('Dexter', 5, 2))
+        guess['series'] = 'changed'
+        self.assertEqual(tvsubtitles.videoInfo(filename).guess['series'], 'Dexter')
+        data = addic7ed.guessFileData(filename)
+        self.assertEqual((data['type'], data['name'], data['season'], data['episode'], data['teams']),
+                         ('tvshow', 'dexter', 5, 2, ['720p', 'hdtv', 'x264-immerse']))
+        data['teams'].remove('720p')
+        self.assertEqual(len(info.fileData['teams']), 3)
+
+    def testFastGuess(self):
+        import VideoInfo, guessit
+        for filename in ('Dexter.S05E02.720p.HDTV.x264-IMMERSE.mkv', '/tv/The.Big.Bang.Theory.S04E12.HDTV.XviD-LOL.avi',
+                         'Show Name - S01E02 - Pilot.mkv', 'Show.S01E01.HDTV-2HD.avi',
+                         'Show.S01E01.720p.WEB-DL.DD5.1.H.264-CtrlHD.mkv', 'Show.S01E01.HDTV.x264-PROPER.mkv'):
+            fast = VideoInfo.fastGuess(filename)
+            guess = guessit.guess_video_info(filename)
+            for field in ('type', 'series', 'season', 'episodeNumber', 'releaseGroup', 'year'):
+                self.assertEqual(fast.get(field), guess.get(field))
+        for filename in ('Lost.S06E17E18.HDTV.avi', '24.S08E01.HDTV.avi', 'Movie.Name.2010.720p.BluRay.x264-GRP.mkv',
+                         'Show.S01E01.720p.WEB-DL.mkv', 'Show.S01E01.HDTV.XviD-CTU-sample.avi',
+                         'Show.S01E01.HDTV.XviD-CTU[eztv].avi', 'Heroes.S04E01.2009.avi', 'V.2009.S01E01.avi',
+                         'Castle.2009.S03E01.720p.HDTV.X264-DIMENSION.mkv', 'Doctor.Who.2005.6x13.HDTV.XviD-ASAP.avi'):
+            self.assertEqual(VideoInfo.fastGuess(filename), None)
+
+
+class ShowIndexTestCase(unittest.TestCase):
+
+    def testMatch(self):
+        import ShowIndex
+        index = ShowIndex.ShowIndex([ ("brothers &amp; sisters", 66), ("grey's anatomy", 7), ("castle 2009", 12708),
+                                      ("battlestar galactica", 42), ("the office us", 10358), ("csi", 27) ])
+        self.assertEqual(index.lookup('Brothers.and.Sisters'), 66)
+        self.assertEqual(index.lookup('Greys Anatomy'), 7)
+        self.assertEqual(index.lookup('Castle'), 12708)
+        self.assertEqual(index.lookup('Castle (2009)'), 12708)
+        self.assertEqual(index.lookup('Battlestar Galatica'), 42)
+        self.assertEqual(index.lookup('The Office UK'), None)
+        self.assertEqual(index.lookup('CSI NY'), None)
+        self.assertEqual(index.lookup('Dexter'), None)
+
+    def testLearnedShows(self):
+        import tempfile, shutil
+        import ShowIndex, TvSubtitles
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'periscope', 'shows.cache')
+            ShowIndex.LearnedShows(ShowIndex.ShowIndex(), path).learn([ ('Dexter', 55), ('Fringe', 204) ])
+            index = ShowIndex.ShowIndex()
+            ShowIndex.LearnedShows(index, path)
+            self.assertEqual(index.lookup('dexter'), 55)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # Known shows do not need a search on the site
+        tvsubtitles = TvSubtitles.TvSubtitles()
+        def search(name):
+            raise AssertionError("%s should be known" % name)
+        tvsubtitles.getLikelyShowUrl = search
+        self.assertEqual(tvsubtitles.getShowId('The.Big.Bang.Theory'), TvSubtitles.showNum['the big bang theory'])
+
+        # Shows of the same title are learned apart, by their whole name on the site
+        shows = [ { 'title' : 'Shameless', 'name' : 'Shameless (US)', 'id' : 1001 },
+                  { 'title' : 'Shameless', 'name' : 'Shameless (UK)', 'id' : 1002 } ]
+        tvsubtitles.getLikelyShowUrl = lambda name: shows
+        showIndex, learnedShows = TvSubtitles.showIndex, TvSubtitles.learnedShows
+        TvSubtitles.showIndex = ShowIndex.ShowIndex()
+        TvSubtitles.learnedShows = ShowIndex.LearnedShows(TvSubtitles.showIndex, None)
+        try:
+            self.assertEqual(tvsubtitles.getShowId('Shameless.UK'), 1002)
+            tvsubtitles.getLikelyShowUrl = search
+            self.assertEqual(tvsubtitles.getShowId('Shameless.US'), 1001)
+            self.assertEqual(tvsubtitles.getShowId('Shameless.UK'), 1002)
+        finally:
+            TvSubtitles.showIndex, TvSubtitles.learnedShows = showIndex, learnedShows
+
+
+class PageCacheTestCase(unittest.TestCase):
+
+    def testSingleFlight(self):
+        import time
+        import PageCache
+        cache = PageCache.PageCache(ttl=60, maxEntries=2)
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'page'
+        results = Queue.Queue()
+        threads = [ threading.Thread(target=lambda: results.put(cache.get('key', compute))) for i in range(5) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([ results.get() for i in range(5) ], ['page'] * 5)
+        # Errors are not cached
+        def fail():
+            raise IOError("down")
+        self.assertRaises(IOError, cache.get, 'other', fail)
+        self.assertEqual(cache.get('other', lambda: 'up'), 'up')
+        # Expired and least recently used entries are computed again
+        cache.get('third', lambda: 'third')
+        self.assertEqual(cache.get('key', lambda: 'again'), 'again')
+        cache.ttl = -1
+        cache.get('expired', lambda: 'old')
+        self.assertEqual(cache.get('expired', lambda: 'new'), 'new')
+
+    def testSeasonPage(self):
+        import TvSubtitles
+        seasonHtml = ''.join([ '<tr align=middle><td>3x%02d</td><td align=left><a href="episode-%d.html"><b>Episode</b></a></td>'
+                               '<td>5/12</td></tr>' % (episode, 1000 + episode) for episode in range(1, 24) ])
+        fetched = []
+        class Page(object):
+            def read(self):
+                return seasonHtml
+        def urlopen(url):
+            fetched.append(url)
+            return Page()
+        urlopen_ = TvSubtitles.Transport.urlopen
+        TvSubtitles.Transport.urlopen = urlopen
+        TvSubtitles.seasonCache.clear()
+        try:
+            tvsubtitles = TvSubtitles.TvSubtitles()
+            for episode in range(1, 24):
+                self.assertEqual(tvsubtitles.getEpisodeId('The.Big.Bang.Theory', 3, episode), 1000 + episode)
+            self.assertRaises(Exception, tvsubtitles.getEpisodeId, 'The.Big.Bang.Theory', 3, 24)
+            self.assertEqual(len(fetched), 1)
+        finally:
+            TvSubtitles.Transport.urlopen = urlopen_
+            TvSubtitles.seasonCache.clear()
+
+    def testEpisodePage(self):
+        import Addic7ed
+        row = ('<tr><td class="NewsTitle" colspan="3"><img src="/images/folder_page.png" /> \nVersion %s, 350.00 MBs</td></tr>'
+               '<tr><td class="language">%s</td><td><b>Completed</b></td><td><a href="/original/1/%d">Download</a></td></tr>')
+        episodeHtml = '<table>%s</table>' % ''.join([ row % ('LOL', 'English', 1), row % ('DIMENSION', 'English', 2),
+                                                      row % ('LOL', 'French', 3) ])
+        fetched = []
+        addic7ed = Addic7ed.Addic7ed()
+        def downloadText(url, timeout=None):
+            fetched.append(url)
+            return episodeHtml
+        addic7ed.downloadText = downloadText
+        Addic7ed.episodePages.clear()
+        try:
+            subs = addic7ed.query('Dexter', 4, 1, ['lol'], ['en'])
+            self.assertEqual([ s['link'] for s in subs ], [ 'http://www.addic7ed.com/original/1/1' ])
+            subs = addic7ed.query('Dexter', 4, 1, ['dimension'], ['en', 'fr'])
+            self.assertEqual([ s['link'] for s in subs ], [ 'http://www.addic7ed.com/original/1/2' ])
+            subs = addic7ed.query('Dexter', 4, 1, ['lol'], ['fr'])
+            self.assertEqual([ (s['lang'], s['release']) for s in subs ], [ ('fr', 'Dexter.S04E01.lol') ])
+            self.assertEqual(len(fetched), 1)
+        finally:
+            Addic7ed.episodePages.clear()
+
+
+class FakeOpenSubtitlesServer(object):
+    ''' Answers the XML-RPC methods used by the OpenSubtitles plugin and counts them '''
+    def __init__(self):
+        self.calls = []
+        self.tokens = set()
+        self.status = None # Status of the searches, instead of 200 OK
+    def LogIn(self, *args):
+        self.calls.append('LogIn')
+        token = 'token%d' % len(self.calls)
+        self.tokens.add(token)
+        return { 'status' : '200 OK', 'token' : token }
+    def LogOut(self, token):
+        self.calls.append('LogOut')
+        self.tokens.discard(token)
+        return { 'status' : '200 OK' }
+    def NoOperation(self, token):
+        self.calls.append('NoOperation')
+        return { 'status' : token in self.tokens and '200 OK' or '406 No session' }
+    def SearchSubtitles(self, token, searches):
+        self.calls.append('SearchSubtitles')
+        if token not in self.tokens:
+            return { 'status' : '406 No session' }
+        if self.status:
+            return { 'status' : self.status }
+        data = [ { 'SubFileName' : 'video.srt', 'SubDownloadLink' : 'http://dl/%s.gz' % s['moviehash'], 'SubLanguageID' : 'eng',
+                   'MovieReleaseName' : 'video', 'MatchedBy' : 'moviehash', 'MovieHash' : s['moviehash'],
+                   'IDSubtitleFile' : str(int(s['moviehash'], 16)) } for s in searches ]
+        return { 'status' : '200 OK', 'data' : data }
+    def DownloadSubtitles(self, token, ids):
+        import gzip, base64, StringIO
+        self.calls.append('DownloadSubtitles')
+        if token not in self.tokens:
+            return { 'status' : '406 No session' }
+        data = []
+        for subid in ids:
+            if subid == '0':
+                continue
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write('subtitle %s' % subid)
+            data.append({ 'idsubtitlefile' : subid, 'data' : base64.b64encode(buf.getvalue()) })
+        return { 'status' : '200 OK', 'data' : data }
+
+class OpenSubtitlesSessionTestCase(unittest.TestCase):
+
+    def testSession(self):
+        import OpenSubtitles
+        server = FakeOpenSubtitlesServer()
+        session = OpenSubtitles.Session(OpenSubtitles.SERVER_URL)
+        session.server = lambda: server
+        opensubtitles = OpenSubtitles.OpenSubtitles()
+        opensubtitles.session = session
+        for i in range(3):
+            subs = opensubtitles.query('video', moviehash='%016x' % i, bytesize=1000, langs=['en'])
+            self.assertEqual([ s['link'] for s in subs ], [ 'http://dl/%016x.gz' % i ])
+        self.assertEqual(server.calls, [ 'LogIn' ] + [ 'SearchSubtitles' ] * 3)
+
+        # An idle token is checked, an expired one is replaced
+        del server.calls[:]
+        session.lastUse -= OpenSubtitles.KEEPALIVE + 1
+        opensubtitles.query('video', moviehash='0', bytesize=1000)
+        server.tokens.clear()
+        session.lastUse -= OpenSubtitles.KEEPALIVE + 1
+        opensubtitles.query('video', moviehash='0', bytesize=1000)
+        self.assertEqual(server.calls, [ 'NoOperation', 'SearchSubtitles', 'NoOperation', 'LogIn', 'SearchSubtitles' ])
+
+        # A token the server forgot is replaced once
+        del server.calls[:]
+        server.tokens.clear()
+        subs = opensubtitles.query('video', moviehash='0', bytesize=1000)
+        self.assertEqual(len(subs), 1)
+        self.assertEqual(server.calls, [ 'SearchSubtitles', 'LogIn', 'SearchSubtitles' ])
+        del server.calls[:]
+        server.tokens.clear()
+        self.assertEqual(len(session.call('DownloadSubtitles', [ '1' ])['data']), 1)
+        self.assertEqual(server.calls, [ 'DownloadSubtitles', 'LogIn', 'DownloadSubtitles' ])
+
+        session.logout()
+        session.logout()
+        self.assertEqual(server.calls[-1:], [ 'LogOut' ])
+        self.assertEqual(server.tokens, set())
+
+    def testBatchSearch(self):
+        import tempfile, shutil
+        import OpenSubtitles
+        server = FakeOpenSubtitlesServer()
+        opensubtitles = OpenSubtitles.OpenSubtitles()
+        opensubtitles.session = OpenSubtitles.Session(OpenSubtitles.SERVER_URL)
+        opensubtitles.session.server = lambda: server
+        tmpdir = tempfile.mkdtemp()
+        try:
+            videos = []
+            for i, size in enumerate([ 200000, 300000, 1000 ]):
+                videos.append(os.path.join(tmpdir, 'video%d.avi' % i))
+                with open(videos[-1], 'wb') as f:
+                    f.write(chr(i) * size)
+            videos.append(os.path.join(tmpdir, 'copy.avi'))
+            shutil.copy(videos[0], videos[-1])
+            results = opensubtitles.processBatch(videos, ['en'])
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(server.calls, [ 'LogIn', 'SearchSubtitles' ])
+        # The small file is left to process, the copy gets the results of its hash
+        self.assertEqual(sorted(results.keys()), sorted([ videos[0], videos[1], videos[3] ]))
+        self.assertEqual(results[videos[0]], results[videos[3]])
+        self.assertNotEqual(results[videos[0]], results[videos[1]])
+
+    def testBatchSearchErrors(self):
+        import tempfile, shutil
+        import OpenSubtitles
+        server = FakeOpenSubtitlesServer()
+        opensubtitles = OpenSubtitles.OpenSubtitles()
+        opensubtitles.session = OpenSubtitles.Session(OpenSubtitles.SERVER_URL)
+        opensubtitles.session.server = lambda: server
+        tmpdir = tempfile.mkdtemp()
+        limit = OpenSubtitles.SEARCH_ROW_LIMIT
+        try:
+            videos = []
+            for i in range(3):
+                videos.append(os.path.join(tmpdir, 'video%d.avi' % i))
+                with open(videos[-1], 'wb') as f:
+                    f.write(chr(i) * 200000)
+            # A refused search does not give the files empty results
+            server.status = '503 Service Unavailable'
+            self.assertRaises(Exception, opensubtitles.processBatch, videos, ['en'])
+            self.assertEqual(opensubtitles.searchBatch(videos, ['en']), {})
+            # The files of a search which may be truncated are searched one by one
+            server.status = None
+            OpenSubtitles.SEARCH_ROW_LIMIT = 3
+            self.assertEqual(opensubtitles.processBatch(videos, ['en']), {})
+            self.assertEqual(len(opensubtitles.processBatch(videos[:2], ['en'])), 2)
+        finally:
+            OpenSubtitles.SEARCH_ROW_LIMIT = limit
+            shutil.rmtree(tmpdir)
+
+    def testBatchDownload(self):
+        import tempfile, shutil
+        import OpenSubtitles
+        server = FakeOpenSubtitlesServer()
+        opensubtitles = OpenSubtitles.OpenSubtitles()
+        opensubtitles.session = OpenSubtitles.Session(OpenSubtitles.SERVER_URL)
+        opensubtitles.session.server = lambda: server
+        tmpdir = tempfile.mkdtemp()
+        try:
+            subtitles = [ { 'filename' : os.path.join(tmpdir, 'video%d.avi' % i), 'subfileid' : str(i) } for i in range(3) ]
+            subtitles.append({ 'filename' : os.path.join(tmpdir, 'old.avi') })
+            paths = opensubtitles.createFiles(subtitles)
+            self.assertEqual(paths, [ None, os.path.join(tmpdir, 'video1.srt'), os.path.join(tmpdir, 'video2.srt'), None ])
+            self.assertEqual(open(paths[2]).read(), 'subtitle 2')
+            # Nothing but the subtitles is written
+            self.assertEqual(sorted(os.listdir(tmpdir)), [ 'video1.srt', 'video2.srt' ])
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(server.calls, [ 'LogIn', 'DownloadSubtitles' ])
+
+
+class CreateFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile, zipfile, gzip
+        from cStringIO import StringIO
+        import SubtitleDatabase
+        self.folder = tempfile.mkdtemp()
+        buf = StringIO()
+        zf = zipfile.ZipFile(buf, 'w')
+        zf.writestr('readme.nfo', 'nfo')
+        zf.writestr('Show.S01E02.srt', 'zipped srt')
+        zf.close()
+        archive = buf.getvalue()
+        buf = StringIO()
+        zf = gzip.GzipFile(fileobj=buf, mode='wb')
+        zf.write('gzipped srt')
+        zf.close()
+        compressed = buf.getvalue()
+        buf = StringIO()
+        zf = zipfile.ZipFile(buf, 'w')
+        for episode in range(1, 4):
+            for team in ('LOL', 'DIMENSION'):
+                zf.writestr('Season 1/Show.S01E%02d.HDTV.%s.srt' % (episode, team), '%d %s' % (episode, team))
+        zf.close()
+        pack = buf.getvalue()
+        buf = StringIO()
+        zf = zipfile.ZipFile(buf, 'w')
+        zf.writestr('Movie.2010.DVDRip.CD1.srt', 'part 1')
+        zf.writestr('Movie.2010.DVDRip.CD2.srt', 'part 2')
+        zf.close()
+        pages = { 'http://x/sub.zip' : archive, 'http://x/sub.gz' : compressed, 'http://x/sub.srt' : 'plain srt',
+                  'http://x/pack' : pack, 'http://x/cds' : buf.getvalue() }
+        self.downloads = []
+        def downloadText(url, timeout=None):
+            self.downloads.append(url)
+            return pages.get(url)
+        SubtitleDatabase.archives.clear()
+        self.plugin = SubtitleDatabase.SubtitleDB(None)
+        self.plugin.downloadText = downloadText
+        self.video = os.path.join(self.folder, 'Show.S01E02.avi')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def testCreateFile(self):
+        for ext, text in (('zip', 'zipped srt'), ('gz', 'gzipped srt'), ('srt', 'plain srt')):
+            subtitle = { 'link' : 'http://x/sub.%s' % ext, 'filename' : self.video }
+            self.assertEqual(self.plugin.downloadSubtitleText(subtitle), text)
+            self.assertEqual(os.listdir(self.folder), [])
+            subpath = self.plugin.createFile(subtitle)
+            self.assertEqual(open(subpath).read(), text)
+            os.remove(subpath)
+            # Only the subtitle was written, no archive nor temporary file
+            self.assertEqual(os.listdir(self.folder), [])
+        self.assertEqual(self.plugin.createFile({ 'link' : 'http://x/missing.zip', 'filename' : self.video }), None)
+
+    def testSeasonPack(self):
+        subtitle = { 'link' : 'http://x/pack', 'forceType' : 'zip' }
+        for name, text in (('Show.S01E02.720p.HDTV.x264-DIMENSION.mkv', '2 DIMENSION'), ('Show.S01E03.HDTV.XviD-LOL.avi', '3 LOL')):
+            subpath = self.plugin.createFile(dict(subtitle, filename=os.path.join(self.folder, name)))
+            self.assertEqual(open(subpath).read(), text)
+        self.assertEqual(sorted(os.listdir(self.folder)), [ 'Show.S01E02.720p.HDTV.x264-DIMENSION.srt', 'Show.S01E03.HDTV.XviD-LOL.srt' ])
+        self.assertEqual(self.plugin.createFile(dict(subtitle, filename=os.path.join(self.folder, 'Show.S01E05.HDTV.XviD-LOL.avi'))), None)
+        self.assertEqual(self.downloads, [ 'http://x/pack' ])
+
+    def testMultiCD(self):
+        video = os.path.join(self.folder, 'Movie.2010.DVDRip.avi')
+        self.plugin.createFile({ 'link' : 'http://x/cds', 'forceType' : 'zip', 'filename' : video })
+        parts = [ open(os.path.join(self.folder, name)).read() for name in ('Movie.2010.DVDRip.srt', 'Movie.2010.DVDRip.1.srt') ]
+        self.assertEqual(sorted(parts), [ 'part 1', 'part 2' ])
+
+    def testAtomicWrite(self):
+        import stat
+        subpath = os.path.join(self.folder, 'Show.S01E02.srt')
+        self.plugin.writeFile(subpath, 'first')
+        self.plugin.writeFile(subpath, 'second')
+        self.assertEqual(open(subpath).read(), 'second')
+        self.assertEqual(os.listdir(self.folder), [ 'Show.S01E02.srt' ])
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(subpath).st_mode), 0666 & ~umask)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -199,7 +199,532 @@ class TestSubtitles(TestCase):
 
         return True
 
-suite = allTests(TestSubtitles)
+class TestWorkerPool(TestCase):
+
+    def testLimits(self):
+        import threading, time
+        import workerpool
+        pool = workerpool.WorkerPool(maxWorkers=4, maxPerKey=2)
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def work(key):
+            with lock:
+                running[key] = running.get(key, 0) + 1
+                running['all'] = running.get('all', 0) + 1
+                peaks[key] = max(peaks.get(key, 0), running[key])
+                peaks['all'] = max(peaks.get('all', 0), running['all'])
+            time.sleep(0.02)
+            with lock:
+                running[key] -= 1
+                running['all'] -= 1
+            return key
+
+        tasks = [ pool.submit(key, work, key) for key in ['a', 'b', 'c'] * 4 ]
+        for task in tasks:
+            self.assert_(task.wait(5))
+        self.assertEqual([ t.result for t in tasks ], ['a', 'b', 'c'] * 4)
+        self.assert_(peaks['all'] <= 4)
+        self.assert_(max(peaks['a'], peaks['b'], peaks['c']) <= 2)
+        self.assert_(len(pool._workers) <= 4)
+        pool.shutdown(wait=True)
+
+    def testCancelAndErrors(self):
+        import threading
+        import workerpool
+        pool = workerpool.WorkerPool(maxWorkers=1)
+        started = threading.Event()
+        release = threading.Event()
+        def block():
+            started.set()
+            release.wait(5)
+        def fail():
+            raise ValueError("boom")
+        blocking = pool.submit('a', block)
+        started.wait(5)
+        pending = pool.submit('a', fail)
+        self.assert_(pending.cancel())
+        self.assert_(pending.done() and pending.cancelled)
+        failing = pool.submit('a', fail)
+        release.set()
+        self.assert_(failing.wait(5))
+        self.assert_(isinstance(failing.exception, ValueError))
+        pool.shutdown(wait=True)
+
+
+class FakeSubtitleDB(periscope.plugins.SubtitleDatabase.SubtitleDB):
+    ''' Offline plugin returning one english subtitle per file, used to test the engine '''
+    def __init__(self):
+        super(FakeSubtitleDB, self).__init__(None)
+
+    def process(self, filepath, langs):
+        return [ { 'release': filepath, 'lang': 'en', 'link': 'http://localhost/%s.srt' % filepath, 'page': None } ]
+
+    def createFile(self, subtitle):
+        return os.path.splitext(subtitle['filename'])[0] + '.srt'
+
+class SlowFakeSubtitleDB(FakeSubtitleDB):
+    ''' Answers after 2 seconds, unless its deadline expires first like the requests of a real plugin '''
+    def process(self, filepath, langs):
+        import time
+        for i in range(200):
+            periscope.plugins.Transport.timeouts() # Raises DeadlineExpired
+            time.sleep(0.01)
+        return FakeSubtitleDB.process(self, filepath, langs)
+
+class OfflineFakeSubtitleDB(FakeSubtitleDB):
+    ''' Fails like a plugin which cannot reach its site '''
+    def process(self, filepath, langs):
+        periscope.plugins.Transport.recordFailure()
+        return []
+
+class HashFakeSubtitleDB(FakeSubtitleDB):
+    def process(self, filepath, langs):
+        subs = FakeSubtitleDB.process(self, filepath, langs)
+        subs[0]['hashMatch'] = True
+        return subs
+
+class NameFakeSubtitleDB(FakeSubtitleDB):
+    def process(self, filepath, langs):
+        subs = FakeSubtitleDB.process(self, filepath, langs)
+        subs[0]['release'] = self.getFileName(filepath)
+        return subs
+
+periscope.plugins.FakeSubtitleDB = FakeSubtitleDB
+periscope.plugins.NameFakeSubtitleDB = NameFakeSubtitleDB
+periscope.plugins.SlowFakeSubtitleDB = SlowFakeSubtitleDB
+periscope.plugins.OfflineFakeSubtitleDB = OfflineFakeSubtitleDB
+periscope.plugins.HashFakeSubtitleDB = HashFakeSubtitleDB
+
+def offlinePeriscope(pluginNames):
+    ''' Returns a Periscope using the given fake plugins, without the result cache '''
+    subdl = periscope.Periscope()
+    subdl.config.set("DEFAULT", "cache_ttl", "0")
+    subdl.pluginNames = pluginNames
+    return subdl
+
+class TestBatchDownload(TestCase):
+
+    def testDownloadSubtitles(self):
+        subdl = offlinePeriscope([ 'FakeSubtitleDB' ])
+        videos = [ 'video%d.avi' % i for i in range(20) ]
+        results = dict(subdl.downloadSubtitles(videos, [ 'en' ], window=4))
+        subdl.shutdown()
+        self.assertEqual(sorted(results.keys()), sorted(videos))
+        for video, sub in results.items():
+            self.assertEqual(sub['subtitlepath'], os.path.splitext(video)[0] + '.srt')
+
+    def testAsyncListSubtitles(self):
+        subdl = offlinePeriscope([ 'FakeSubtitleDB' ])
+        future = subdl.alistSubtitles('video.avi', [ 'en' ])
+        self.assert_(future.wait(5))
+        self.assertEqual([ s['release'] for s in future.result ], [ 'video.avi' ])
+        subdl.shutdown()
+
+    def testPluginTimeout(self):
+        import time
+        subdl = offlinePeriscope([ 'SlowFakeSubtitleDB', 'FakeSubtitleDB' ])
+        subdl.config.set("DEFAULT", "plugin_timeout", "0.2")
+        start = time.time()
+        subs = subdl.listSubtitles('video.avi', [ 'en' ])
+        self.assert_(time.time() - start < 1)
+        self.assertEqual([ s['plugin'].__class__.__name__ for s in subs ], [ 'FakeSubtitleDB' ])
+        # search_timeout is not capped by plugin_timeout
+        subdl.config.set("DEFAULT", "plugin_timeout", "5")
+        subdl.config.set("DEFAULT", "search_timeout", "0.2")
+        start = time.time()
+        subs = subdl.listSubtitles('video.avi', [ 'en' ])
+        self.assert_(time.time() - start < 1)
+        subdl.config.set("DEFAULT", "plugin_timeout", "0.2")
+        subdl.config.set("DEFAULT", "search_timeout", "5")
+        self.assertEqual(len(subdl.listSubtitles('video.avi', [ 'en' ])), 1)
+        subdl.shutdown()
+
+    def testEarlyExit(self):
+        import time
+        subdl = offlinePeriscope([ 'SlowFakeSubtitleDB', 'FakeSubtitleDB', 'HashFakeSubtitleDB' ])
+        start = time.time()
+        subs = subdl.listSubtitles('video.avi', [ 'en' ])
+        self.assert_(time.time() - start < 1)
+        self.assertEqual(subs[0]['plugin'].__class__.__name__, 'HashFakeSubtitleDB')
+        self.assert_('SlowFakeSubtitleDB' not in [ s['plugin'].__class__.__name__ for s in subs ])
+        subdl.shutdown()
+        # A release name match does not stop the plugins which may find a hash match
+        subdl = offlinePeriscope([ 'SlowFakeSubtitleDB', 'NameFakeSubtitleDB' ])
+        subs = subdl.listSubtitles('video.avi', [ 'en' ])
+        self.assertEqual(sorted([ s['plugin'].__class__.__name__ for s in subs ]), [ 'NameFakeSubtitleDB', 'SlowFakeSubtitleDB' ])
+        subdl.shutdown()
+
+    def testUnwantedLanguage(self):
+        subdl = offlinePeriscope([ 'FakeSubtitleDB' ])
+        results = list(subdl.downloadSubtitles([ 'video.avi' ], [ 'fr' ]))
+        subdl.shutdown()
+        self.assertEqual(results, [ ('video.avi', None) ])
+
+    def testBatchSearch(self):
+        subdl = offlinePeriscope([ 'BatchFakeSubtitleDB' ])
+        CountingFakeSubtitleDB.calls = 0
+        BatchFakeSubtitleDB.batches = []
+        videos = [ 'video%d.avi' % i for i in range(9) ] + [ 'alone.avi' ]
+        results = dict(subdl.downloadSubtitles(videos, [ 'en' ], window=3))
+        subdl.shutdown()
+        self.assertEqual(sorted(results.keys()), sorted(videos))
+        self.assert_(all(results.values()))
+        self.assertEqual(BatchFakeSubtitleDB.batches, [ 4, 4, 2 ])
+        self.assertEqual(CountingFakeSubtitleDB.calls, 1) # alone.avi
+        self.assertEqual(subdl._batches, {})
+
+    def testBatchDownload(self):
+        subdl = offlinePeriscope([ 'BatchDownloadFakeSubtitleDB' ])
+        BatchDownloadFakeSubtitleDB.batches = []
+        videos = [ 'video%d.avi' % i for i in range(9) ] + [ 'fail.avi' ]
+        results = dict(subdl.downloadSubtitles(videos, [ 'en' ], window=6))
+        subdl.shutdown()
+        self.assertEqual(sorted(results.keys()), sorted(videos))
+        self.assertEqual([ results[video]['release'] for video in videos ], [ 'first' ] * 9 + [ 'second' ])
+        self.assertEqual(sum(BatchDownloadFakeSubtitleDB.batches), 10)
+        self.assert_(len(BatchDownloadFakeSubtitleDB.batches) < 10)
+
+    def testGroupBySeason(self):
+        subdl = offlinePeriscope([ 'FakeSubtitleDB' ])
+        videos = [ 'Dexter.S04E01.HDTV.avi', 'Lost.S06E01.HDTV.avi', 'Avatar.2009.DVDRip.avi',
+                   'Dexter.S04E02.HDTV.avi', 'Dexter.S03E01.HDTV.avi', 'Lost.S06E02.HDTV.avi' ]
+        self.assertEqual(subdl.groupBySeason(videos), [ 'Dexter.S04E01.HDTV.avi', 'Dexter.S04E02.HDTV.avi',
+                                                        'Lost.S06E01.HDTV.avi', 'Lost.S06E02.HDTV.avi',
+                                                        'Avatar.2009.DVDRip.avi', 'Dexter.S03E01.HDTV.avi' ])
+        videos = [ 'Am\xc3\xa9lie.2001.avi', 'H\xe9ros.S01E01.avi', 'Dexter.S04E01.HDTV.avi', 'H\xe9ros.S01E02.avi' ]
+        # Names which cannot be parsed are kept in their own group
+        self.assertEqual(subdl.groupBySeason(videos), videos)
+        subdl.shutdown()
+
+class CountingFakeSubtitleDB(FakeSubtitleDB):
+    calls = 0
+    def process(self, filepath, langs):
+        CountingFakeSubtitleDB.calls += 1
+        if 'broken' in filepath:
+            periscope.plugins.Transport.recordFailure()
+            return []
+        if 'none' in filepath:
+            return []
+        return FakeSubtitleDB.process(self, filepath, langs)
+
+periscope.plugins.CountingFakeSubtitleDB = CountingFakeSubtitleDB
+
+class BatchFakeSubtitleDB(CountingFakeSubtitleDB):
+    ''' Searches up to 4 files at once, except those named alone '''
+    batchSize = 4
+    batches = []
+    def processBatch(self, filepaths, langs):
+        BatchFakeSubtitleDB.batches.append(len(filepaths))
+        return dict([ (filepath, FakeSubtitleDB.process(self, filepath, langs)) for filepath in filepaths if 'alone' not in filepath ])
+
+periscope.plugins.BatchFakeSubtitleDB = BatchFakeSubtitleDB
+
+class BatchDownloadFakeSubtitleDB(FakeSubtitleDB):
+    ''' Downloads up to 4 subtitles at once, except the first subtitle of the files named fail '''
+    downloadBatchSize = 4
+    batches = []
+    def process(self, filepath, langs):
+        return [ dict(sub, release=release) for release in ('first', 'second') for sub in FakeSubtitleDB.process(self, filepath, langs) ]
+    def createFiles(self, subtitles):
+        BatchDownloadFakeSubtitleDB.batches.append(len(subtitles))
+        return [ not ('fail' in s['filename'] and s['release'] == 'first') and self.createFile(s) or None for s in subtitles ]
+
+periscope.plugins.BatchDownloadFakeSubtitleDB = BatchDownloadFakeSubtitleDB
+
+class TestResultCache(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def testExpiryAndEviction(self):
+        import time
+        import cache
+        results = cache.ResultCache(os.path.join(self.folder, 'cache.db'), ttl=60, negativeTtl=0.1, maxEntries=2)
+        results.put('Plugin', 'video', [ 'fr', 'en' ], [ { 'lang': 'en', 'link': 'http://x', 'plugin': object() } ])
+        results.put('Plugin', 'other', [ 'en' ], [])
+        writes = results.db.total_changes
+        self.assertEqual(results.get('Plugin', 'video', [ 'en', 'fr' ]), [ { 'lang': 'en', 'link': 'http://x' } ])
+        self.assertEqual(results.get('Plugin', 'other', [ 'en' ]), [])
+        # Hits do not write, their access times are written by batches
+        self.assertEqual(results.db.total_changes, writes)
+        self.assertEqual(results.get('Plugin', 'video', [ 'en' ]), None)
+        time.sleep(0.2)
+        self.assertEqual(results.get('Plugin', 'other', [ 'en' ]), None)
+        for i in range(3):
+            results.put('Plugin', 'video%d' % i, None, [ { 'lang': 'en' } ])
+            time.sleep(0.01)
+        results.get('Plugin', 'video0', None)
+        results.evict()
+        self.assertEqual([ results.get('Plugin', 'video%d' % i, None) is not None for i in range(3) ], [ True, False, True ])
+        results.close()
+
+    def testCachedSearch(self):
+        import cache
+        subdl = offlinePeriscope([ 'CountingFakeSubtitleDB' ])
+        subdl.cache = cache.ResultCache(os.path.join(self.folder, 'cache.db'))
+        CountingFakeSubtitleDB.calls = 0
+        for i in range(2):
+            subs = subdl.listSubtitles('Show.S01E02.720p.HDTV.x264-GRP.mkv', [ 'en' ])
+            self.assertEqual(subs[0]['plugin'].__class__.__name__, 'CountingFakeSubtitleDB')
+            self.assertEqual(subs[0]['filename'], 'Show.S01E02.720p.HDTV.x264-GRP.mkv')
+            subdl.listSubtitles('none.avi', [ 'en' ])
+            subdl.listSubtitles('broken.avi', [ 'en' ])
+        # Only the failed search is done twice
+        self.assertEqual(CountingFakeSubtitleDB.calls, 4)
+        subdl.shutdown()
+
+    def testSearchHistory(self):
+        import time
+        import cache
+        subdl = offlinePeriscope([ 'FakeSubtitleDB' ])
+        subdl.history = cache.SearchHistory(os.path.join(self.folder, 'cache.db'), backoff=100)
+        for i in range(3):
+            subdl.recordSearch('missed.avi', [ 'en' ], None)
+        subdl.recordSearch('found.avi', [ 'en' ], None)
+        subdl.recordSearch('found.avi', [ 'en' ], { 'lang': 'en' })
+        attempts, lastAttempt, plugins = subdl.history.get(os.path.abspath('missed.avi'), [ 'en' ])
+        self.assertEqual((attempts, plugins), (3, [ 'FakeSubtitleDB' ]))
+        self.assertEqual(subdl.history.nextAttempt(os.path.abspath('missed.avi'), [ 'en' ]), lastAttempt + 400)
+        self.assertEqual(subdl.filterRetries([ 'missed.avi', 'found.avi', 'new.avi' ], [ 'en' ]), [ 'found.avi', 'new.avi' ])
+        self.assertEqual(subdl.filterRetries([ 'missed.avi' ], [ 'fr' ]), [ 'missed.avi' ])
+        self.assert_(subdl.history.shouldSearch(os.path.abspath('missed.avi'), [ 'en' ], time.time() + 400))
+        subdl.shutdown()
+
+        # Files which a plugin failed to search, or which timed out, are not missed
+        subdl = offlinePeriscope([ 'OfflineFakeSubtitleDB', 'SlowFakeSubtitleDB' ])
+        subdl.history = cache.SearchHistory(os.path.join(self.folder, 'cache.db'), backoff=100)
+        subdl.config.set("DEFAULT", "search_timeout", "0.2")
+        for video, sub in subdl.downloadSubtitles([ 'offline.avi' ], [ 'en' ]):
+            subdl.recordSearch(video, [ 'en' ], sub)
+        subdl.config.set("DEFAULT", "search_timeout", "5")
+        subdl.pluginNames = [ 'OfflineFakeSubtitleDB' ]
+        for video, sub in subdl.downloadSubtitles([ 'failed.avi' ], [ 'en' ]):
+            subdl.recordSearch(video, [ 'en' ], sub)
+        subdl.pluginNames = [ 'FakeSubtitleDB' ]
+        for video, sub in subdl.downloadSubtitles([ 'missed.avi' ], [ 'fr' ]):
+            subdl.recordSearch(video, [ 'fr' ], sub)
+        self.assertEqual(subdl.history.get(os.path.abspath('offline.avi'), [ 'en' ]), None)
+        self.assertEqual(subdl.history.get(os.path.abspath('failed.avi'), [ 'en' ]), None)
+        self.assertEqual(subdl.history.get(os.path.abspath('missed.avi'), [ 'fr' ])[0], 1)
+        subdl.shutdown()
+
+    def testBrokenCache(self):
+        subdl = offlinePeriscope([ 'FakeSubtitleDB' ])
+        path = os.path.join(self.folder, 'cache.db')
+        open(path, 'w').write('not a database')
+        subdl.cachePath = lambda: path
+        self.assertEqual(subdl.history, None)
+        subdl.recordSearch('missed.avi', [ 'en' ], None)
+        self.assertEqual(subdl.filterRetries([ 'missed.avi' ], [ 'en' ]), [ 'missed.avi' ])
+        subdl.shutdown()
+
+    def testFingerprints(self):
+        import cache
+        fingerprints = cache.FingerprintCache(os.path.join(self.folder, 'cache.db'))
+        video = os.path.join(self.folder, 'video.avi')
+        open(video, 'wb').write('a' * 1000)
+        computed = []
+        def compute(path):
+            computed.append(path)
+            return '%d' % os.path.getsize(path)
+        plugin = FakeSubtitleDB()
+        plugin.fingerprints = fingerprints
+        self.assertEqual(plugin.fileHash('size', video, compute), '1000')
+        self.assertEqual(plugin.fileHash('size', video, compute), '1000')
+        self.assertEqual(len(computed), 1)
+        open(video, 'ab').write('b')
+        self.assertEqual(plugin.fileHash('size', video, compute), '1001')
+        self.assertEqual(len(fingerprints.query("SELECT * FROM hashes")), 1)
+
+        # The hashes of the plugins come from a single read of the file, then from the database
+        reads = []
+        fromFile = periscope.plugins.Fingerprint.VideoFingerprint.fromFile
+        def countingFromFile(path):
+            reads.append(path)
+            return fromFile(path)
+        periscope.plugins.Fingerprint.VideoFingerprint.fromFile = staticmethod(countingFromFile)
+        try:
+            open(video, 'wb').write(os.urandom(200000))
+            subdb = periscope.plugins.TheSubDB()
+            subdb.fingerprints = fingerprints
+            opensubtitles = periscope.plugins.OpenSubtitles()
+            opensubtitles.fingerprints = fingerprints
+            subdbHash = subdb.fileHash('thesubdb', video, subdb.get_hash)
+            self.assertEqual(opensubtitles.fileHash('opensubtitles', video, opensubtitles.hashFile), fromFile(video).get('opensubtitles'))
+            fingerprints.memory.clear()
+            self.assertEqual(subdb.fileHash('thesubdb', video, subdb.get_hash), subdbHash)
+            self.assertEqual(reads, [ video ])
+        finally:
+            periscope.plugins.Fingerprint.VideoFingerprint.fromFile = classmethod(fromFile.im_func)
+        fingerprints.close()
+
+
+class TestLibrary(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+        for path in ('Show/Season 1/Show.S01E03.mkv', 'Show/Season 1/Show.S01E02.mkv', 'Show/Season 1/Show.S01E01.avi', 'Show/Season 1/Show.S01E01.srt',
+                     'Show/Season 2/Show.S02E01.MP4', 'Show/Season 2/notes.txt', 'Movie.2010.avi', 'Movie.2010.nfo'):
+            path = os.path.join(self.folder, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def testWalk(self):
+        import library
+        found = [ os.path.relpath(video, self.folder) for video in library.LibraryWalker(workers=2).walk(self.folder) ]
+        self.assertEqual(sorted(found), [ 'Movie.2010.avi', 'Show/Season 1/Show.S01E02.mkv', 'Show/Season 1/Show.S01E03.mkv', 'Show/Season 2/Show.S02E01.MP4' ])
+        # The videos of a folder come together, sorted
+        self.assertEqual(found.index('Show/Season 1/Show.S01E03.mkv'), found.index('Show/Season 1/Show.S01E02.mkv') + 1)
+        forced = list(library.LibraryWalker(force=True).walk(self.folder))
+        self.assertEqual(len(forced), 5)
+        self.assertEqual(list(library.LibraryWalker().walk(os.path.join(self.folder, 'Show/Season 1/Show.S01E01.avi'))), [])
+        self.assertEqual(list(library.LibraryWalker().walk(os.path.join(self.folder, 'Movie.2010.nfo'))), [])
+        self.assertEqual(list(library.LibraryWalker().walk(os.path.join(self.folder, 'missing'))), [])
+
+    def testListdirFallback(self):
+        import library
+        scandir, library.scandir = library.scandir, None
+        try:
+            self.assertEqual(len(list(library.LibraryWalker().walk(self.folder))), 4)
+        finally:
+            library.scandir = scandir
+
+
+    def testIndex(self):
+        import time
+        import cache
+        import library
+        def settle(path, age=100):
+            for folder, dirs, files in os.walk(path):
+                os.utime(folder, (time.time() - age, time.time() - age))
+        import tempfile
+        import shutil
+        settle(self.folder)
+        cacheFolder = tempfile.mkdtemp()
+        index = cache.LibraryIndex(os.path.join(cacheFolder, 'cache.db'))
+        listed = []
+        listDirectory = library.listDirectory
+        def countingList(path):
+            listed.append(os.path.relpath(path, self.folder))
+            return listDirectory(path)
+        library.listDirectory = countingList
+        try:
+            walk = lambda: sorted([ os.path.relpath(video, self.folder) for video in library.LibraryWalker(index=index).walk(self.folder) ])
+            videos = [ 'Movie.2010.avi', 'Show/Season 1/Show.S01E02.mkv', 'Show/Season 1/Show.S01E03.mkv', 'Show/Season 2/Show.S02E01.MP4' ]
+            self.assertEqual(walk(), videos)
+            self.assertEqual(len(listed), 4)
+            # Unchanged folders are not listed again but their videos without subtitle still come
+            del listed[:]
+            self.assertEqual(walk(), videos)
+            self.assertEqual(listed, [])
+            open(os.path.join(self.folder, 'Show/Season 1/Show.S01E02.srt'), 'w').close()
+            os.rename(os.path.join(self.folder, 'Show/Season 2'), os.path.join(self.folder, 'Show/Season 02'))
+            settle(os.path.join(self.folder, 'Show'), 10)
+            self.assertEqual(walk(), [ 'Movie.2010.avi', 'Show/Season 02/Show.S02E01.MP4', 'Show/Season 1/Show.S01E03.mkv' ])
+            self.assertEqual(sorted(listed), [ 'Show', 'Show/Season 02', 'Show/Season 1' ])
+            self.assertEqual(index.query("SELECT COUNT(*) FROM folders WHERE path LIKE '%Season 2'")[0][0], 0)
+            # Recently modified folders are listed again on the next walk
+            open(os.path.join(self.folder, 'Show/Show.S03E01.avi'), 'w').close()
+            del listed[:]
+            self.assert_('Show/Show.S03E01.avi' in walk())
+            del listed[:]
+            self.assert_('Show/Show.S03E01.avi' in walk())
+            self.assertEqual(listed, [ 'Show' ])
+        finally:
+            library.listDirectory = listDirectory
+            index.close()
+            shutil.rmtree(cacheFolder)
+
+    def testBrokenIndex(self):
+        import library
+        import tempfile
+        import shutil
+        cacheFolder = tempfile.mkdtemp()
+        path = os.path.join(cacheFolder, 'cache.db')
+        open(path, 'w').write('not a database')
+        subdl = offlinePeriscope([ 'FakeSubtitleDB' ])
+        subdl.cachePath = lambda: path
+        try:
+            self.assertEqual(subdl.libraryIndex, None)
+            walker = library.LibraryWalker(index=subdl.libraryIndex, rescan=True)
+            self.assertEqual(len(list(walker.walk(self.folder))), 4)
+        finally:
+            subdl.shutdown()
+            shutil.rmtree(cacheFolder)
+
+class TestWatcher(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.folder)
+
+    def testDebouncer(self):
+        import watcher
+        video = os.path.join(self.folder, 'Show.S01E01.avi')
+        f = open(video, 'w')
+        debouncer = watcher.Debouncer(settle=5)
+        debouncer.touch(video, 100)
+        self.assertEqual(debouncer.ready(101), [])
+        f.write('a' * 1000)
+        f.flush()
+        # Still growing
+        self.assertEqual(debouncer.ready(106), [])
+        f.close()
+        self.assertEqual(debouncer.ready(110), [])
+        self.assertEqual(debouncer.ready(111), [ video ])
+        self.assertEqual(len(debouncer), 0)
+        debouncer.touch(os.path.join(self.folder, 'gone.avi'))
+        self.assertEqual(debouncer.ready(), [])
+        self.assertEqual(len(debouncer), 0)
+
+    def watch(self, **kwargs):
+        import watcher
+        watch = watcher.Watcher(self.folder, settle=0.1, **kwargs)
+        try:
+            os.makedirs(os.path.join(self.folder, 'Show', 'Season 1'))
+            for name in ('Show.S01E01.avi', 'Show.S01E01.srt', 'Show.S01E02.mkv', 'Show.S01E02.nfo'):
+                open(os.path.join(self.folder, 'Show', 'Season 1', name), 'w').write('data')
+            open(os.path.join(self.folder, 'partial'), 'w').write('data')
+            os.rename(os.path.join(self.folder, 'partial'), os.path.join(self.folder, 'Movie.2010.mp4'))
+            found = []
+            for videos in watch.batches():
+                found += [ os.path.relpath(video, self.folder) for video in videos ]
+                if len(found) >= 2:
+                    break
+            self.assertEqual(sorted(found), [ 'Movie.2010.mp4', 'Show/Season 1/Show.S01E02.mkv' ])
+            return watch
+        finally:
+            watch.close()
+
+    def testInotify(self):
+        import watcher
+        if not watcher.loadLibc():
+            return
+        self.assert_(isinstance(self.watch().source, watcher.InotifySource))
+
+    def testPolling(self):
+        import watcher
+        self.assert_(isinstance(self.watch(polling=True, interval=0.1).source, watcher.PollingSource))
+
+suite = TestSuite([ allTests(TestSubtitles), allTests(TestWorkerPool), allTests(TestBatchDownload),
+                    allTests(TestResultCache), allTests(TestLibrary), allTests(TestWatcher) ])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import errno
+import struct
+import select
+import logging
+import ctypes
+import ctypes.util
+
+import library
+
+log = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+def loadLibc():
+    ''' Returns libc if it has inotify, None otherwise '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ ctypes.c_int ]
+        libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+def videosUnder(path):
+    ''' Returns the paths of all the videos of a folder tree '''
+    videos = []
+    for folder, dirs, files in os.walk(path):
+        videos += [ os.path.join(folder, name) for name in files if library.isVideo(name) ]
+    return videos
+
+
+class InotifySource(object):
+    ''' Reports the files created, written or moved in a folder tree, with inotify. The
+    folders created in the tree are watched as they appear. '''
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+    def __init__(self, root, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.folders = {} # watch descriptor -> path
+        self.watchTree(root)
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            hint = e == errno.ENOSPC and " (raise fs.inotify.max_user_watches)" or ""
+            log.warning("Could not watch %s: %s%s" % (path, os.strerror(e), hint))
+            return
+        self.folders[wd] = path
+
+    def watchTree(self, root):
+        for folder, dirs, files in os.walk(root):
+            self.watch(folder)
+
+    def changes(self, timeout=None):
+        ''' Returns the paths touched within timeout seconds (None waits for one) '''
+        if not select.select([ self.fd ], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        touched = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip('\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Some changes were missed, looking for the videos of the whole tree")
+                for path in set(self.folders.values()):
+                    touched += [ os.path.join(path, name) for name in os.listdir(path) if library.isVideo(name) ]
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                # A folder moved in the tree keeps its descriptor, it gets its new path
+                self.watchTree(path)
+                touched += videosUnder(path)
+            else:
+                touched.append(path)
+        return touched
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingSource(object):
+    ''' Reports the videos of a folder tree which appeared or changed since the previous
+    look, every interval seconds '''
+
+    def __init__(self, root, interval=10):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.look()
+        self.nextLook = time.time() + interval
+
+    def look(self):
+        snapshot = {}
+        for path in videosUnder(self.root):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def changes(self, timeout=None):
+        wait = self.nextLook - time.time()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(0, timeout))
+            return []
+        time.sleep(max(0, wait))
+        self.nextLook = time.time() + self.interval
+        snapshot, self.snapshot = self.snapshot, self.look()
+        return [ path for path, key in self.snapshot.items() if snapshot.get(path) != key ]
+
+    def close(self):
+        pass
+
+
+class Debouncer(object):
+    ''' Holds the touched files until they are fully written: until their size and mtime
+    did not change for settle seconds '''
+
+    def __init__(self, settle=5):
+        self.settle = settle
+        self.pending = {} # path -> ((size, mtime), since)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def touch(self, path, now=None):
+        self.pending[path] = (None, now or time.time())
+
+    def ready(self, now=None):
+        ''' Returns the settled files, sorted, and forgets them. The files which are gone
+        are dropped. '''
+        now = now or time.time()
+        settled = []
+        for path, (key, since) in self.pending.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            current = (st.st_size, st.st_mtime)
+            if current != key:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                settled.append(path)
+        return sorted(settled)
+
+
+class Watcher(object):
+    ''' Finds the videos created or moved in a folder tree, once fully written, which have
+    no subtitle next to them (or all of them if force is set). Changes come from inotify
+    on Linux, from looking at the tree every interval seconds elsewhere. '''
+
+    def __init__(self, root, force=False, settle=5, interval=10, polling=False):
+        self.root = root
+        self.force = force
+        self.debouncer = Debouncer(settle)
+        libc = not polling and loadLibc()
+        self.source = None
+        if libc:
+            try:
+                self.source = InotifySource(root, libc)
+            except OSError, e:
+                log.warning("Could not use inotify, looking for changes every %d seconds: %s" % (interval, e))
+        if not self.source:
+            self.source = PollingSource(root, interval)
+
+    def batches(self):
+        ''' Yields lists of new videos as they are settled, forever '''
+        while True:
+            # Without pending files, wait for changes as long as it takes
+            timeout = None
+            if len(self.debouncer):
+                timeout = min(1, self.debouncer.settle)
+            for path in self.source.changes(timeout):
+                if library.isVideo(path):
+                    self.debouncer.touch(path)
+            videos = self.wanted(self.debouncer.ready())
+            if videos:
+                yield videos
+
+    def wanted(self, paths):
+        if self.force:
+            return paths
+        walker = library.LibraryWalker()
+        videos = []
+        for path in paths:
+            videos += walker.walk(path)
+        return videos
+
+    def close(self):
+        self.source.close()
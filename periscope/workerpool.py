@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+#   This file is part of periscope.
+#
+#    periscope is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    periscope is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with periscope; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import sys
+import threading
+import logging
+import traceback
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+class Future(object):
+    ''' The result of an operation that completes later. Once done, either result or
+    exception is set and the callbacks are called with the future itself.'''
+
+    def __init__(self, key=None):
+        self.key = key
+        self.result = None
+        self.exception = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._callbacks = []
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        ''' Waits until the future is done, returns whether it is '''
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def addCallback(self, callback):
+        ''' Calls callback(future) once it is done (right away if it already is) '''
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def setResult(self, result):
+        self.result = result
+        self._finish()
+
+    def setException(self, exception):
+        self.exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            if self.done():
+                return
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception, e:
+                log.error("Error raised by callback of %s: %s" % (self, e))
+                log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+class Task(Future):
+    ''' A unit of work scheduled on a WorkerPool '''
+
+    def __init__(self, pool, key, func, args, kwargs):
+        super(Task, self).__init__(key)
+        self.pool = pool
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return "<Task %s %s>" % (self.key, getattr(self.func, '__name__', self.func))
+
+    def cancel(self):
+        ''' Removes the task from the pool if it did not start yet. Returns
+        True if the task will not run.'''
+        return self.pool._cancel(self)
+
+    def _run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception, e:
+            log.error("Error raised by task %s: %s" % (self.key, e))
+            log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+            self.exception = e
+
+
+class WorkerPool(object):
+    ''' A bounded pool of long-lived worker threads. Each task is submitted with
+    a key (usually a plugin name); at most maxWorkers tasks run at the same
+    time and at most maxPerKey of them share the same key. Threads are started
+    lazily and stay alive until shutdown.'''
+
+    def __init__(self, maxWorkers=8, maxPerKey=None):
+        self.maxWorkers = max(1, maxWorkers)
+        self.maxPerKey = maxPerKey
+        self.keyLimits = {}
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._running = {}
+        self._workers = []
+        self._busy = set()
+        self._idle = 0
+        self._shutdown = False
+
+    def setKeyLimit(self, key, limit):
+        ''' Overrides maxPerKey for the given key '''
+        with self._cond:
+            self.keyLimits[key] = limit
+            self._cond.notifyAll()
+
+    def submit(self, key, func, *args, **kwargs):
+        ''' Schedules func(*args, **kwargs) and returns its Task '''
+        task = Task(self, key, func, args, kwargs)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit a task to a pool that has been shut down")
+            self._pending.append(task)
+            if len(self._pending) > self._idle and len(self._workers) < self.maxWorkers:
+                worker = threading.Thread(target=self._work, name="periscope-worker-%d" % len(self._workers))
+                worker.setDaemon(True)
+                self._workers.append(worker)
+                worker.start()
+            self._cond.notify()
+        return task
+
+    def shutdown(self, wait=False):
+        ''' Cancels the pending tasks and stops the workers. Idle workers are always
+        joined, busy ones only if wait is True (they are daemonic anyway).'''
+        with self._cond:
+            self._shutdown = True
+            pending, self._pending = self._pending, deque()
+            workers = [ w for w in self._workers if wait or w not in self._busy ]
+            self._cond.notifyAll()
+        for task in pending:
+            task.cancelled = True
+            task._finish()
+        for worker in workers:
+            if worker is not threading.currentThread():
+                worker.join()
+
+    def _limit(self, key):
+        return self.keyLimits.get(key, self.maxPerKey)
+
+    def _next(self):
+        ''' Pops the first pending task whose key is not saturated. Must be called with the lock held. '''
+        for task in self._pending:
+            limit = self._limit(task.key)
+            if task.key is None or not limit or self._running.get(task.key, 0) < limit:
+                self._pending.remove(task)
+                return task
+        return None
+
+    def _cancel(self, task):
+        with self._cond:
+            if task.done():
+                return task.cancelled
+            try:
+                self._pending.remove(task)
+            except ValueError:
+                return False # Already running
+            task.cancelled = True
+        task._finish()
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = None
+                while not self._shutdown:
+                    task = self._next()
+                    if task:
+                        break
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                if not task:
+                    return
+                self._running[task.key] = self._running.get(task.key, 0) + 1
+                self._busy.add(threading.currentThread())
+            try:
+                task._run()
+            finally:
+                with self._cond:
+                    self._running[task.key] -= 1
+                    self._busy.discard(threading.currentThread())
+                    self._cond.notifyAll()
+            # Only now wake up the waiters, so that the worker is idle by the time they get the result
+            task._finish()